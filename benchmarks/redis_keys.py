@@ -0,0 +1,105 @@
+"""Measures the time needed to build the cache keys of redis cached attributes and functions.
+
+Run from the repository root with: python -m benchmarks.redis_keys
+No redis server is needed, only the keys are built.
+"""
+from frasco.redis.attr import RedisCachedProperty, RedisCachedMethod
+from frasco.redis.utils import redis_cached_function
+from frasco.utils import unknown_value
+import inspect
+import re
+import timeit
+
+
+N = 100000
+
+
+class Obj(object):
+    __redis_cache_key__ = 'Obj:{id}:{__name__}'
+    id = 42
+
+    def prop(self):
+        return 1
+
+    def meth(self, a, b=2):
+        return 1
+
+
+def func(a, b=2):
+    return 1
+
+
+# the previous implementation parsed the template on every call and bound the arguments
+# of methods and functions with inspect.getcallargs()
+def uncached_build_object_key(obj=None, name=None, key=None, at_values=None, values=None, super_key=None):
+    cls = None
+    if obj:
+        super_key = getattr(obj, '__redis_cache_key__', None)
+        cls = obj if inspect.isclass(obj) else obj.__class__
+    if key and '{__super__}' in key and super_key is not None:
+        key = key.replace('{__super__}', super_key)
+    elif not key and super_key:
+        key = super_key
+    elif not key:
+        key = '%s:{__name__}' % cls.__name__
+    if name is None and cls:
+        name = cls.__name__
+    values = {} if values is None else dict(**values)
+    for attr in re.findall(r'\{(@?[a-z0-9_]+)[^}]*\}', key, re.I):
+        value = unknown_value
+        if attr == '__name__' and name is not None:
+            value = name
+        elif attr.startswith('@') and at_values:
+            value = at_values.get(attr[1:], '')
+        elif obj:
+            value = getattr(obj, attr)
+        if value is not unknown_value:
+            cache_id = getattr(value, '__redis_cache_id__', None)
+            if cache_id:
+                value = cache_id()
+            values[attr] = value
+    return key.format(**values)
+
+
+def uncached_property_key(attr, obj):
+    return uncached_build_object_key(obj, attr.name, attr.key)
+
+
+def uncached_method_key(attr, args, kwargs, obj):
+    return uncached_build_object_key(obj, attr.name, attr.key, inspect.getcallargs(attr.func, obj, *args, **kwargs))
+
+
+def uncached_function_key(func, key, *args, **kwargs):
+    return uncached_build_object_key(None, func.__name__, key, values=inspect.getcallargs(func, *args, **kwargs))
+
+
+def bench(label, callback):
+    duration = min(timeit.repeat(callback, number=N, repeat=3))
+    print('%-40s %6.2fus/call' % (label, duration / N * 1e6))
+    return duration
+
+
+def main():
+    obj = Obj()
+    prop = RedisCachedProperty(Obj.prop)
+    meth = RedisCachedMethod(Obj.meth, key='{__super__}:{@a}:{@b}')
+    cached_func = redis_cached_function('func:{a}:{b}')(func)
+
+    assert uncached_property_key(prop, obj) == prop.build_key(obj)
+    assert uncached_method_key(meth, (1,), {'b': 3}, obj) == meth.build_key((1,), {'b': 3}, obj)
+    assert uncached_function_key(func, 'func:{a}:{b}', 1, b=3) == cached_func.build_key(1, b=3)
+
+    speedups = []
+    for label, uncached, cached in [
+        ('property key', lambda: uncached_property_key(prop, obj), lambda: prop.build_key(obj)),
+        ('method key', lambda: uncached_method_key(meth, (1,), {'b': 3}, obj),
+                       lambda: meth.build_key((1,), {'b': 3}, obj)),
+        ('function key', lambda: uncached_function_key(func, 'func:{a}:{b}', 1, b=3),
+                         lambda: cached_func.build_key(1, b=3))]:
+        before = bench(label + ' (uncached)', uncached)
+        after = bench(label, cached)
+        speedups.append('%s %.1fx' % (label.split()[0], before / after))
+    print('speedups: %s' % ', '.join(speedups))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""Measures the time needed to convert model objects to rows and to validate rows before an import.
+
+Run from the repository root with: python -m benchmarks.row_codecs
+Uses an in-memory sqlite database, the objects are never saved.
+"""
+from frasco.app import Frasco
+from frasco.models import db
+from frasco.models.utils import model_obj_to_dict, get_model_codec, extract_model_attr_to_col_mapping
+from frasco.models.serializer import DatabaseDictSerializer
+import datetime
+import time
+
+
+N = 100000
+
+
+app = Frasco(__name__)
+app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://')
+db.init_app(app)
+
+
+class BenchAccount(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+
+
+class BenchRow(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String, nullable=False)
+    email = db.Column(db.String, unique=True)
+    created = db.Column(db.DateTime)
+    score = db.Column(db.Integer)
+    active = db.Column(db.Boolean)
+    note = db.Column('note_text', db.String)
+    account_id = db.Column(db.Integer, db.ForeignKey('bench_account.id'))
+
+
+# the previous implementations rebuilt the attribute to column mapping and the list of
+# foreign columns on every row
+def uncached_model_obj_to_dict(obj, value_serializer=None):
+    row = {}
+    for attr, col in extract_model_attr_to_col_mapping(obj.__class__).items():
+        row[col] = (value_serializer or (lambda a: a))(getattr(obj, attr))
+    return row
+
+
+def uncached_get_foreign_cols(table):
+    return [col.name for col in table.c if col.foreign_keys]
+
+
+def uncached_validate_data(table, data):
+    data = {k: v for k, v in data.items() if k in table.c}
+    for col, value in data.items():
+        if value is None and not table.c[col].nullable:
+            return
+    return data
+
+
+def bench(label, callback):
+    duration = min(_time(callback) for _ in range(3))
+    print('%-50s %8.1fms (%.2fus/row)' % (label, duration * 1000, duration / N * 1e6))
+    return duration
+
+
+def _time(callback):
+    start = time.perf_counter()
+    callback()
+    return time.perf_counter() - start
+
+
+def main():
+    now = datetime.datetime(2020, 1, 1)
+    objs = [BenchRow(id=i, name='n%d' % i, email='e%d@example.com' % i, created=now, score=i,
+                     active=True, note='note', account_id=1) for i in range(N)]
+    serializer = DatabaseDictSerializer()
+    table = BenchRow.__table__
+    codec = get_model_codec(BenchRow)
+    assert [uncached_model_obj_to_dict(o) for o in objs[:10]] == [model_obj_to_dict(o) for o in objs[:10]] \
+        == codec.dump_many(objs[:10])
+
+    uncached_dump = bench('model_obj_to_dict (uncached mapping)',
+        lambda: [uncached_model_obj_to_dict(o, serializer._dump_value) for o in objs])
+    dump = bench('model_obj_to_dict', lambda: [model_obj_to_dict(o, serializer._dump_value) for o in objs])
+    dump_many = bench('ModelCodec.dump_many', lambda: codec.dump_many(objs, serializer._dump_value))
+
+    rows = codec.dump_many(objs)
+    uncached_validate = bench('foreign cols + validate (uncached)',
+        lambda: [(uncached_get_foreign_cols(table), uncached_validate_data(table, r)) for r in rows])
+    validate = bench('foreign cols + validate',
+        lambda: [(serializer._get_foreign_cols(table), serializer._validate_data(table, r)) for r in rows])
+
+    print('speedups: dump %.1fx (dump_many %.1fx), validate %.1fx' % (
+        uncached_dump / dump, uncached_dump / dump_many, uncached_validate / validate))
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        main()
@@ -66,28 +66,128 @@ class ContextStack(LocalStack):
 delayed_result = object()
 
 
+def make_call_key(args, kwargs):
+    """Returns a hashable key identifying a call from its arguments"""
+    key = (tuple(args), tuple(sorted(kwargs.items())))
+    try:
+        hash(key)
+    except TypeError:
+        key = repr(key)
+    return key
+
+
+class DelayedCall(object):
+    """A delayed call. Calls coalesced into it when a merge function is given are kept in merged_calls"""
+    __slots__ = ('func', 'args', 'kwargs', 'merge', 'dedupe_key', 'background', 'merged_calls')
+
+    def __init__(self, func, args, kwargs, merge=None, dedupe_key=None, background=False):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.merge = merge
+        self.dedupe_key = dedupe_key
+        self.background = background
+        self.merged_calls = [(args, kwargs)] if merge is not None else None
+
+    def get_call_args(self):
+        """Returns the (args, kwargs) to call func with"""
+        if self.merge is not None:
+            return self.merge(self.merged_calls)
+        return self.args, self.kwargs
+
+    def __call__(self):
+        args, kwargs = self.get_call_args()
+        return self.func(*args, **kwargs)
+
+    def prepare(self):
+        """Returns a function running the call which can be called from another thread.
+        When background is a function, it is called with the call arguments in the calling thread
+        and must return this function (or None if there is nothing left to run).
+        """
+        args, kwargs = self.get_call_args()
+        if callable(self.background):
+            return self.background(*args, **kwargs)
+        return functools.partial(self.func, *args, **kwargs)
+
+
+class DelayedCalls(list):
+    """List of DelayedCall.
+    Calls with a key are coalesced: only the first one is kept, or if a merge function is
+    given, all the (args, kwargs) sharing the key are passed to it when calling and it
+    must return the (args, kwargs) of a single call.
+    """
+    def __init__(self):
+        super(DelayedCalls, self).__init__()
+        self.coalesced = {}
+
+    def add(self, func, args, kwargs, key=None, merge=None, background=False):
+        if key is None:
+            self.append(DelayedCall(func, args, kwargs, background=background))
+            return
+        call = self.coalesced.get((func, key))
+        if call is None:
+            call = self.coalesced[(func, key)] = DelayedCall(func, args, kwargs, merge, key, background)
+            self.append(call)
+        elif merge is not None:
+            call.merged_calls.append((args, kwargs))
+
+
 class DelayedCallsContext(ContextStack):
+    """Delays calls until the context is popped.
+    Calls flagged with background are passed to dispatcher(run) if one is set,
+    which must eventually call run() (eg: from another thread). background can be a function
+    preparing the call in the calling thread (see DelayedCall.prepare()), so that the thread
+    running it does not depend on thread local state (eg: the sqlalchemy session).
+    """
     def __init__(self, **kwargs):
         self.calling_ctx = kwargs.pop('calling_ctx', ContextStack(default_item=True))
-        super(DelayedCallsContext, self).__init__(default_item=list, ignore_nested=True, **kwargs)
-
-    def call(self, func, args, kwargs):
+        self.dispatcher = kwargs.pop('dispatcher', None)
+        super(DelayedCallsContext, self).__init__(default_item=DelayedCalls, ignore_nested=True, **kwargs)
+
+    def call(self, func, args, kwargs, dedupe_key=None, merge=None, background=False):
+        """Calls func now or delays the call until the context is popped.
+        dedupe_key can be True (to use the arguments) or a function receiving the same arguments
+        as func and returning a key (or None to not coalesce the call). Delayed calls with the same key
+        are coalesced (see DelayedCalls). When merge is provided without dedupe_key, all delayed calls
+        to func are merged.
+        """
         if self.top is not None:
-            self.top.append((func, args, kwargs))
+            key = None
+            if dedupe_key is True:
+                key = make_call_key(args, kwargs)
+            elif dedupe_key:
+                key = dedupe_key(*args, **kwargs)
+            elif merge:
+                key = func
+            self.top.add(func, args, kwargs, key, merge, background)
             return delayed_result
         return func(*args, **kwargs)
 
     def pop(self, drop_calls=False):
         top = super(DelayedCallsContext, self).pop()
-        if not drop_calls and not self.is_stacked:
+        if drop_calls or self.is_stacked:
+            return
+        background_calls = [c for c in top if c.background] if self.dispatcher else []
+        if background_calls:
+            self.run_calls([c for c in top if not c.background])
             with self.calling_ctx():
-                for func, args, kwargs in top:
-                    func(*args, **kwargs)
-
-    def proxy(self, func):
+                runs = [run for run in (c.prepare() for c in background_calls) if run is not None]
+            if runs:
+                self.dispatcher(functools.partial(self.run_calls, runs))
+        else:
+            self.run_calls(top)
+
+    def run_calls(self, calls):
+        with self.calling_ctx():
+            for call in calls:
+                call()
+
+    def proxy(self, func=None, dedupe_key=None, merge=None, background=False):
+        if func is None:
+            return lambda func: self.proxy(func, dedupe_key, merge, background)
         @functools.wraps(func)
         def proxy(*args, **kwargs):
-            return self.call(func, args, kwargs)
+            return self.call(func, args, kwargs, dedupe_key, merge, background)
         proxy.call_now = func
         return proxy
 
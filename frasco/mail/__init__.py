@@ -2,7 +2,7 @@ from flask import g, current_app
 from flask.signals import Namespace
 from frasco.ext import *
 from frasco.models import delayed_tx_calls
-from frasco.tasks import enqueue_task
+from frasco.tasks import enqueue_task, prepare_enqueue
 from frasco.templating.extensions import RemoveYamlFrontMatterExtension
 from frasco.utils import extract_unmatched_items, import_class, AttrDict
 from jinja_macro_tags import MacroLoader, MacroRegistry
@@ -11,6 +11,7 @@ from contextlib import contextmanager
 from flask_mail import Mail
 import os
 import datetime
+import functools
 
 from .message import create_message, clickable_links, markdown_jinja, log_message
 from .provider import MailProvider, bulk_connection_context
@@ -98,7 +99,15 @@ class FrascoMail(Extension):
         state.connections[name] = self.create_connection(options, provider, _state=state)
 
 
-@delayed_tx_calls.proxy
+def _prepare_send_message(msg, connection="default", silent=None):
+    # bulk connections are only opened in the calling thread
+    if bulk_connection_context.top:
+        send_message_sync.call_now(msg, connection, silent)
+        return None
+    return functools.partial(send_message_sync.call_now, msg, connection, silent)
+
+
+@delayed_tx_calls.proxy(background=_prepare_send_message)
 def send_message_sync(msg, connection="default", silent=None):
     state = get_extension_state('frasco_mail')
 
@@ -126,7 +135,12 @@ def send_message_sync(msg, connection="default", silent=None):
         current_app.log_exception(e)
 
 
-@delayed_tx_calls.proxy
+def _prepare_send_message_async(msg, connection="default"):
+    require_extension('frasco_tasks')
+    return prepare_enqueue(send_message_sync, kwargs=dict(msg=msg, connection=connection))
+
+
+@delayed_tx_calls.proxy(background=_prepare_send_message_async)
 def send_message_async(msg, connection="default"):
     require_extension('frasco_tasks')
     enqueue_task(send_message_sync, msg=msg, connection=connection)
@@ -48,14 +48,20 @@ def marshal_with(marshaller, filter=None, filter_status_code=403, **marshaller_k
 
 
 def marshal_many_with(marshaller, filter=None, **marshaller_kwargs):
+    """Marshals each item returned by the function. When the function returns a page
+    (eg: from keyset_paginate()), a dict {items, next_cursor} is returned.
+    """
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             items = func(*args, **kwargs)
             if not disable_marshaller.top:
+                page = items if hasattr(items, 'next_cursor') else None
                 items = [marshal(i, marshaller, func=func, args=args, kwargs=kwargs, **marshaller_kwargs) for i in items]
                 if filter:
                     items = [i for i in items if filter(i)]
+                if page is not None:
+                    return {"items": items, "next_cursor": page.next_cursor}
             return items
         wrapper.marshalled_with = marshaller
         return wrapper
@@ -1,3 +1,7 @@
 from .ext import db
 from .transactions import *
 from .utils import *
+from .identity_cache import *
+from .events import *
+from .instrumentation import *
+from .replicas import *
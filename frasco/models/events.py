@@ -0,0 +1,41 @@
+from flask import has_app_context
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, inspect as sqla_inspect
+import itertools
+import logging
+
+
+__all__ = ('after_modified_objs_commit',)
+
+
+logger = logging.getLogger('frasco.models')
+
+
+def after_modified_objs_commit(info_key, callback, filter=None):
+    """Registers session listeners collecting the instances modified or deleted by each flush
+    (for which filter(obj) is true) and calling callback(objs) once they are committed.
+    Errors raised by callback are logged as the commit cannot be undone anymore.
+    """
+    @event.listens_for(SignallingSession, 'after_flush')
+    def on_after_flush(session, flush_context):
+        objs = session.info.setdefault(info_key, {})
+        for obj in itertools.chain(session.dirty, session.deleted):
+            if filter is not None and not filter(obj):
+                continue
+            if obj in session.deleted or session.is_modified(obj, include_collections=False):
+                objs[sqla_inspect(obj).key] = obj
+
+    @event.listens_for(SignallingSession, 'after_commit')
+    def on_after_commit(session):
+        objs = session.info.pop(info_key, None)
+        if not objs or not has_app_context():
+            return
+        try:
+            callback(list(objs.values()))
+        except Exception:
+            logger.exception('Error in the after commit callback of %s' % info_key)
+
+    @event.listens_for(SignallingSession, 'after_soft_rollback')
+    def on_after_soft_rollback(session, previous_transaction):
+        if previous_transaction.parent is None:
+            session.info.pop(info_key, None)
@@ -1,7 +1,9 @@
 from flask_sqlalchemy import SQLAlchemy, Model as BaseModel
 from flask_migrate import Migrate
+from sqlalchemy import orm
 from frasco.ext import get_extension_config
 from frasco.helpers import inject_app_config
+from .identity_cache import identity_cache_get, identity_cache_get_many
 
 
 class Model(BaseModel):
@@ -10,7 +12,17 @@ class Model(BaseModel):
 
     @classmethod
     def __taskload__(cls, id):
-        return cls.query.get(id)
+        return cls.get_cached(id)
+
+    @classmethod
+    def get_cached(cls, id):
+        """Same as query.get() but uses the identity cache if enabled with __identity_cache__"""
+        return identity_cache_get(cls, id)
+
+    @classmethod
+    def get_many(cls, ids):
+        """Returns the objects with the given ids (None for missing ones) using the identity cache if enabled"""
+        return identity_cache_get_many(cls, ids)
 
 
 class FrascoModels(SQLAlchemy):
@@ -23,9 +35,27 @@ class FrascoModels(SQLAlchemy):
 
     def init_app(self, app):
         app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-        inject_app_config(app, get_extension_config(app, 'frasco_models'), prefix="SQLALCHEMY_")
+        config = get_extension_config(app, 'frasco_models')
+        background_delayed_calls = config.pop('background_delayed_calls', False)
+        delayed_calls_options = {k: config.pop('delayed_calls_%s' % k) for k in ('workers', 'max_pending', 'submit_timeout')
+            if 'delayed_calls_%s' % k in config}
+        replicas = config.pop('replicas', None)
+        replicas_options = {k: config.pop('replicas_%s' % k) for k in ('max_lag', 'lag_check_interval', 'lag_query')
+            if 'replicas_%s' % k in config}
+        inject_app_config(app, config, prefix="SQLALCHEMY_")
         super(FrascoModels, self).init_app(app)
         self.migrate = Migrate(app, self)
+        if background_delayed_calls:
+            from .transactions import DelayedCallsExecutor
+            app.extensions['frasco_delayed_tx_calls'] = DelayedCallsExecutor(**delayed_calls_options)
+        if replicas:
+            from .replicas import ReplicaSet
+            app.extensions['frasco_replicas'] = ReplicaSet.from_urls([replicas] if isinstance(replicas, str) else replicas,
+                app.config.get('SQLALCHEMY_ENGINE_OPTIONS'), **replicas_options)
+
+    def create_session(self, options):
+        from .replicas import RoutingSession
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
 
 
 db = FrascoModels()
@@ -0,0 +1,235 @@
+from frasco.ext import get_extension_state, has_extension
+from frasco.utils import unknown_value
+from sqlalchemy import inspect as sqla_inspect, tuple_
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from collections import OrderedDict
+from .events import after_modified_objs_commit
+import threading
+import logging
+import pickle
+import time
+
+
+__all__ = ('identity_cache_get', 'identity_cache_get_many', 'invalidate_identity_cache', 'LocalIdentityCacheBackend',
+           'RedisIdentityCacheBackend')
+
+
+logger = logging.getLogger('frasco.models')
+DEFAULT_OPTIONS = {"ttl": 300, "backend": None, "key_prefix": "identity"}
+
+
+class LocalIdentityCacheBackend(object):
+    """In-process LRU storage. Invalidations only apply to the current process
+    so a short ttl should be used when running multiple processes.
+    """
+    def __init__(self, max_items=10000):
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        now = time.time()
+        values = []
+        with self._lock:
+            for key in keys:
+                item = self._items.get(key)
+                if item is not None and item[1] and item[1] < now:
+                    del self._items[key]
+                    item = None
+                elif item is not None:
+                    self._items.move_to_end(key)
+                values.append(item[0] if item else None)
+        return values
+
+    def set_many(self, items, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            for key, value in items:
+                self._items[key] = (value, expires_at)
+                self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._items.pop(key, None)
+
+
+class RedisIdentityCacheBackend(object):
+    """Stores rows using the cache connection of frasco_redis"""
+    @property
+    def redis(self):
+        return get_extension_state('frasco_redis').cache_binary_connection
+
+    def get_many(self, keys):
+        from frasco.redis import guard_redis_call
+        values = guard_redis_call(self.redis.mget, keys)
+        if not isinstance(values, list):
+            # redis is unavailable
+            return [None] * len(keys)
+        return values
+
+    def set_many(self, items, ttl=None):
+        from frasco.redis import guard_redis_call
+        pipe = self.redis.pipeline(transaction=False)
+        for key, value in items:
+            if ttl:
+                pipe.setex(key, ttl, value)
+            else:
+                pipe.set(key, value)
+        guard_redis_call(pipe.execute)
+
+    def delete_many(self, keys):
+        from frasco.redis import guard_redis_call
+        if guard_redis_call(self.redis.delete, *keys) is unknown_value:
+            logger.error('Redis is unavailable, identity cache keys were not invalidated: %s' % ', '.join(keys))
+
+
+local_backend = LocalIdentityCacheBackend()
+redis_backend = RedisIdentityCacheBackend()
+_options_cache = {}
+
+
+def get_identity_cache_options(cls):
+    """Returns the identity cache options of a model class or None if it is not enabled
+    (using the __identity_cache__ class attribute which can be True or a dict of options)
+    """
+    if cls not in _options_cache:
+        options = getattr(cls, '__identity_cache__', None)
+        if options:
+            options = dict(DEFAULT_OPTIONS, **(options if isinstance(options, dict) else {}))
+        _options_cache[cls] = options or None
+    return _options_cache[cls]
+
+
+def _get_backend(options):
+    if options['backend'] == 'local' or (options['backend'] is None and not has_extension('frasco_redis')):
+        return local_backend
+    return redis_backend
+
+
+def _ident(mapper, id):
+    ident = tuple(id) if isinstance(id, (tuple, list)) else (id,)
+    return tuple(_coerce_pk_value(col, value) for col, value in zip(mapper.primary_key, ident))
+
+
+def _coerce_pk_value(col, value):
+    # ids from urls or cookies are strings
+    if not isinstance(value, str):
+        return value
+    try:
+        python_type = col.type.python_type
+    except NotImplementedError:
+        return value
+    if python_type is str:
+        return value
+    try:
+        return python_type(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def identity_cache_key(cls, ident, options=None):
+    options = options or get_identity_cache_options(cls)
+    return '%s:%s:%s' % (options['key_prefix'], cls.__name__, ':'.join(str(v) for v in ident))
+
+
+def _dump_instance(obj):
+    state = sqla_inspect(obj)
+    # only loaded columns are stored, others will be lazy loaded
+    return pickle.dumps(dict((attr.key, state.dict[attr.key]) for attr in state.mapper.column_attrs
+        if attr.key in state.dict), pickle.HIGHEST_PROTOCOL)
+
+
+def _load_instance(cls, session, data):
+    mapper = sqla_inspect(cls)
+    obj = mapper.class_manager.new_instance()
+    for key, value in pickle.loads(data).items():
+        if key in mapper.column_attrs:
+            set_committed_value(obj, key, value)
+    make_transient_to_detached(obj)
+    existing = session.identity_map.get(sqla_inspect(obj).key)
+    if existing is not None:
+        return existing
+    session.add(obj)
+    return obj
+
+
+def identity_cache_get(cls, id):
+    """Same as cls.query.get(id) but reads the row from the identity cache
+    """
+    options = get_identity_cache_options(cls)
+    if options is None:
+        return cls.query.get(id)
+    return identity_cache_get_many(cls, [id])[0]
+
+
+def identity_cache_get_many(cls, ids):
+    """Returns the objects with the given primary keys (None for missing ones), in the same order.
+    Cached rows are fetched at once (MGET with redis) and the others with a single IN query.
+    """
+    ids = list(ids)
+    if not ids:
+        return []
+    options = get_identity_cache_options(cls)
+    mapper = sqla_inspect(cls)
+    query = cls.query
+    session = query.session
+    idents = [_ident(mapper, id) for id in ids]
+    objs = {}
+
+    lookup = []
+    for ident in idents:
+        obj = session.identity_map.get(mapper.identity_key_from_primary_key(ident))
+        if obj is not None:
+            objs[ident] = obj
+        elif options is not None:
+            lookup.append(ident)
+
+    if lookup:
+        backend = _get_backend(options)
+        keys = [identity_cache_key(cls, ident, options) for ident in lookup]
+        for ident, data in zip(lookup, backend.get_many(keys)):
+            if data is not None:
+                objs[ident] = _load_instance(cls, session, data)
+
+    missing = list(OrderedDict.fromkeys(ident for ident in idents if ident not in objs))
+    if missing:
+        if len(mapper.primary_key) == 1:
+            q = query.filter(mapper.primary_key[0].in_([ident[0] for ident in missing]))
+        else:
+            q = query.filter(tuple_(*mapper.primary_key).in_(missing))
+        loaded = []
+        for obj in q:
+            ident = tuple(mapper.primary_key_from_instance(obj))
+            objs[ident] = obj
+            if options is not None and type(obj) is cls:
+                loaded.append((identity_cache_key(cls, ident, options), _dump_instance(obj)))
+        if loaded:
+            _get_backend(options).set_many(loaded, options['ttl'])
+
+    return [objs.get(ident) for ident in idents]
+
+
+def invalidate_identity_cache(*objs):
+    """Removes instances from the identity cache"""
+    keys_by_backend = {}
+    for obj in objs:
+        options = get_identity_cache_options(obj.__class__)
+        identity = sqla_inspect(obj).identity
+        if options is None or identity is None:
+            continue
+        keys_by_backend.setdefault(_get_backend(options), []).append(
+            identity_cache_key(obj.__class__, identity, options))
+    for backend, keys in keys_by_backend.items():
+        backend.delete_many(keys)
+
+
+def _invalidate_committed_objs(objs):
+    invalidate_identity_cache(*objs)
+
+
+after_modified_objs_commit('identity_cache_to_invalidate', _invalidate_committed_objs,
+    filter=lambda obj: get_identity_cache_options(obj.__class__) is not None)
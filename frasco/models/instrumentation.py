@@ -0,0 +1,260 @@
+from flask import request
+from frasco.ext import *
+from frasco.ctx import ContextStack
+from frasco.redis.stats import BufferedRedisStats
+from sqlalchemy import event
+import sqlalchemy
+from sqlalchemy.engine import Engine
+from contextlib import contextmanager
+import traceback
+import logging
+import click
+import time
+import os
+import re
+
+
+__all__ = ('FrascoSQLInstrumentation', 'SQLProfile', 'SQLStats', 'sql_profile', 'current_sql_profile', 'fingerprint_statement')
+
+
+logger = logging.getLogger('frasco.models.sql')
+sql_profile_ctx = ContextStack()
+current_sql_profile = sql_profile_ctx.make_proxy()
+# requests not matching any endpoint share a profile instead of creating one per path
+UNMATCHED_PROFILE_NAME = '<unmatched>'
+
+
+_fingerprint_res = [(re.compile(p, re.S), r) for p, r in (
+    (r"'(?:[^']|'')*'", '?'),                       # string literals
+    (r'%\(\w+\)s|\$\d+|(?<![:\w]):\w+|%s', '?'),    # bind parameters
+    (r'\b\d+(?:\.\d+)?\b', '?'),                   # numbers
+    (r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(?)'),          # IN lists and VALUES
+    (r'(?:\(\?\)\s*,\s*)+\(\?\)', '(?)'),            # multi-row VALUES
+    (r'\s+', ' '))]
+
+
+def fingerprint_statement(statement):
+    """Normalizes a SQL statement so that queries differing only by their values are equal"""
+    for regexp, repl in _fingerprint_res:
+        statement = regexp.sub(repl, statement)
+    return statement.strip()
+
+
+_sqlalchemy_dir = os.path.dirname(sqlalchemy.__file__) + os.sep
+
+
+def _get_caller_location():
+    for frame in reversed(traceback.extract_stack()):
+        if frame.filename.startswith(_sqlalchemy_dir) or frame.filename == __file__ or 'flask_sqlalchemy' in frame.filename:
+            continue
+        return '%s:%s in %s' % (frame.filename, frame.lineno, frame.name)
+
+
+class SQLProfile(object):
+    """Counts queries, their total time and their fingerprints for a unit of work (a request or a task).
+    Fingerprints executed at least n_plus_one_threshold times are flagged as likely N+1 queries
+    with the location of the code which executed it.
+    """
+    def __init__(self, name, n_plus_one_threshold=5):
+        self.name = name
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.query_count = 0
+        self.total_time = 0
+        self.fingerprints = {} # fingerprint -> [count, time]
+        self.n_plus_one = {} # fingerprint -> location
+        self.started_at = time.time()
+
+    def record(self, statement, duration):
+        self.query_count += 1
+        self.total_time += duration
+        fingerprint = fingerprint_statement(statement)
+        stats = self.fingerprints.get(fingerprint)
+        if stats is None:
+            stats = self.fingerprints[fingerprint] = [0, 0]
+        stats[0] += 1
+        stats[1] += duration
+        if stats[0] == self.n_plus_one_threshold:
+            # the stack is only extracted once per flagged fingerprint
+            self.n_plus_one[fingerprint] = _get_caller_location()
+
+    def get_n_plus_one(self):
+        """Returns a list of (fingerprint, count, time, location) for queries flagged as N+1"""
+        return sorted([(fp, self.fingerprints[fp][0], self.fingerprints[fp][1], location)
+            for fp, location in self.n_plus_one.items()], key=lambda i: i[1], reverse=True)
+
+    def summary(self):
+        return "%s: %d queries in %.1fms%s" % (self.name, self.query_count, self.total_time * 1000,
+            (", %d likely N+1" % len(self.n_plus_one)) if self.n_plus_one else "")
+
+    def header_value(self):
+        return "count=%d; time=%.1fms; n+1=%d" % (self.query_count, self.total_time * 1000, len(self.n_plus_one))
+
+
+class SQLStats(BufferedRedisStats):
+    """Aggregates profiles per name in memory and periodically adds them to redis hashes
+    so that the stats of all workers can be reported together.
+    """
+    counters = ('count', 'queries', 'time', 'n_plus_one')
+    float_counters = ('time',)
+
+    def __init__(self, key_prefix='frasco:sql_stats', flush_interval=10):
+        super(SQLStats, self).__init__(key_prefix, flush_interval)
+
+    def _reset_buffers(self):
+        super(SQLStats, self)._reset_buffers()
+        self._n_plus_one = {}
+
+    def _take_buffers(self):
+        n_plus_one = self._n_plus_one
+        self._n_plus_one = {}
+        return super(SQLStats, self)._take_buffers(), n_plus_one
+
+    def add(self, profile):
+        with self._lock:
+            self._check_pid()
+            counters = self._counters.setdefault(profile.name, {'count': 0, 'queries': 0, 'time': 0.0, 'n_plus_one': 0})
+            counters['count'] += 1
+            counters['queries'] += profile.query_count
+            counters['time'] += profile.total_time
+            counters['n_plus_one'] += 1 if profile.n_plus_one else 0
+            for fingerprint, count, _, location in profile.get_n_plus_one():
+                field = '\x00'.join((profile.name, location or '', fingerprint))
+                self._n_plus_one[field] = self._n_plus_one.get(field, 0) + 1
+
+    def _queue_flush(self, pipe, buffers):
+        counters, n_plus_one = buffers
+        for field, count in n_plus_one.items():
+            pipe.hincrby('%s:n_plus_one' % self.key_prefix, field, count)
+        return super(SQLStats, self)._queue_flush(pipe, counters) or bool(n_plus_one)
+
+    def read(self, redis):
+        """Returns a tuple (stats per name, list of (name, location, fingerprint, count))"""
+        stats = super(SQLStats, self).read(redis)
+        n_plus_one = []
+        for field, count in redis.hgetall('%s:n_plus_one' % self.key_prefix).items():
+            if isinstance(field, bytes):
+                field = field.decode('utf-8')
+            n_plus_one.append(tuple(field.split('\x00', 2)) + (int(count),))
+        return stats, sorted(n_plus_one, key=lambda i: i[3], reverse=True)
+
+    def reset(self, redis):
+        super(SQLStats, self).reset(redis)
+        redis.delete('%s:n_plus_one' % self.key_prefix)
+
+
+class FrascoSQLInstrumentation(Extension):
+    """Records the number of queries, their time and likely N+1 queries per request and per task.
+    Reports are logged, added as a response header and aggregated in redis (if frasco_redis
+    is enabled) for the sql-stats command.
+    """
+    name = 'frasco_sql_instrumentation'
+    defaults = {"n_plus_one_threshold": 5,
+                "log_summary": False,
+                "log_n_plus_one": True,
+                "response_header": None,
+                "response_header_name": "X-SQL-Queries",
+                "stats": True,
+                "stats_redis_connection": None,
+                "stats_key": "frasco:sql_stats",
+                "stats_flush_interval": 10}
+
+    def _init_app(self, app, state):
+        if state.options['response_header'] is None:
+            state.options['response_header'] = app.debug
+        state.stats = None
+        if state.options['stats'] and has_extension('frasco_redis', app):
+            state.stats = SQLStats(state.options['stats_key'], state.options['stats_flush_interval'])
+        register_sql_instrumentation_listeners()
+
+        def start_profile():
+            sql_profile_ctx.push(SQLProfile(request.endpoint or UNMATCHED_PROFILE_NAME, state.options['n_plus_one_threshold']))
+        # registered first so that queries from other before_request functions are counted
+        app.before_request_funcs.setdefault(None, []).insert(0, start_profile)
+
+        @app.after_request
+        def add_header(response):
+            profile = sql_profile_ctx.top
+            if profile is not None and state.options['response_header']:
+                response.headers[state.options['response_header_name']] = profile.header_value()
+            return response
+
+        @app.teardown_request
+        def end_profile(exc):
+            if sql_profile_ctx.top is not None:
+                report_sql_profile(sql_profile_ctx.pop(), state)
+
+        @app.cli.command('sql-stats')
+        @click.option('--limit', default=20, help='Maximum number of N+1 queries to report')
+        @click.option('--reset', is_flag=True, help='Reset the counters after reporting them')
+        def stats_command(limit, reset):
+            """Report queries per request/task and likely N+1 queries"""
+            redis = _get_stats_redis(state)
+            stats, n_plus_one = SQLStats(state.options['stats_key']).read(redis)
+            click.echo("%-50s %10s %12s %12s %8s" % ("request/task", "count", "avg queries", "avg time", "N+1"))
+            for name, counters in sorted(stats.items(), key=lambda i: i[1]['queries'], reverse=True):
+                click.echo("%-50s %10d %12.1f %10.1fms %8d" % (name, counters['count'],
+                    counters['queries'] / float(counters['count'] or 1),
+                    counters['time'] * 1000.0 / (counters['count'] or 1), counters['n_plus_one']))
+            if n_plus_one:
+                click.echo("\nLikely N+1 queries")
+                for name, location, fingerprint, count in n_plus_one[:limit]:
+                    click.echo("%dx %s at %s\n    %s" % (count, name, location, fingerprint))
+            if reset:
+                SQLStats(state.options['stats_key']).reset(redis)
+
+
+def _get_stats_redis(state):
+    return get_extension_state('frasco_redis').get_connection(state.options['stats_redis_connection'])
+
+
+def report_sql_profile(profile, state=None):
+    state = get_extension_state('frasco_sql_instrumentation', state)
+    if state.options['log_n_plus_one']:
+        for fingerprint, count, duration, location in profile.get_n_plus_one():
+            logger.warning("Likely N+1 query in %s: executed %d times (%.1fms) at %s: %s" % (
+                profile.name, count, duration * 1000, location, fingerprint))
+    if state.options['log_summary']:
+        logger.info(profile.summary())
+    if state.stats:
+        state.stats.add(profile)
+        try:
+            state.stats.maybe_flush(_get_stats_redis(state))
+        except Exception as e:
+            logger.warning("Could not save sql stats: %s" % e)
+
+
+@contextmanager
+def sql_profile(name):
+    """Profiles the queries executed in the block (when the extension is enabled), yielding the SQLProfile"""
+    if not has_extension('frasco_sql_instrumentation'):
+        yield None
+        return
+    state = get_extension_state('frasco_sql_instrumentation')
+    profile = sql_profile_ctx.push(SQLProfile(name, state.options['n_plus_one_threshold']))
+    try:
+        yield profile
+    finally:
+        sql_profile_ctx.pop()
+        report_sql_profile(profile, state)
+
+
+_listeners_registered = False
+
+
+def register_sql_instrumentation_listeners():
+    global _listeners_registered
+    if _listeners_registered:
+        return
+    _listeners_registered = True
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if sql_profile_ctx.top is not None:
+            conn.info.setdefault('frasco_query_start', []).append(time.perf_counter())
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        profile = sql_profile_ctx.top
+        starts = conn.info.get('frasco_query_start')
+        if profile is not None and starts:
+            profile.record(statement, time.perf_counter() - starts.pop())
@@ -0,0 +1,168 @@
+from flask_sqlalchemy import SignallingSession
+from frasco.ctx import ContextStack
+from sqlalchemy import event, text
+from sqlalchemy.sql.selectable import Select, CompoundSelect
+from contextlib import contextmanager
+import sqlalchemy
+import threading
+import logging
+import time
+import os
+
+
+__all__ = ('read_only', 'use_primary', 'ReplicaSet')
+
+
+logger = logging.getLogger('frasco.models')
+_read_only_ctx = ContextStack(False, default_item=True)
+
+
+LAG_QUERIES = {
+    'postgresql': "SELECT COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)"
+}
+
+
+@contextmanager
+def read_only():
+    """Routes the SELECT queries of the session to a replica (can also be used as a decorator).
+    Queries go to the primary inside transaction() or once the session has written.
+    """
+    _read_only_ctx.push(True)
+    try:
+        yield
+    finally:
+        _read_only_ctx.pop()
+
+
+@contextmanager
+def use_primary():
+    """Forces queries to go to the primary, even inside read_only()"""
+    _read_only_ctx.push(False)
+    try:
+        yield
+    finally:
+        _read_only_ctx.pop()
+
+
+class ReplicaSet(object):
+    """Engines of the read replicas, balanced using round-robin.
+    When max_lag is set, the replication lag of each replica is checked every lag_check_interval
+    seconds by a background thread (one per process) and replicas lagging more than max_lag seconds
+    (or whose lag is not known yet) are skipped. Choosing a replica never connects to the database.
+    """
+    def __init__(self, engines, max_lag=None, lag_check_interval=10, lag_query=None):
+        self.engines = list(engines)
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self.lag_query = lag_query
+        self._index = 0
+        self._lags = {} # engine -> lag
+        self._lock = threading.Lock()
+        self._lag_thread = None
+        self._pid = None
+
+    @classmethod
+    def from_urls(cls, urls, engine_options=None, **kwargs):
+        return cls([sqlalchemy.create_engine(url, **(engine_options or {})) for url in urls], **kwargs)
+
+    def check_lag(self, engine):
+        """Queries the replication lag of the replica in seconds (None if it cannot be checked)"""
+        query = self.lag_query or LAG_QUERIES.get(engine.dialect.name)
+        if not query:
+            return 0
+        try:
+            with engine.connect() as conn:
+                return float(conn.execute(text(query)).scalar() or 0)
+        except Exception as e:
+            logger.warning('Cannot check the replication lag of %s: %s' % (engine.url, e))
+
+    def check_lags(self):
+        for engine in self.engines:
+            self._lags[engine] = self.check_lag(engine)
+
+    def get_lag(self, engine):
+        """Returns the last checked replication lag in seconds (None if not checked yet or if the check failed)"""
+        self._start_lag_thread()
+        return self._lags.get(engine)
+
+    def _start_lag_thread(self):
+        if self._lag_thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._lag_thread is None or self._pid != os.getpid():
+                # threads are not inherited by forked processes
+                self._lags = {}
+                self._pid = os.getpid()
+                self._lag_thread = threading.Thread(target=self._check_lags_forever, name='frasco-replicas-lag', daemon=True)
+                self._lag_thread.start()
+
+    def _check_lags_forever(self):
+        while True:
+            self.check_lags()
+            time.sleep(self.lag_check_interval)
+
+    def is_available(self, engine):
+        if self.max_lag is None:
+            return True
+        lag = self.get_lag(engine)
+        return lag is not None and lag <= self.max_lag
+
+    def next_engine(self):
+        """Returns the next available replica engine or None if all of them are lagging"""
+        with self._lock:
+            start = self._index
+            self._index = (self._index + 1) % len(self.engines)
+        for i in range(len(self.engines)):
+            engine = self.engines[(start + i) % len(self.engines)]
+            if self.is_available(engine):
+                return engine
+
+
+def _is_read_query(clause):
+    # SELECT ... FOR UPDATE takes locks which only exist on the primary
+    return isinstance(clause, (Select, CompoundSelect)) and getattr(clause, '_for_update_arg', None) is None
+
+
+class RoutingSession(SignallingSession):
+    """Session sending SELECT queries to a replica inside read_only(). The replica is chosen
+    once per session transaction. Writes, SELECT ... FOR UPDATE and queries executed inside
+    transaction() or after the session has flushed changes use the primary.
+    """
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if _read_only_ctx.top and _is_read_query(clause):
+            engine = self._get_replica_engine(mapper)
+            if engine is not None:
+                return engine
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def _get_replica_engine(self, mapper):
+        from .transactions import is_transaction # the session class is created before transactions is imported
+        replicas = self.app.extensions.get('frasco_replicas')
+        if replicas is None or is_transaction() or self.info.get('frasco_has_written') or not self._is_clean():
+            return None
+        if mapper is not None and getattr(mapper.persist_selectable, 'info', {}).get('bind_key') is not None:
+            return None
+        if 'frasco_replica' not in self.info:
+            self.info['frasco_replica'] = replicas.next_engine()
+        return self.info['frasco_replica']
+
+    def _is_clean(self):
+        return not (self.new or self.dirty or self.deleted)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def on_after_flush(session, flush_context):
+    # reads following a write in the same session use the primary
+    session.info['frasco_has_written'] = True
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def on_do_orm_execute(orm_execute_state):
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info['frasco_has_written'] = True
+
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def on_after_transaction_end(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('frasco_replica', None)
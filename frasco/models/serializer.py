@@ -1,9 +1,19 @@
 import logging
 import sqlalchemy
 import datetime
+import decimal
+import uuid
+import gzip
+import json
+import os
+import itertools
+import pickle
+import sqlite3
+import tempfile
 from collections import OrderedDict
+from sqlalchemy.orm import selectinload
 from .ext import db
-from .utils import model_obj_to_dict, extract_model_attr_to_col_mapping
+from .utils import model_obj_to_dict, extract_model_attr_to_col_mapping, get_model_codec, get_table_codec
 
 
 logger = logging.getLogger('frasco.models.serializer')
@@ -64,6 +74,119 @@ class DatabaseDictSerializer(object):
 
         return data
 
+    def dump_stream(self, objs, sink, ignore_tables=None, follow_rels=True, batch_size=500, tmp_dir=None):
+        """Same as dump() but rows are written to sink (eg: a JSONLinesSink) as they are loaded.
+        objs can be a query, a list or a single object. Objects are loaded level by level,
+        batch_size at a time, with their followed relationships eager loaded using IN queries
+        and in a separate session which is cleared after each batch.
+        Each row is only exported once. The ids waiting to be exported and the ids already exported
+        are kept in a temporary sqlite database (in tmp_dir) so that memory usage does not grow
+        with the size of the export.
+        """
+        ignore_tables = ignore_tables or []
+        frontier = DumpStreamFrontier(tmp_dir)
+
+        def enqueue(cls, spec, idents):
+            if cls.__table__.name not in ignore_tables:
+                frontier.add(cls, spec, idents)
+
+        try:
+            if isinstance(objs, sqlalchemy.orm.Query):
+                cls = objs.column_descriptions[0]['entity']
+                pk = sqlalchemy.inspect(cls).primary_key
+                # root ids are streamed so that they are never all loaded in memory
+                for rows in _iter_batches(objs.with_entities(*pk).order_by(None).yield_per(batch_size), batch_size):
+                    enqueue(cls, follow_rels, [tuple(row) for row in rows])
+            else:
+                if not isinstance(objs, (list, tuple)):
+                    objs = [objs]
+                for obj in objs:
+                    if obj is not None:
+                        enqueue(obj.__class__, follow_rels, [sqlalchemy.inspect(obj).identity])
+
+            session = db.session.session_factory()
+            try:
+                while True:
+                    batch = frontier.pop(batch_size)
+                    if not batch:
+                        break
+                    cls, spec, idents = batch
+                    self._dump_stream_batch(session, cls, spec, idents, sink, ignore_tables, frontier, enqueue)
+                    session.expunge_all()
+            finally:
+                session.close()
+        finally:
+            frontier.close()
+        sink.flush()
+        return sink
+
+    def _get_follow_rels(self, cls, follow_rels):
+        if not follow_rels:
+            return []
+        if isinstance(follow_rels, dict):
+            return follow_rels.get(cls.__name__, [])
+        if isinstance(follow_rels, (list, tuple)):
+            return follow_rels
+        return getattr(cls, '__export_follow_rels__', [])
+
+    def _dump_stream_batch(self, session, cls, follow_rels, idents, sink, ignore_tables, frontier, enqueue):
+        mapper = sqlalchemy.inspect(cls)
+        rels = []
+        for relattr in self._get_follow_rels(cls, follow_rels):
+            rel_follow_rels = follow_rels if isinstance(follow_rels, dict) else True
+            if isinstance(relattr, tuple):
+                relattr, rel_follow_rels = relattr
+            rels.append((relattr, getattr(mapper.relationships, relattr, None), rel_follow_rels))
+
+        q = session.query(cls).options(*[selectinload(getattr(cls, relattr)) for relattr, attr, _ in rels
+            if attr is not None and attr.secondary is None and attr.target.name not in ignore_tables])
+        if len(mapper.primary_key) == 1:
+            q = q.filter(mapper.primary_key[0].in_([ident[0] for ident in idents]))
+        else:
+            q = q.filter(sqlalchemy.tuple_(*mapper.primary_key).in_(idents))
+
+        objs = q.all()
+        value_serializer = None if self._dump_value.__func__ is DatabaseDictSerializer._dump_value else self._dump_value
+        identities = dict((obj, sqlalchemy.inspect(obj).identity) for obj in objs)
+        new_identities = set(frontier.mark_exported(cls.__table__.name, identities.values()))
+        for obj in objs:
+            if identities[obj] not in new_identities:
+                continue
+            if not hasattr(obj, '__export_to_dict__'):
+                sink.write(obj.__table__.name, get_model_codec(obj.__class__).dump(obj, value_serializer))
+                continue
+            extra = {}
+            row = obj.__export_to_dict__(extra)
+            if row:
+                sink.write(obj.__table__.name, row)
+            for table, rows in extra.items():
+                for extra_row in rows:
+                    sink.write(table, extra_row)
+
+        for relattr, attr, rel_follow_rels in rels:
+            if attr is not None and attr.secondary is not None:
+                # association rows of the whole batch are loaded with a single query
+                local_col, remote_col = attr.synchronize_pairs[0]
+                values = [getattr(obj, local_col.name) for obj in objs]
+                rows = OrderedDict()
+                for r in session.query(attr.secondary).filter(remote_col.in_(values)):
+                    row = {c.name: str(getattr(r, c.name)) for c in attr.secondary.columns}
+                    rows[tuple(row.values())] = row
+                # objects can be exported again with another follow rels spec, their association rows must not
+                for key in frontier.mark_exported(attr.secondary.name, rows.keys()):
+                    sink.write(attr.secondary.name, rows[key])
+                continue
+            if attr is not None and attr.target.name in ignore_tables:
+                continue
+            children = {}
+            for obj in objs:
+                value = getattr(obj, relattr)
+                for child in (value if (attr.uselist if attr is not None else True) else [value]) or []:
+                    if child is not None:
+                        children.setdefault(child.__class__, []).append(sqlalchemy.inspect(child).identity)
+            for child_cls, child_idents in children.items():
+                enqueue(child_cls, rel_follow_rels, child_idents)
+
     def dump_many(self, objs, data=None, **kwargs):
         kwargs['many'] = True
         return self.dump(objs, data, **kwargs)
@@ -75,10 +198,24 @@ class DatabaseDictSerializer(object):
     def _dump_value(self, value):
         return value
 
-    def load(self, data, idmap=None):
+    def load(self, data, idmap=None, bulk=False, batch_size=1000):
+        """Inserts rows exported with dump() and returns the idmap (table -> old id -> new id).
+        With bulk=True, unique conflicts are resolved with one query per column, rows are inserted
+        with multi-row INSERT ... RETURNING and foreign keys of inserted rows are remapped with
+        UPDATE ... FROM (VALUES ...), batch_size rows at a time (on PostgreSQL, other databases use
+        executemany()). Subclasses overriding _process_data() or _insert_raw() always use the
+        row by row path.
+        """
         idmap = idmap or {}
         pre_insert_tables, tables_need_remap = self._get_tables_need_remap(data)
 
+        if bulk and not self._overrides_row_hooks():
+            for table in pre_insert_tables:
+                self._bulk_insert_without_fks(table, data.get(table.name, []), idmap, batch_size)
+            for table in tables_need_remap:
+                self._bulk_remap(table, data.get(table.name, []), idmap, batch_size)
+            return idmap
+
         for table in pre_insert_tables:
             for row in data.get(table.name, []):
                 self._insert_without_fks(table, row, idmap)
@@ -108,12 +245,13 @@ class DatabaseDictSerializer(object):
         return db.Model.metadata.tables[name]
 
     def _get_foreign_cols(self, table):
-        return [col.name for col in [col for col in table.c if col.foreign_keys]]
+        return get_table_codec(table).foreign_cols
 
     def _validate_data(self, table, data):
-        data = {k: v for k, v in data.items() if k in table.c}
+        codec = get_table_codec(table)
+        data = {k: v for k, v in data.items() if k in codec.column_names}
         for col, value in data.items():
-            if value is None and not table.c[col].nullable:
+            if value is None and col in codec.not_nullable_cols:
                 logger.debug("%s: %s can't be null (%s)" % (table.name, col, data))
                 return
         return data
@@ -125,7 +263,7 @@ class DatabaseDictSerializer(object):
         return self._ensure_data_has_no_unique_conflict(table, data)
 
     def _ensure_data_has_no_unique_conflict(self, table, data):
-        for col in [c for c in table.c if c.unique]:
+        for col in get_table_codec(table).unique_columns:
             if not data.get(col.name):
                 continue
             value = data[col.name]
@@ -169,12 +307,7 @@ class DatabaseDictSerializer(object):
             data = self._process_data(table, row, idmap,
                 {k: v for k, v in row.items() if k != 'id' and k not in fks})
 
-        for col in fks:
-            if col not in row or not row[col]:
-                continue
-            target = list(table.c[col].foreign_keys)[0].column.table
-            data[col] = self._mapid(idmap, target.name, int(row[col]))
-
+        data = self._map_fks(table, fks, row, data, idmap)
         data = self._remap_data(table, row, data, idmap)
         data = self._validate_data(table, data)
         if not data:
@@ -192,10 +325,281 @@ class DatabaseDictSerializer(object):
                 logger.debug('remap_insert(%s, %s)' % (table.name, data))
                 db.session.execute(table.insert(), data)
 
+    def _map_fks(self, table, fks, row, data, idmap):
+        for col in fks:
+            if col not in row or not row[col]:
+                continue
+            target = list(table.c[col].foreign_keys)[0].column.table
+            data[col] = self._mapid(idmap, target.name, int(row[col]))
+        return data
+
     def _remap_data(self, table, row, data, idmap):
         return data
 
+    def _overrides_row_hooks(self):
+        # the bulk path does not go through the row by row hooks
+        return any(getattr(type(self), name) is not getattr(DatabaseDictSerializer, name)
+                   for name in ('_process_data', '_ensure_data_has_no_unique_conflict', '_insert_raw'))
+
+    def _use_bulk_sql(self, table):
+        return db.get_engine(bind=table.info.get('bind_key')).dialect.name == 'postgresql'
+
+    def _ensure_rows_have_no_unique_conflict(self, table, datas, batch_size=1000):
+        """Same as _ensure_data_has_no_unique_conflict() for a list of rows. Existing values
+        are fetched with one IN query per column (and per round of renamed values).
+        """
+        for col in get_table_codec(table).unique_columns:
+            pending = [(data, data[col.name], 1) for data in datas if data.get(col.name)]
+            taken = set()
+            used = set()
+            while pending:
+                taken.update(self._get_existing_values(col, set(data[col.name] for data, _, _ in pending), batch_size))
+                conflicts = []
+                for data, value, c in pending:
+                    if data[col.name] in taken or data[col.name] in used:
+                        data[col.name] = "%s-%s" % (value, c)
+                        conflicts.append((data, value, c + 1))
+                    else:
+                        used.add(data[col.name])
+                pending = conflicts
+        return datas
+
+    def _get_existing_values(self, col, values, batch_size=1000):
+        existing = set()
+        for batch in _iter_batches(list(values), batch_size):
+            existing.update(v for v, in db.session.query(col).filter(col.in_(batch)))
+        return existing
+
+    def _bulk_insert_raw(self, table, items, idmap, batch_size=1000):
+        """Inserts (oldid, data) items and records their new ids in idmap"""
+        if not items:
+            return
+        table_idmap = idmap.setdefault(table.name, {})
+        if not self._use_bulk_sql(table):
+            for oldid, data in items:
+                table_idmap[int(oldid)] = int(db.session.execute(table.insert(), data).inserted_primary_key[0])
+            return
+        for _, group in _group_by_keys(items, lambda item: item[1]):
+            for batch in _iter_batches(group, batch_size):
+                # RETURNING does not guarantee any order, new ids are mapped back using a unique column
+                key_col = self._get_bulk_insert_key_col(table, [data for _, data in batch])
+                if key_col is None:
+                    for oldid, data in batch:
+                        self._insert_raw(table, oldid, data, idmap)
+                    logger.debug('insert(%s, %s rows, no unique column)' % (table.name, len(batch)))
+                    continue
+                oldids = {data[key_col.name]: oldid for oldid, data in batch}
+                stmt = table.insert().values([data for _, data in batch]).returning(table.c.id, key_col)
+                for newid, key in db.session.execute(stmt):
+                    table_idmap[int(oldids[key])] = int(newid)
+                logger.debug('bulk_insert(%s, %s rows)' % (table.name, len(batch)))
+
+    def _get_bulk_insert_key_col(self, table, datas):
+        """Returns a unique column with a distinct value in each row or None"""
+        for col in get_table_codec(table).unique_columns:
+            values = set(data.get(col.name) for data in datas)
+            if None not in values and len(values) == len(datas):
+                return col
+
+    def _bulk_update(self, table, items, batch_size=1000):
+        """Updates rows from (id, data) items"""
+        for keys, group in _group_by_keys(items, lambda item: item[1]):
+            for batch in _iter_batches(group, batch_size):
+                if self._use_bulk_sql(table):
+                    values = sqlalchemy.values(*[sqlalchemy.column(k, table.c[k].type) for k in ('id',) + keys],
+                        name='remap_values').data([(id,) + tuple(data[k] for k in keys) for id, data in batch])
+                    db.session.execute(table.update()
+                        .values({k: sqlalchemy.cast(values.c[k], table.c[k].type) for k in keys})
+                        .where(table.c.id == values.c.id))
+                else:
+                    db.session.execute(table.update().where(table.c.id == sqlalchemy.bindparam('_id')),
+                        [dict(data, _id=id) for id, data in batch])
+                logger.debug('bulk_update(%s, %s rows)' % (table.name, len(batch)))
+
+    def _bulk_insert_without_fks(self, table, rows, idmap, batch_size=1000):
+        fks = self._get_foreign_cols(table)
+        inserted = idmap.get(table.name, {})
+        rows = [row for row in rows if 'id' in row and int(row['id']) not in inserted]
+        datas = self._ensure_rows_have_no_unique_conflict(table,
+            [{k: v for k, v in row.items() if k != 'id' and k not in fks} for row in rows], batch_size)
+        items = []
+        for row, data in zip(rows, datas):
+            data = self._validate_data(table, data)
+            if data:
+                items.append((row['id'], data))
+        self._bulk_insert_raw(table, items, idmap, batch_size)
+
+    def _bulk_remap(self, table, rows, idmap, batch_size=1000):
+        fks = self._get_foreign_cols(table)
+        inserted = idmap.get(table.name, {})
+        existing_rows = [row for row in rows if 'id' in row and int(row['id']) in inserted]
+        new_rows = [row for row in rows if 'id' not in row or int(row['id']) not in inserted]
+
+        if new_rows and 'id' in table.c and any(list(table.c[col].foreign_keys)[0].column.table is table for col in fks):
+            # new rows can reference rows of the same table inserted before them
+            for row in new_rows:
+                self.remap(table, row, idmap)
+            new_rows = []
+
+        if fks:
+            updates = []
+            for row in existing_rows:
+                data = self._map_fks(table, fks, row, {}, idmap)
+                data = self._validate_data(table, self._remap_data(table, row, data, idmap))
+                if data:
+                    updates.append((inserted[int(row['id'])], data))
+            self._bulk_update(table, updates, batch_size)
+
+        datas = self._ensure_rows_have_no_unique_conflict(table,
+            [{k: v for k, v in row.items() if k != 'id' and k not in fks} for row in new_rows], batch_size)
+        items = []
+        items_without_id = []
+        for row, data in zip(new_rows, datas):
+            data = self._map_fks(table, fks, row, data, idmap)
+            data = self._validate_data(table, self._remap_data(table, row, data, idmap))
+            if not data:
+                continue
+            if 'id' in row:
+                items.append((row['id'], data))
+            else:
+                items_without_id.append(data)
+        self._bulk_insert_raw(table, items, idmap, batch_size)
+        for _, group in _group_by_keys(items_without_id):
+            for batch in _iter_batches(group, batch_size):
+                db.session.execute(table.insert(), batch)
+
     def _mapid(self, idmap, tablename, id, keep_existing=None):
         if keep_existing is None:
             keep_existing = self.keep_existing_fks
         return idmap.get(tablename, {}).get(id, id if keep_existing else None)
+
+
+def _iter_batches(items, size):
+    it = iter(items)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _group_by_keys(items, get_data=None):
+    """Groups rows by the set of columns they contain (multi-row statements need the same columns)"""
+    groups = OrderedDict()
+    for item in items:
+        groups.setdefault(tuple(sorted((get_data(item) if get_data else item).keys())), []).append(item)
+    return groups.items()
+
+
+class DumpStreamFrontier(object):
+    """Ids to export and already exported ids of DatabaseDictSerializer.dump_stream(), stored in
+    a temporary sqlite database. Ids are exported in the order they were added, grouped by class
+    and follow rels spec.
+    """
+    def __init__(self, tmp_dir=None):
+        fd, self.filename = tempfile.mkstemp(suffix='.sqlite', prefix='frasco-dump-', dir=tmp_dir)
+        os.close(fd)
+        self.conn = sqlite3.connect(self.filename)
+        self.conn.executescript("""
+            PRAGMA journal_mode = OFF;
+            PRAGMA synchronous = OFF;
+            CREATE TABLE queue (seq INTEGER PRIMARY KEY, spec INTEGER, ident BLOB, done INTEGER DEFAULT 0,
+                                UNIQUE (spec, ident));
+            CREATE INDEX queue_pending ON queue (done, seq);
+            CREATE INDEX queue_pending_spec ON queue (done, spec, seq);
+            CREATE TABLE exported (tbl TEXT, ident BLOB, PRIMARY KEY (tbl, ident)) WITHOUT ROWID;
+        """)
+        self.specs = [] # (class, follow rels spec), the spec column is an index in this list
+        self._spec_ids = {}
+
+    def _get_spec_id(self, cls, spec):
+        key = (cls, spec if isinstance(spec, bool) else id(spec))
+        if key not in self._spec_ids:
+            self._spec_ids[key] = len(self.specs)
+            self.specs.append((cls, spec))
+        return self._spec_ids[key]
+
+    def add(self, cls, spec, idents):
+        """Queues ids which were never queued for this class and spec"""
+        spec_id = self._get_spec_id(cls, spec)
+        self.conn.executemany("INSERT OR IGNORE INTO queue (spec, ident) VALUES (?, ?)",
+            ((spec_id, pickle.dumps(tuple(ident), 4)) for ident in idents))
+
+    def pop(self, size):
+        """Returns (class, spec, ids) for the next size ids of the oldest pending class or None"""
+        row = self.conn.execute("SELECT spec FROM queue WHERE done = 0 ORDER BY seq LIMIT 1").fetchone()
+        if row is None:
+            return None
+        rows = self.conn.execute("SELECT seq, ident FROM queue WHERE done = 0 AND spec = ? ORDER BY seq LIMIT ?",
+            (row[0], size)).fetchall()
+        self.conn.executemany("UPDATE queue SET done = 1 WHERE seq = ?", ((seq,) for seq, _ in rows))
+        cls, spec = self.specs[row[0]]
+        return cls, spec, [pickle.loads(ident) for _, ident in rows]
+
+    def mark_exported(self, table, idents):
+        """Marks rows as exported and returns the ids of the ones which were not already exported"""
+        keys = OrderedDict((pickle.dumps(tuple(ident), 4), ident) for ident in idents)
+        for batch in _iter_batches(list(keys), 500):
+            for key, in self.conn.execute("SELECT ident FROM exported WHERE tbl = ? AND ident IN (%s)"
+                                          % ', '.join('?' * len(batch)), [table] + batch):
+                keys.pop(key)
+        self.conn.executemany("INSERT INTO exported (tbl, ident) VALUES (?, ?)", ((table, key) for key in keys))
+        return list(keys.values())
+
+    def close(self):
+        self.conn.close()
+        os.unlink(self.filename)
+
+
+class DictSink(object):
+    """Collects exported rows in a dict like the one returned by DatabaseDictSerializer.dump()"""
+    def __init__(self, data=None):
+        self.data = {} if data is None else data
+
+    def write(self, table, row):
+        self.data.setdefault(table, []).append(row)
+
+    def flush(self):
+        pass
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    raise TypeError("%r is not JSON serializable" % value)
+
+
+class JSONLinesSink(object):
+    """Writes the rows of each table as JSON lines in a gzip file (<directory>/<table>.jsonl.gz)"""
+    def __init__(self, directory, compresslevel=6):
+        self.directory = directory
+        self.compresslevel = compresslevel
+        self.files = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, table, row):
+        f = self.files.get(table)
+        if f is None:
+            f = self.files[table] = gzip.open(os.path.join(self.directory, '%s.jsonl.gz' % table),
+                'wt', encoding='utf-8', compresslevel=self.compresslevel)
+        f.write(json.dumps(row, default=_json_default))
+        f.write('\n')
+
+    def flush(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+    @classmethod
+    def read(cls, directory):
+        """Returns a dict of the exported rows, as accepted by DatabaseDictSerializer.load()"""
+        data = {}
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith('.jsonl.gz'):
+                with gzip.open(os.path.join(directory, filename), 'rt', encoding='utf-8') as f:
+                    data[filename[:-len('.jsonl.gz')]] = [json.loads(line) for line in f]
+        return data
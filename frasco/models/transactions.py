@@ -1,22 +1,104 @@
-from flask import after_this_request, _request_ctx_stack
+from flask import after_this_request, _request_ctx_stack, current_app, has_request_context, copy_current_request_context
 from flask_sqlalchemy import SignallingSession
 from frasco.ctx import ContextStack, DelayedCallsContext
 from frasco.utils import AttrDict
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
 from sqlalchemy import event
 import functools
+import threading
+import os
+import sys
 from .ext import db
 import logging
 
 
-__all__ = ('transaction', 'as_transaction', 'current_transaction', 'is_transaction', 'delayed_tx_calls', 'after_transaction_commit')
+__all__ = ('transaction', 'as_transaction', 'current_transaction', 'is_transaction', 'delayed_tx_calls', 'after_transaction_commit',
+           'DelayedCallsExecutor', 'flush_delayed_tx_calls')
 
 
-_transaction_ctx = ContextStack(default_item=True)
-delayed_tx_calls = DelayedCallsContext()
 logger = logging.getLogger('frasco.models')
 
 
+class DelayedCallsExecutor(object):
+    """Runs the background delayed calls of requests (enqueuing tasks, push events, emails) after commit
+    in a bounded thread pool (one per process), within a copy of the request context.
+    When max_pending runs are already waiting, the request blocks up to submit_timeout seconds
+    and then runs the calls itself. Errors are logged.
+    """
+    def __init__(self, workers=4, max_pending=100, submit_timeout=5):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.submit_timeout = submit_timeout
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._executor is None or self._pid != os.getpid():
+            # threads are not inherited by forked processes
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='frasco-delayed-calls')
+            self._slots = threading.BoundedSemaphore(self.max_pending)
+            self._pending = set()
+            self._pid = os.getpid()
+        return self._executor
+
+    def submit(self, run):
+        executor = self._get_executor()
+        if not self._slots.acquire(timeout=self.submit_timeout):
+            logger.warning('Too many pending delayed calls, running them in the request')
+            run()
+            return
+
+        @copy_current_request_context
+        def run_in_request_ctx():
+            try:
+                run()
+            except Exception:
+                current_app.log_exception(sys.exc_info())
+
+        try:
+            future = executor.submit(run_in_request_ctx)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._on_done)
+
+    def _on_done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+        self._slots.release()
+
+    def flush(self, timeout=None):
+        """Waits for the pending calls to complete"""
+        if self._executor is None:
+            return
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending, timeout)
+
+
+def _dispatch_delayed_tx_calls(run):
+    executor = current_app.extensions.get('frasco_delayed_tx_calls') if has_request_context() else None
+    if executor is None:
+        run()
+    else:
+        executor.submit(run)
+
+
+def flush_delayed_tx_calls(timeout=None):
+    """Waits for the delayed calls running in the background to complete (useful in tests)"""
+    executor = current_app.extensions.get('frasco_delayed_tx_calls')
+    if executor is not None:
+        executor.flush(timeout)
+
+
+_transaction_ctx = ContextStack(default_item=True)
+delayed_tx_calls = DelayedCallsContext(dispatcher=_dispatch_delayed_tx_calls)
+
+
 @contextmanager
 def transaction():
     if not _transaction_ctx.top:
@@ -53,8 +135,9 @@ def as_transaction(func):
     return wrapper
 
 
-def after_transaction_commit(func):
-    delayed_tx_calls.call(func, [], {})
+def after_transaction_commit(func, dedupe=False):
+    """Calls func after the current transaction is committed (only once per transaction if dedupe is True)"""
+    delayed_tx_calls.call(func, [], {}, dedupe_key=dedupe or None)
 
 
 _current_transaction_ctx = ContextStack()
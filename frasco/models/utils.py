@@ -1,14 +1,25 @@
 from flask import current_app, abort
-from frasco.utils import unknown_value
+from frasco.ext import has_extension
+from frasco.utils import unknown_value, encode_cursor, decode_cursor, import_string
 from sqlalchemy.ext.mutable import Mutable
+from sqlalchemy.sql import operators
 from flask_sqlalchemy import Pagination
 import uuid
+import datetime
+import decimal
 import functools
+import operator
 import sqlalchemy
 from .ext import db
 
 
 def move_obj_position_in_collection(obj, new_position, position_attr='position', scope=None, data=None, current_position=unknown_value):
+    """Moves obj to new_position, shifting the positions of the rows in between (updated with data).
+    Models declaring __position_gap__ use sparse positions instead: new_position is then the index of obj
+    in the collection (starting at 0) and only obj is written (see move_obj_to_gap_position_in_collection()).
+    """
+    if getattr(obj.__class__, '__position_gap__', None):
+        return move_obj_to_gap_position_in_collection(obj, new_position, position_attr, scope, data)
     if not data:
         data = {}
     if current_position is unknown_value:
@@ -36,6 +47,184 @@ def compute_move_obj_position_in_collection_bounds(current_position, new_positio
     return shift, lower_idx, upper_idx
 
 
+def move_obj_to_gap_position_in_collection(obj, new_position, position_attr='position', scope=None, data=None):
+    """Gives obj a position between the ones of its new neighbours so that no other row is written.
+    Rows are spaced by the __position_gap__ of the model. Once a gap is down to 1, the scope is renumbered
+    by a background task when frasco_tasks is enabled (or during the next move which finds no room left).
+    """
+    model = obj.__class__
+    position_col = getattr(model, position_attr)
+    before, after = _get_gap_position_neighbours(obj, new_position, position_col, scope)
+    position = _compute_gap_position(model, position_col, before, after)
+    if position is None:
+        rebalance_obj_positions_in_collection(model, position_attr, scope, data, exclude=obj)
+        before, after = _get_gap_position_neighbours(obj, new_position, position_col, scope)
+        position = _compute_gap_position(model, position_col, before, after)
+    setattr(obj, position_attr, position)
+    if (before is not None and position - before <= 1) or (after is not None and after - position <= 1):
+        _enqueue_positions_rebalance(model, position_attr, scope)
+
+
+def _get_gap_position_neighbours(obj, new_position, position_col, scope):
+    q = obj.__class__.query.with_entities(position_col).filter(position_col != None)
+    if scope:
+        q = q.filter_by(**scope)
+    identity = sqlalchemy.inspect(obj).identity
+    if identity:
+        pk = sqlalchemy.inspect(obj.__class__).primary_key
+        q = q.filter(sqlalchemy.not_(sqlalchemy.and_(*[col == value for col, value in zip(pk, identity)])))
+    q = q.order_by(position_col)
+    if new_position <= 0:
+        row = q.first()
+        return None, row[0] if row else None
+    rows = q.offset(new_position - 1).limit(2).all()
+    if not rows:
+        # past the end of the collection
+        return q.with_entities(sqlalchemy.func.max(position_col)).scalar(), None
+    return rows[0][0], rows[1][0] if len(rows) > 1 else None
+
+
+def _compute_gap_position(model, position_col, before, after):
+    gap = model.__position_gap__
+    if before is None and after is None:
+        return gap
+    if before is None:
+        return after - gap
+    if after is None:
+        return before + gap
+    if isinstance(position_col.type, sqlalchemy.Integer):
+        position = (before + after) // 2
+    else:
+        position = (before + after) / 2
+    if position == before or position == after:
+        return None
+    return position
+
+
+def rebalance_obj_positions_in_collection(model, position_attr='position', scope=None, data=None, exclude=None, batch_size=1000):
+    """Renumbers the positions of a collection using the __position_gap__ of the model, keeping their order"""
+    gap = model.__position_gap__
+    position_col = getattr(model, position_attr)
+    pk = sqlalchemy.inspect(model).primary_key
+    q = model.query.with_entities(*pk).filter(position_col != None)
+    if scope:
+        q = q.filter_by(**scope)
+    if exclude is not None and sqlalchemy.inspect(exclude).identity:
+        q = q.filter(sqlalchemy.not_(sqlalchemy.and_(*[col == value for col, value in zip(pk, sqlalchemy.inspect(exclude).identity)])))
+    mappings = [dict(zip([col.key for col in pk], row), **dict(data or {}, **{position_attr: (i + 1) * gap}))
+                for i, row in enumerate(q.order_by(position_col, *pk))]
+    for i in range(0, len(mappings), batch_size):
+        db.session.bulk_update_mappings(model, mappings[i:i + batch_size])
+    # objects already loaded in the session must not keep their old position
+    for obj in list(db.session.identity_map.values()):
+        if isinstance(obj, model) and obj is not exclude:
+            db.session.expire(obj, [position_attr])
+
+
+def _rebalance_positions_task(model_name, position_attr, scope):
+    from .transactions import transaction
+    with transaction():
+        rebalance_obj_positions_in_collection(import_string(model_name), position_attr, scope)
+
+
+def _enqueue_positions_rebalance(model, position_attr, scope):
+    if not has_extension('frasco_tasks'):
+        return
+    from frasco.tasks import enqueue_task # frasco.tasks imports frasco.models
+    # model classes cannot be task arguments (pack_job_args() would call their unbound __taskdump__())
+    enqueue_task(_rebalance_positions_task, '%s.%s' % (model.__module__, model.__name__), position_attr, scope)
+
+
+class KeysetPage(object):
+    """A page of items returned by keyset_paginate(), iterating over the items"""
+    def __init__(self, items, next_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def _keyset_column(column):
+    if getattr(column, 'modifier', None) in (operators.desc_op, operators.asc_op):
+        return column.element, column.modifier is operators.desc_op
+    return column, False
+
+
+# conversions accepted for the values of a cursor, other values must be instances of the python type of the column
+_keyset_value_coercers = {float: lambda v: float(v) if isinstance(v, int) else v,
+                          decimal.Decimal: lambda v: decimal.Decimal(v) if isinstance(v, (int, str)) else v,
+                          uuid.UUID: lambda v: uuid.UUID(v) if isinstance(v, str) else v}
+
+
+def coerce_keyset_cursor(columns, values):
+    """Checks that decoded cursor values match the columns of keyset_paginate(), converting
+    them to the python type of each column when possible. Raises a ValueError otherwise.
+    """
+    columns = [_keyset_column(c)[0] for c in columns]
+    if not isinstance(values, (list, tuple)) or len(values) != len(columns):
+        raise ValueError("Invalid cursor")
+    coerced = []
+    for col, value in zip(columns, values):
+        if value is not None:
+            try:
+                python_type = col.type.python_type
+            except NotImplementedError:
+                python_type = None
+            if python_type:
+                try:
+                    value = _keyset_value_coercers.get(python_type, lambda v: v)(value)
+                except (ValueError, TypeError, ArithmeticError):
+                    raise ValueError("Invalid cursor value")
+                # bool is an int and datetime a date, they are not accepted in place of one another
+                if not isinstance(value, python_type) or isinstance(value, bool) != (python_type is bool) \
+                  or isinstance(value, datetime.datetime) != issubclass(python_type, datetime.datetime):
+                    raise ValueError("Invalid cursor value")
+        coerced.append(value)
+    return coerced
+
+
+def keyset_paginate(query, columns, cursor=None, per_page=20):
+    """Paginates a query using the values of the last item instead of an offset so that
+    fetching a page has the same cost at any depth (given an index on the columns).
+    columns must uniquely order the rows (eg: end with the primary key), use .desc() for descending order.
+    cursor is the next_cursor of the previous page (as a string or decoded with the keyset_cursor
+    request param type). Invalid cursors abort with a 400. Returns a KeysetPage.
+    """
+    if cursor:
+        try:
+            values = coerce_keyset_cursor(columns, decode_cursor(cursor) if isinstance(cursor, str) else cursor)
+        except ValueError:
+            abort(400, "invalid cursor")
+    columns = [_keyset_column(c) for c in columns]
+    if cursor:
+        if len(set(desc for _, desc in columns)) == 1:
+            row = sqlalchemy.tuple_(*[col for col, _ in columns])
+            values_row = sqlalchemy.tuple_(*values)
+            query = query.filter(row < values_row if columns[0][1] else row > values_row)
+        else:
+            # (a > va) OR (a = va AND b > vb) ...
+            clauses = []
+            for i, (col, desc) in enumerate(columns):
+                clauses.append(sqlalchemy.and_(*([c == v for (c, _), v in zip(columns[:i], values[:i])]
+                    + [col < values[i] if desc else col > values[i]])))
+            query = query.filter(sqlalchemy.or_(*clauses))
+    query = query.order_by(*[col.desc() if desc else col.asc() for col, desc in columns])
+    items = query.limit(per_page + 1).all()
+    next_cursor = None
+    if len(items) > per_page:
+        items = items[:per_page]
+        next_cursor = encode_cursor([getattr(items[-1], col.key) for col, _ in columns])
+    return KeysetPage(items, next_cursor)
+
+
 def ensure_unique_value(model, column, value, fallback=None, counter_start=1):
     if not fallback:
         fallback = value + "-%(counter)s"
@@ -94,6 +283,11 @@ def model_loader(model, nullable=False, *options, **options_kwargs):
             if not nullable:
                 abort(404)
             return None
+        if not options and not options_kwargs and hasattr(model, 'get_cached'):
+            obj = model.get_cached(id)
+            if obj is None:
+                abort(404)
+            return obj
         q = model.query
         for opt in options:
             q = q.options(opt)
@@ -117,11 +311,81 @@ def extract_model_attr_to_col_mapping(model):
     return mapping
 
 
+class TableCodec(object):
+    """Column metadata of a table computed once"""
+    def __init__(self, table):
+        self.table = table
+        self.column_names = frozenset(c.name for c in table.c)
+        self.foreign_cols = tuple(c.name for c in table.c if c.foreign_keys)
+        self.unique_columns = tuple(c for c in table.c if c.unique)
+        self.not_nullable_cols = frozenset(c.name for c in table.c if not c.nullable)
+
+
+class ModelCodec(TableCodec):
+    """Dumps objects of a mapped class to dicts keyed by column names using a precompiled
+    attribute getter. Instances can be used as marshallers.
+    """
+    def __init__(self, model):
+        super(ModelCodec, self).__init__(model.__table__)
+        self.model = model
+        mapping = extract_model_attr_to_col_mapping(model)
+        self.attrs = tuple(mapping.keys())
+        self.columns = tuple(mapping.values())
+        if len(self.attrs) == 1:
+            attr_getter = operator.attrgetter(self.attrs[0])
+            item_getter = operator.itemgetter(self.attrs[0])
+            self.attr_getter = lambda obj: (attr_getter(obj),)
+            self.item_getter = lambda d: (item_getter(d),)
+        else:
+            self.attr_getter = operator.attrgetter(*self.attrs)
+            self.item_getter = operator.itemgetter(*self.attrs)
+
+    def getter(self, obj):
+        try:
+            # loaded values are read directly from the instance dict
+            return self.item_getter(obj.__dict__)
+        except KeyError:
+            # some attributes are deferred or expired and need to be loaded
+            return self.attr_getter(obj)
+
+    def dump(self, obj, value_serializer=None):
+        if value_serializer is None:
+            return dict(zip(self.columns, self.getter(obj)))
+        return dict(zip(self.columns, map(value_serializer, self.getter(obj))))
+
+    def dump_many(self, objs, value_serializer=None):
+        columns = self.columns
+        getter = self.getter
+        if value_serializer is None:
+            return [dict(zip(columns, getter(obj))) for obj in objs]
+        return [dict(zip(columns, map(value_serializer, getter(obj)))) for obj in objs]
+
+    def __call__(self, obj):
+        return self.dump(obj)
+
+
+_model_codecs = {}
+_table_codecs = {}
+
+
+def get_model_codec(model):
+    """Returns the cached ModelCodec of a mapped class"""
+    codec = _model_codecs.get(model)
+    if codec is None:
+        codec = _model_codecs[model] = ModelCodec(model)
+    return codec
+
+
+def get_table_codec(table):
+    """Returns the cached TableCodec of a table"""
+    codec = _table_codecs.get(table)
+    if codec is None:
+        codec = _table_codecs[table] = TableCodec(table)
+    return codec
+
+
 def model_obj_to_dict(obj, value_serializer=None):
-    row = {}
-    for attr, col in extract_model_attr_to_col_mapping(obj.__class__).items():
-        row[col] = (value_serializer or (lambda a: a))(getattr(obj, attr))
-    return row
+    return get_model_codec(obj.__class__).dump(obj, value_serializer)
 
 
 def get_model_class(name):
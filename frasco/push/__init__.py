@@ -2,9 +2,10 @@ from flask import g, has_request_context, request, current_app
 from frasco.ext import *
 from frasco.users import is_user_logged_in, current_user
 from frasco.models import delayed_tx_calls
-from frasco.ctx import ContextStack, DelayedCallsContext
+from frasco.ctx import ContextStack, DelayedCallsContext, make_call_key
 from frasco.assets import expose_package
 from itsdangerous import URLSafeTimedSerializer
+import functools
 import hashlib
 import logging
 import subprocess
@@ -32,6 +33,7 @@ class FrascoPush(Extension):
     name = 'frasco_push'
     state_class = FrascoPushState
     defaults = {"redis_url": None,
+                "redis_connection": "push",
                 "server_url": None,
                 "server_port": 8888,
                 "server_secured": False,
@@ -39,7 +41,8 @@ class FrascoPush(Extension):
                 "secret": None,
                 "prefix_event_with_room": True,
                 "default_current_user_loader": True,
-                "testing_ignore_redis_publish": True}
+                "testing_ignore_redis_publish": True,
+                "coalesce_events": False}
 
     def _init_app(self, app, state):
         expose_package(app, "frasco_push", __name__)
@@ -47,8 +50,10 @@ class FrascoPush(Extension):
         if state.options['secret'] is None:
             state.options["secret"] = app.config['SECRET_KEY']
 
+        redis_options = None
         if not state.options['redis_url'] and has_extension('frasco_redis', app):
-            state.options['redis_url'] = app.extensions.frasco_redis.options['url']
+            state.options['redis_url'] = app.extensions.frasco_redis.get_connection_url(state.options['redis_connection'])
+            redis_options = app.extensions.frasco_redis.get_connection_kwargs(state.options['redis_connection'])
 
         state.server_cli = ["python", "-m", "frasco.push.server",
             "--channel", state.options["channel"],
@@ -68,7 +73,8 @@ class FrascoPush(Extension):
                 server_name.split(':')[0], state.options['server_port'])
 
         state.token_serializer = URLSafeTimedSerializer(state.options['secret'])
-        state.redis_manager = socketio.RedisManager(state.options['redis_url'], write_only=True)
+        state.redis_manager = socketio.RedisManager(state.options['redis_url'], write_only=True,
+            redis_options=redis_options)
         state.host_id = uuid.uuid4().hex
 
         @app.cli.command('push-server')
@@ -122,14 +128,19 @@ def create_push_token(user_info=None, user_room=None, allowed_rooms=None):
     return get_extension_state('frasco_push').token_serializer.dumps([user_info, user_room, allowed_rooms])
 
 
-@delayed_push_events.proxy
-@delayed_tx_calls.proxy
-def _emit_push_event(event, data=None, skip_self=None, room=None, namespace=None, prefix_event_with_room=True):
+def _push_event_dedupe_key(*args, **kwargs):
+    # identical events emitted during a transaction are only sent once when coalesce_events is enabled
+    if get_extension_state('frasco_push').options['coalesce_events']:
+        return make_call_key(args, kwargs)
+
+
+def _prepare_push_event(event, data=None, skip_self=None, room=None, namespace=None, prefix_event_with_room=True):
+    # reads the thread local state in the calling thread and returns the function publishing the event
     state = get_extension_state('frasco_push')
     if current_app.testing and testing_push_events.top is not None:
         testing_push_events.top.append((event, data, skip_self, room, namespace))
         if state.options['testing_ignore_redis_publish']:
-            return
+            return None
     if state.options['prefix_event_with_room'] and prefix_event_with_room and room:
         event = "%s:%s" % (room, event)
     if skip_self is None:
@@ -138,7 +149,15 @@ def _emit_push_event(event, data=None, skip_self=None, room=None, namespace=None
     if skip_self and has_request_context() and 'x-socketio-sid' in request.headers:
         skip_sid = request.headers['x-socketio-sid']
     logger.debug("Push event '%s' to {namespace=%s, room=%s, skip_sid=%s}: %s" % (event, namespace, room, skip_sid, data))
-    return state.redis_manager.emit(event, data=data, to=room, skip_sid=skip_sid, namespace=namespace)
+    return functools.partial(state.redis_manager.emit, event, data=data, to=room, skip_sid=skip_sid, namespace=namespace)
+
+
+@delayed_push_events.proxy(dedupe_key=_push_event_dedupe_key)
+@delayed_tx_calls.proxy(dedupe_key=_push_event_dedupe_key, background=_prepare_push_event)
+def _emit_push_event(event, data=None, skip_self=None, room=None, namespace=None, prefix_event_with_room=True):
+    emit = _prepare_push_event(event, data, skip_self, room, namespace, prefix_event_with_room)
+    if emit is not None:
+        return emit()
 
 
 def emit_push_event(event, data=None, skip_self=None, room=None, namespace=None, prefix_event_with_room=True):
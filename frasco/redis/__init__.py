@@ -2,3 +2,12 @@ from .ext import *
 from .attr import *
 from .utils import *
 from .objects import *
+from .local_cache import *
+from .codecs import *
+from .stats import *
+from .tags import *
+from .aio import *
+from .warm import *
+from .breaker import *
+from .sharding import *
+from .chunks import *
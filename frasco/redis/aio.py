@@ -0,0 +1,316 @@
+from flask import current_app, json
+from frasco.utils import unknown_value
+from redis.exceptions import LockError
+from .attr import RedisCachedMethod
+from .local_cache import get_local_cache, async_local_cache_invalidate
+from .codecs import get_codec
+from .stats import get_async_cache_stats
+from .tags import async_tag_cache_key
+from .breaker import guard_async_redis_call
+from .chunks import is_chunk_manifest, async_write_chunked_value, async_read_chunked_value, async_delete_chunked_value
+from .utils import (logger, _make_codec_serializers, _make_function_key_builders, _encode_value, _decode_value,
+                    _pack_protected_value, _unpack_protected_value)
+import asyncio
+import functools
+import inspect
+import random
+import math
+import time
+
+
+__all__ = ('async_redis_get_set', 'async_redis_get_set_as_json', 'async_redis_invalidate_key',
+           'async_redis_cached_function', 'async_redis_cached_function_as_json', 'async_redis_cached_method',
+           'async_redis_cached_method_as_json')
+
+
+def _get_async_redis(redis=None, binary=False):
+    if not redis or isinstance(redis, str):
+        # redis can also be the name of a connection
+        return current_app.extensions.frasco_redis.get_cache_async_connection(redis, binary=binary)
+    return redis
+
+
+async def _call_async_callback(callback, stats=None, name=None):
+    start = time.time()
+    value = callback()
+    if inspect.isawaitable(value):
+        value = await value
+    if stats:
+        stats.incr(name, 'recompute_time', time.time() - start)
+    return value
+
+
+async def async_redis_get_set(key, callback, ttl=None, coerce=None, serializer=None, redis=None, logging=False,
+                              local_cache=False, name=None, stampede_protection=False, should_cache=None, codec=None,
+                              tags=None, chunk_size=None):
+    """Same as redis_get_set() but using a redis.asyncio client. callback can return an awaitable.
+    """
+    if codec:
+        serializer, coerce = _make_codec_serializers(get_codec(codec), coerce)
+    redis = _get_async_redis(redis, bool(codec))
+    if local_cache:
+        local_cache = get_local_cache()
+    log = logging or (logging is None and current_app.debug)
+    stats = await get_async_cache_stats()
+    if stampede_protection:
+        return await _async_redis_get_set_protected(redis, key, callback, ttl, coerce, serializer, local_cache,
+            name, should_cache, log, stats, tags, chunk_size,
+            **(stampede_protection if isinstance(stampede_protection, dict) else {}))
+    value = await _get_raw_value(redis, key, ttl, local_cache, name, stats, chunk_size)
+    if value is not None:
+        if log:
+            logger.debug('CACHE HIT: %s' % key)
+        return _decode_value(value, coerce)
+    if log:
+        logger.debug('CACHE MISS: %s' % key)
+    value = await _call_async_callback(callback, stats, name)
+    if should_cache is None or should_cache():
+        await _set_raw_value(redis, key, _encode_value(value, serializer), ttl, local_cache, stats, name, tags,
+            chunk_size)
+    return value
+
+
+async def _async_redis_get_set_protected(redis, key, callback, ttl, coerce, serializer, local_cache, name, should_cache,
+                                         log, stats=None, tags=None, chunk_size=None, lock_timeout=10, wait_timeout=2,
+                                         wait_interval=0.05, stale_ttl=None, early_refresh=1.0):
+    raw = await _get_raw_value(redis, key, ttl, local_cache, name, stats, chunk_size)
+    stale = unknown_value
+    if raw is not None:
+        expires_at, delta, payload = _unpack_protected_value(raw)
+        if payload is not unknown_value:
+            if not expires_at or time.time() - delta * early_refresh * math.log(1.0 - random.random()) < expires_at:
+                if log:
+                    logger.debug('CACHE HIT: %s' % key)
+                return _decode_value(payload, coerce)
+            stale = payload
+
+    lock = redis.lock('%s:lock' % key, timeout=lock_timeout)
+    acquired = await guard_async_redis_call(lock.acquire, blocking=False)
+    if acquired is unknown_value:
+        lock = None # redis is unavailable, compute the value without locking
+    elif not acquired:
+        if stale is not unknown_value:
+            if log:
+                logger.debug('CACHE STALE: %s' % key)
+            return _decode_value(stale, coerce)
+        deadline = time.time() + wait_timeout
+        while time.time() < deadline:
+            await asyncio.sleep(wait_interval)
+            raw = await guard_async_redis_call(_get_value, redis, key, chunk_size)
+            if raw is unknown_value:
+                break
+            _, _, payload = _unpack_protected_value(raw)
+            if payload is not unknown_value:
+                return _decode_value(payload, coerce)
+        lock = None # the lock holder is too slow, compute the value ourselves
+
+    if log:
+        logger.debug('CACHE MISS: %s' % key)
+    try:
+        start = time.time()
+        value = await _call_async_callback(callback, stats, name)
+        delta = time.time() - start
+        if should_cache is None or should_cache():
+            expires_at = ''
+            redis_ttl = None
+            if ttl:
+                expires_at = time.time() + ttl
+                redis_ttl = int(ttl + (stale_ttl if stale_ttl is not None else ttl))
+            await _set_raw_value(redis, key, _pack_protected_value(expires_at, delta, _encode_value(value, serializer)),
+                redis_ttl, local_cache, stats, name, tags, chunk_size)
+    finally:
+        if lock is not None:
+            try:
+                await guard_async_redis_call(lock.release)
+            except LockError:
+                pass
+    return value
+
+
+async def _get_value(redis, key, chunk_size=None):
+    value = await redis.get(key)
+    if chunk_size and is_chunk_manifest(value):
+        value = await async_read_chunked_value(redis, key, value)
+    return value
+
+
+def _queue_set_value(pipe, key, value, ttl=None):
+    if ttl:
+        pipe.setex(key, ttl, value)
+    else:
+        pipe.set(key, value)
+
+
+async def _get_raw_value(redis, key, ttl=None, local_cache=None, name=None, stats=None, chunk_size=None):
+    try:
+        if not local_cache:
+            value = await guard_async_redis_call(_get_value, redis, key, chunk_size)
+        else:
+            value = local_cache.get(key, name)
+            if value is None:
+                value = await guard_async_redis_call(_get_value, redis, key, chunk_size)
+                if value is not unknown_value:
+                    local_cache.set(key, value, ttl)
+    except Exception:
+        if stats:
+            stats.error(name)
+        raise
+    if value is unknown_value:
+        # redis is unavailable
+        if stats:
+            stats.error(name)
+        return None
+    if stats:
+        if value is None:
+            stats.miss(name)
+        else:
+            stats.hit(name)
+    return value
+
+
+async def _set_raw_value(redis, key, value, ttl=None, local_cache=None, stats=None, name=None, tags=None,
+                         chunk_size=None):
+    async def write():
+        pipe = redis.pipeline(transaction=False)
+        if chunk_size and len(value) > chunk_size:
+            await async_write_chunked_value(redis, key, value, chunk_size, ttl, pipe)
+        else:
+            _queue_set_value(pipe, key, value, ttl)
+        if tags:
+            await async_tag_cache_key(key, tags, pipe, ttl, redis)
+        return await pipe.execute()
+    rv = await guard_async_redis_call(write)
+    if rv is unknown_value:
+        return
+    if local_cache:
+        local_cache.set(key, value, ttl)
+    if stats:
+        stats.write(name, value)
+
+
+def async_redis_get_set_as_json(key, callback, **kwargs):
+    kwargs['serializer'] = json.dumps
+    kwargs['coerce'] = json.loads
+    return async_redis_get_set(key, callback, **kwargs)
+
+
+async def async_redis_invalidate_key(key, redis=None, local_cache=False, chunked=False):
+    redis = _get_async_redis(redis)
+    if chunked:
+        await async_delete_chunked_value(redis, key)
+    else:
+        await redis.delete(key)
+    if local_cache:
+        await async_local_cache_invalidate(key)
+
+
+def async_redis_cached_function(key, **opts):
+    """Same as redis_cached_function() for coroutine functions. Calls to the
+    decorated function can be run concurrently using asyncio.gather().
+    """
+    opts.setdefault('logging', None)
+    tags = opts.pop('tags', None)
+    def decorator(func):
+        opts.setdefault('name', func.__qualname__)
+        build_key, build_tags = _make_function_key_builders(func, key, tags)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await async_redis_get_set(build_key(*args, **kwargs), lambda: func(*args, **kwargs),
+                tags=build_tags(*args, **kwargs) if tags else None, **opts)
+
+        async def invalidate(*args, **kwargs):
+            await async_redis_invalidate_key(build_key(*args, **kwargs), redis=opts.get('redis'),
+                local_cache=opts.get('local_cache', False), chunked=bool(opts.get('chunk_size')))
+
+        wrapper.build_key = build_key
+        wrapper.invalidate = invalidate
+        return wrapper
+    return decorator
+
+
+def async_redis_cached_function_as_json(key, **opts):
+    opts['serializer'] = json.dumps
+    opts['coerce'] = json.loads
+    return async_redis_cached_function(key, **opts)
+
+
+class AsyncRedisCachedMethod(RedisCachedMethod):
+    """Same as RedisCachedMethod for coroutine methods. cached() and invalidate() are coroutines.
+    """
+    @property
+    def async_redis(self):
+        if self._redis and not isinstance(self._redis, str):
+            return self._redis
+        return _get_async_redis(self._redis, bool(self.codec))
+
+    async def call(self, obj, args, kwargs):
+        key = None
+        if not self.cache_disabled:
+            try:
+                key = self.build_key(args, kwargs, obj)
+            except Exception as e:
+                current_app.log_exception(e)
+        if not key:
+            return await self._call_func(obj, *args, **kwargs)
+        default_ttl = getattr(obj, '__redis_cache_ttl__', None)
+        tags = self._build_method_tags(obj, args, kwargs)
+        serializer = self.serializer.dumps if self.serializer else None
+        if self.stampede_protection:
+            return await async_redis_get_set(key, lambda: self._call_func(obj, *args, **kwargs),
+                ttl=self.ttl if self.ttl is not None else default_ttl, coerce=self._decode_cached_value,
+                serializer=serializer, redis=self.async_redis, local_cache=self.local_cache, name=self.stats_name,
+                stampede_protection=self.stampede_protection, tags=tags, chunk_size=self.chunk_size,
+                should_cache=lambda: not self.cache_ignore_current)
+
+        stats = await get_async_cache_stats()
+        local_cache = get_local_cache() if self.local_cache else None
+        value = self._decode_cached_value(await _get_raw_value(self.async_redis, key, self.ttl, local_cache,
+            self.stats_name, stats, self.chunk_size))
+        if value is not unknown_value:
+            return value
+        value = await _call_async_callback(lambda: self._call_func(obj, *args, **kwargs), stats, self.stats_name)
+        # the flags set by the method are visible here as it was awaited in the same context
+        if not self.cache_ignore_current:
+            ttl = self.cache_current_ttl
+            if ttl is None:
+                ttl = default_ttl
+            await _set_raw_value(self.async_redis, key, _encode_value(value, serializer), ttl, local_cache,
+                stats, self.stats_name, tags, self.chunk_size)
+        return value
+
+    async def get_cached(self, obj, args, kwargs):
+        try:
+            key = self.build_key(args, kwargs, obj)
+        except Exception as e:
+            current_app.log_exception(e)
+            return unknown_value
+        value = await _get_raw_value(self.async_redis, key, self.ttl,
+            get_local_cache() if self.local_cache else None, self.stats_name, await get_async_cache_stats(),
+            self.chunk_size)
+        if self.stampede_protection:
+            value = _unpack_protected_value(value)[2]
+            if value is unknown_value:
+                value = None
+        return self._decode_cached_value(value)
+
+    async def invalidate_for(self, obj, args, kwargs):
+        try:
+            key = self.build_key(args, kwargs, obj)
+        except Exception as e:
+            current_app.log_exception(e)
+            return
+        await async_redis_invalidate_key(key, self.async_redis, self.local_cache, bool(self.chunk_size))
+
+
+def async_redis_cached_method(func=None, **kwargs):
+    def decorator(f):
+        return AsyncRedisCachedMethod(f, **kwargs)
+    if func:
+        return decorator(func)
+    return decorator
+
+
+def async_redis_cached_method_as_json(func=None, **kwargs):
+    kwargs['serializer'] = json
+    return async_redis_cached_method(func, **kwargs)
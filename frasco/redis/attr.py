@@ -1,16 +1,25 @@
 from flask import json, current_app
 from frasco.ext import get_extension_state
 from frasco.utils import unknown_value
-from .utils import build_object_key
-import inspect
+from .utils import (build_object_key, redis_get_set, NONE_VALUE, CallArgsBinder, _unpack_protected_value,
+                    _call_callback, _get_value, _set_value)
+from .chunks import is_chunk_manifest, read_chunked_value, delete_chunked_value
+from .stats import get_cache_stats
+from .tags import tag_cache_key
+from .local_cache import get_local_cache, local_cache_invalidate
+from .codecs import get_codec
+from .breaker import guard_redis_call
+import contextvars
 
 
-__all__ = ('redis_cached_property', 'redis_cached_property_as_json', 'redis_cached_method', 'redis_cached_method_as_json')
+__all__ = ('redis_cached_property', 'redis_cached_property_as_json', 'redis_cached_method', 'redis_cached_method_as_json',
+           'prefetch_redis_cached')
 
 
 class RedisCachedAttribute(object):
     def __init__(self, func, redis=None, key=None, ttl=None, coerce=None,\
-                 serializer=None, name=None):
+                 serializer=None, name=None, local_cache=False, stampede_protection=False, codec=None,
+                 tags=None, chunk_size=None):
         self.func = func
         self.__name__ = func.__name__
         self.__doc__ = func.__doc__
@@ -18,35 +27,125 @@ class RedisCachedAttribute(object):
         self.key = key
         self.ttl = ttl
         self.coerce = coerce
-        self.serializer = serializer
+        # codecs share the interface of serializers but produce bytes
+        self.codec = get_codec(codec) if codec else None
+        self.serializer = self.codec or serializer
         self.name = name or self.__name__
+        self.stats_name = self.name
+        self.local_cache = local_cache
+        self.stampede_protection = stampede_protection
+        self.tags = tags
+        self.chunk_size = chunk_size
         self.cached_property_name = self.__name__ + '_cached'
         self.cache_disabled = False
-        self.cache_ignore_current = False
-        self.cache_current_ttl = None
+        # flags of the current call, local to each thread and asyncio task
+        self._ignore_current = contextvars.ContextVar('%s_ignore_current' % self.__name__, default=False)
+        self._current_ttl = contextvars.ContextVar('%s_current_ttl' % self.__name__, default=None)
+
+    @property
+    def cache_ignore_current(self):
+        return self._ignore_current.get()
+
+    @cache_ignore_current.setter
+    def cache_ignore_current(self, value):
+        self._ignore_current.set(value)
+
+    @property
+    def cache_current_ttl(self):
+        return self._current_ttl.get()
+
+    @cache_current_ttl.setter
+    def cache_current_ttl(self, value):
+        self._current_ttl.set(value)
+
+    def __set_name__(self, owner, name):
+        self.stats_name = '%s.%s' % (owner.__name__, self.name)
 
     @property
     def redis(self):
-        return self._redis or get_extension_state('frasco_redis').connection
+        if self._redis and not isinstance(self._redis, str):
+            return self._redis
+        # redis can also be the name of a connection
+        return get_extension_state('frasco_redis').get_cache_connection(self._redis, binary=bool(self.codec))
+
+    def _build_tags(self, obj, args=(), kwargs=None, at_values=None):
+        if not self.tags:
+            return None
+        if callable(self.tags):
+            return self.tags(obj, *args, **(kwargs or {}))
+        return [build_object_key(obj, self.name, tag, at_values) for tag in self.tags]
 
-    def _set_cached_value(self, key, value, default_ttl=None):
+    def _set_cached_value(self, key, value, default_ttl=None, pipe=None, tags=None):
         if self.serializer:
             value = self.serializer.dumps(value)
         ttl = self.cache_current_ttl
         if ttl is None:
             ttl = default_ttl
         if value is None:
-            value = 'None'
-        if ttl is not None:
-            self.redis.setex(key, ttl, value)
-        else:
-            self.redis.set(key, value)
+            value = NONE_VALUE
+        def write(pipe):
+            execute = pipe is None
+            if execute:
+                pipe = self.redis.pipeline(transaction=False)
+            _set_value(self.redis, key, value, ttl, self.chunk_size, pipe)
+            if tags:
+                tag_cache_key(key, tags, pipe, ttl, self.redis)
+            if execute:
+                pipe.execute()
+        if guard_redis_call(write, pipe) is unknown_value:
+            return
+        local_cache = get_local_cache() if self.local_cache else None
+        if local_cache:
+            local_cache.set(key, value, ttl)
+        stats = get_cache_stats()
+        if stats:
+            stats.write(self.stats_name, value)
 
     def _get_cached_value(self, key):
-        if not self.redis.exists(key):
+        stats = get_cache_stats()
+        try:
+            local_cache = get_local_cache() if self.local_cache else None
+            if not local_cache:
+                value = guard_redis_call(_get_value, self.redis, key, self.chunk_size)
+            else:
+                value = local_cache.get(key, self.stats_name)
+                if value is None:
+                    value = guard_redis_call(_get_value, self.redis, key, self.chunk_size)
+                    if value is not unknown_value:
+                        local_cache.set(key, value, self.ttl)
+        except Exception:
+            if stats:
+                stats.error(self.stats_name)
+            raise
+        if value is unknown_value:
+            # redis is unavailable
+            if stats:
+                stats.error(self.stats_name)
+            return value
+        if self.stampede_protection:
+            value = _unpack_protected_value(value)[2]
+            if value is unknown_value:
+                value = None
+        value = self._decode_cached_value(value)
+        if stats:
+            if value is unknown_value:
+                stats.miss(self.stats_name)
+            else:
+                stats.hit(self.stats_name)
+        return value
+
+    def _delete_cached_value(self, key):
+        if self.chunk_size:
+            delete_chunked_value(self.redis, key)
+        else:
+            self.redis.delete(key)
+        if self.local_cache:
+            local_cache_invalidate(key)
+
+    def _decode_cached_value(self, value):
+        if value is None:
             return unknown_value
-        value = self.redis.get(key)
-        if value is None or value == 'None':
+        if value == NONE_VALUE:
             return None
         if self.serializer:
             value = self.serializer.loads(value)
@@ -54,6 +153,13 @@ class RedisCachedAttribute(object):
             value = self.coerce(value)
         return value
 
+    def _get_set_protected(self, key, callback, default_ttl=None, tags=None):
+        return redis_get_set(key, callback, ttl=self.ttl if self.ttl is not None else default_ttl,
+            coerce=self._decode_cached_value, serializer=self.serializer.dumps if self.serializer else None,
+            redis=self.redis, local_cache=self.local_cache, name=self.stats_name,
+            stampede_protection=self.stampede_protection, tags=tags, chunk_size=self.chunk_size,
+            should_cache=lambda: not self.cache_ignore_current)
+
     def _call_func(self, obj, *args, **kwargs):
         self.cache_ignore_current = False
         self.cache_current_ttl = self.ttl
@@ -75,15 +181,19 @@ class RedisCachedProperty(RedisCachedAttribute):
             if not self.cache_disabled:
                 try:
                     key = self.build_key(obj)
-                    value = self._get_cached_value(key)
+                    if not self.stampede_protection:
+                        value = self._get_cached_value(key)
                 except Exception as e:
                     current_app.log_exception(e)
                     value = unknown_value
-            if value is unknown_value:
-                value = self.get_fresh(obj)
+            if self.stampede_protection and key:
+                value = self._get_set_protected(key, lambda: self.get_fresh(obj),
+                    getattr(obj, '__redis_cache_ttl__', None), self._build_tags(obj))
+            elif value is unknown_value:
+                value = _call_callback(lambda: self.get_fresh(obj), get_cache_stats(), self.stats_name)
                 if not self.cache_disabled and not self.cache_ignore_current and key:
                     self._set_cached_value(key, value,
-                        getattr(obj, '__redis_cache_ttl__', None))
+                        getattr(obj, '__redis_cache_ttl__', None), tags=self._build_tags(obj))
             obj.__dict__[self.cached_property_name] = value
         return value
 
@@ -122,7 +232,7 @@ class RedisCachedProperty(RedisCachedAttribute):
         except Exception as e:
             current_app.log_exception(e)
             return
-        self.redis.delete(key)
+        self._delete_cached_value(key)
 
     def setter(self, fset):
         self.fset = fset
@@ -147,30 +257,56 @@ def redis_cached_property_as_json(fget=None, **kwargs):
 
 
 class RedisCachedMethod(RedisCachedAttribute):
+    """Accessing the method on an instance returns a BoundRedisCachedMethod so that
+    the descriptor, shared by all threads, is never modified.
+    """
+    def __init__(self, func, **kwargs):
+        super(RedisCachedMethod, self).__init__(func, **kwargs)
+        self.bind_args = CallArgsBinder(func)
+
     def __get__(self, obj, cls=None):
-        self.obj = obj
-        return self
+        if obj is None:
+            return self
+        return BoundRedisCachedMethod(self, obj)
 
     def __call__(self, *args, **kwargs):
-        obj = kwargs.pop('__obj__', self.obj)
+        obj = kwargs.pop('__obj__', None)
+        return self.call(obj, args, kwargs)
+
+    def cached(self, *args, **kwargs):
+        obj = kwargs.pop('__obj__', None)
+        return self.get_cached(obj, args, kwargs)
+
+    def fresh(self, *args, **kwargs):
+        obj = kwargs.pop('__obj__', None)
+        return self._call_func(obj, *args, **kwargs)
+
+    def invalidate(self, *args, **kwargs):
+        obj = kwargs.pop('__obj__', None)
+        return self.invalidate_for(obj, args, kwargs)
+
+    def call(self, obj, args, kwargs):
         value = unknown_value
+        key = None
         if not self.cache_disabled:
-            key = None
             try:
                 key = self.build_key(args, kwargs, obj)
-                value = self._get_cached_value(key)
+                if not self.stampede_protection:
+                    value = self._get_cached_value(key)
             except Exception as e:
                 current_app.log_exception(e)
                 value = unknown_value
-        if value is unknown_value:
-            value = self._call_func(obj, *args, **kwargs)
+        if self.stampede_protection and key:
+            value = self._get_set_protected(key, lambda: self._call_func(obj, *args, **kwargs),
+                getattr(obj, '__redis_cache_ttl__', None), self._build_method_tags(obj, args, kwargs))
+        elif value is unknown_value:
+            value = _call_callback(lambda: self._call_func(obj, *args, **kwargs), get_cache_stats(), self.stats_name)
             if not self.cache_disabled and not self.cache_ignore_current and key:
-                self._set_cached_value(key, value,
-                    getattr(self.obj, '__redis_cache_ttl__', None))
+                self._set_cached_value(key, value, getattr(obj, '__redis_cache_ttl__', None),
+                    tags=self._build_method_tags(obj, args, kwargs))
         return value
 
-    def cached(self, *args, **kwargs):
-        obj = kwargs.pop('__obj__', self.obj)
+    def get_cached(self, obj, args, kwargs):
         try:
             key = self.build_key(args, kwargs, obj)
         except Exception as e:
@@ -178,28 +314,58 @@ class RedisCachedMethod(RedisCachedAttribute):
             return unknown_value
         return self._get_cached_value(key)
 
-    def fresh(self, *args, **kwargs):
-        obj = kwargs.pop('__obj__', self.obj)
-        return self._call_func(obj, *args, **kwargs)
-
-    def invalidate(self, *args, **kwargs):
-        obj = kwargs.pop('__obj__', self.obj)
+    def invalidate_for(self, obj, args, kwargs):
         try:
             key = self.build_key(args, kwargs, obj)
         except Exception as e:
             current_app.log_exception(e)
             return
-        self.redis.delete(key)
+        self._delete_cached_value(key)
+
+    def _build_method_tags(self, obj, args, kwargs):
+        return self._build_tags(obj, args, kwargs, lambda: self.bind_args(obj, *args, **kwargs))
 
     def build_key(self, args=None, kwargs=None, obj=None):
-        if not obj:
-            obj = self.obj
         if not args:
             args = []
         if not kwargs:
             kwargs = {}
-        at_values = inspect.getcallargs(self.func, obj, *args, **kwargs)
-        return build_object_key(obj, self.name, self.key, at_values)
+        return build_object_key(obj, self.name, self.key, lambda: self.bind_args(obj, *args, **kwargs))
+
+
+class BoundRedisCachedMethod(object):
+    """A RedisCachedMethod bound to an instance. Other attributes are read from
+    and written to the method.
+    """
+    __slots__ = ('method', 'obj')
+
+    def __init__(self, method, obj):
+        object.__setattr__(self, 'method', method)
+        object.__setattr__(self, 'obj', obj)
+
+    def __call__(self, *args, **kwargs):
+        return self.method.call(self.obj, args, kwargs)
+
+    def cached(self, *args, **kwargs):
+        return self.method.get_cached(self.obj, args, kwargs)
+
+    def fresh(self, *args, **kwargs):
+        return self.method._call_func(self.obj, *args, **kwargs)
+
+    def invalidate(self, *args, **kwargs):
+        return self.method.invalidate_for(self.obj, args, kwargs)
+
+    def build_key(self, args=None, kwargs=None, obj=None):
+        return self.method.build_key(args, kwargs, obj or self.obj)
+
+    def __getattr__(self, name):
+        return getattr(self.method, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.method, name, value)
+
+    def __repr__(self):
+        return '<bound redis cached method %s of %r>' % (self.method.__name__, self.obj)
 
 
 def redis_cached_method(func=None, **kwargs):
@@ -213,3 +379,76 @@ def redis_cached_method(func=None, **kwargs):
 def redis_cached_method_as_json(func=None, **kwargs):
     kwargs['serializer'] = json
     return redis_cached_method(func, **kwargs)
+
+
+def prefetch_redis_cached(objs, *names):
+    """Loads the values of multiple cached properties for a list of objects using
+    a single MGET per redis connection. Missing values are computed and written back
+    in one pipeline. Values end up in the per-object cache so subsequent attribute
+    accesses do not hit redis.
+    """
+    objs = list(objs)
+    if not objs or not names:
+        return
+    lookups = {} # redis connection -> [(attr, obj, key)]
+    for name in names:
+        for obj in objs:
+            attr = getattr(obj.__class__, name)
+            if not isinstance(attr, RedisCachedProperty):
+                raise TypeError("'%s' is not a redis cached property" % name)
+            if attr.cached_property_name in obj.__dict__ or attr.stampede_protection:
+                # stampede protected values are stored with metadata and loaded one by one
+                continue
+            key = None
+            if not attr.cache_disabled:
+                try:
+                    key = attr.build_key(obj)
+                except Exception as e:
+                    current_app.log_exception(e)
+            lookups.setdefault(attr.redis, []).append((attr, obj, key))
+
+    stats = get_cache_stats()
+    for conn, items in lookups.items():
+        keys = [key for _, _, key in items if key]
+        values = {}
+        if keys:
+            try:
+                rv = guard_redis_call(conn.mget, keys)
+                if rv is unknown_value:
+                    # redis is unavailable, values are computed without being cached
+                    keys = []
+                    items = [(attr, obj, None) for attr, obj, _ in items]
+                    if stats:
+                        stats.error(items[0][0].stats_name)
+                else:
+                    values = dict(zip(keys, rv))
+            except Exception as e:
+                current_app.log_exception(e)
+                if stats:
+                    stats.error(items[0][0].stats_name)
+
+        pipe = None
+        for attr, obj, key in items:
+            value = unknown_value
+            if key and key in values:
+                try:
+                    raw = values[key]
+                    if attr.chunk_size and is_chunk_manifest(raw):
+                        raw = guard_redis_call(read_chunked_value, conn, key, raw)
+                        if raw is unknown_value:
+                            raw = None
+                    value = attr._decode_cached_value(raw)
+                except Exception as e:
+                    current_app.log_exception(e)
+                if stats:
+                    stats.incr(attr.stats_name, 'misses' if value is unknown_value else 'hits')
+            if value is unknown_value:
+                value = _call_callback(lambda: attr.get_fresh(obj), stats, attr.stats_name)
+                if key and not attr.cache_ignore_current:
+                    if pipe is None:
+                        pipe = conn.pipeline(transaction=False)
+                    attr._set_cached_value(key, value, getattr(obj, '__redis_cache_ttl__', None),
+                        pipe=pipe, tags=attr._build_tags(obj))
+            obj.__dict__[attr.cached_property_name] = value
+        if pipe is not None:
+            guard_redis_call(pipe.execute)
@@ -0,0 +1,129 @@
+from frasco.ext import get_extension_state, has_extension
+from frasco.utils import unknown_value
+from redis.exceptions import ConnectionError, TimeoutError
+import threading
+import logging
+import time
+
+
+__all__ = ('CircuitBreaker', 'get_circuit_breaker', 'guard_redis_call', 'guard_async_redis_call')
+
+
+logger = logging.getLogger('frasco.redis')
+
+
+class CircuitBreaker(object):
+    """Stops calling redis after failure_threshold consecutive connection failures.
+    The circuit stays open for reset_timeout seconds, then a single call is let through
+    (half open): the circuit closes if it succeeds or opens again if it fails.
+    Failures are logged at most once every log_interval seconds.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    errors = (ConnectionError, TimeoutError)
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, log_interval=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.log_interval = log_interval
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.opened_count = 0
+        self.skipped_count = 0
+        self._lock = threading.Lock()
+        self._last_log = 0
+        self._unlogged_failures = 0
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                # let one probe through
+                self.state = self.HALF_OPEN
+                return True
+            self.skipped_count += 1
+            return False
+
+    def success(self):
+        if self.state == self.CLOSED and not self.failures:
+            return
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.warning('Redis is available again, closing the circuit breaker')
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self, exc):
+        with self._lock:
+            self.failures += 1
+            self._unlogged_failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.time()
+                self.opened_count += 1
+                logger.error('Redis is unavailable (%s), skipping the cache for %ss' % (exc, self.reset_timeout))
+                self._last_log = self.opened_at
+                self._unlogged_failures = 0
+            elif time.time() - self._last_log >= self.log_interval:
+                logger.warning('Redis error (%s), %d failure(s) since last report' % (exc, self._unlogged_failures))
+                self._last_log = time.time()
+                self._unlogged_failures = 0
+
+    def metrics(self):
+        return {'state': self.state,
+                'failures': self.failures,
+                'opened_count': self.opened_count,
+                'skipped_count': self.skipped_count}
+
+
+def get_circuit_breaker():
+    """Returns the CircuitBreaker of the current app, or None if it is disabled"""
+    if not has_extension('frasco_redis'):
+        return None
+    return get_extension_state('frasco_redis').circuit_breaker
+
+
+def guard_redis_call(func, *args, **kwargs):
+    """Calls func unless the circuit breaker is open. Returns unknown_value when
+    the call is skipped or when redis is unavailable.
+    """
+    breaker = get_circuit_breaker()
+    if breaker is None:
+        return func(*args, **kwargs)
+    if not breaker.allow():
+        return unknown_value
+    try:
+        rv = func(*args, **kwargs)
+    except breaker.errors as e:
+        breaker.failure(e)
+        return unknown_value
+    except Exception:
+        # redis answered, the error comes from the command itself
+        breaker.success()
+        raise
+    breaker.success()
+    return rv
+
+
+async def guard_async_redis_call(func, *args, **kwargs):
+    """Same as guard_redis_call() for coroutine functions"""
+    breaker = get_circuit_breaker()
+    if breaker is None:
+        return await func(*args, **kwargs)
+    if not breaker.allow():
+        return unknown_value
+    try:
+        rv = await func(*args, **kwargs)
+    except breaker.errors as e:
+        breaker.failure(e)
+        return unknown_value
+    except Exception:
+        # redis answered, the error comes from the command itself
+        breaker.success()
+        raise
+    breaker.success()
+    return rv
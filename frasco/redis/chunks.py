@@ -0,0 +1,171 @@
+from flask import current_app
+import uuid
+
+
+__all__ = ('redis_iter_value_chunks', 'write_chunked_value', 'read_chunked_value', 'delete_chunked_value')
+
+
+CHUNK_MANIFEST_PREFIX = '\x00chunks:'
+CHUNK_MANIFEST_BINARY_PREFIX = CHUNK_MANIFEST_PREFIX.encode('ascii')
+CHUNK_MANIFEST_MAX_LENGTH = 64
+
+
+def is_chunk_manifest(value):
+    if isinstance(value, bytes):
+        return value.startswith(CHUNK_MANIFEST_BINARY_PREFIX)
+    return isinstance(value, str) and value.startswith(CHUNK_MANIFEST_PREFIX)
+
+
+def parse_chunk_manifest(manifest):
+    """Returns the version, number of chunks and type (str or bytes) of a value"""
+    if isinstance(manifest, bytes):
+        version, count = manifest[len(CHUNK_MANIFEST_BINARY_PREFIX):].decode('ascii').split(':')
+        return version, int(count), bytes
+    version, count = manifest[len(CHUNK_MANIFEST_PREFIX):].split(':')
+    return version, int(count), str
+
+
+def chunk_key(key, version, index):
+    return '%s:chunk:%s:%s' % (key, version, index)
+
+
+def write_chunked_value(redis, key, value, chunk_size, ttl=None, pipe=None):
+    """Stores value as chunks of chunk_size and a small manifest under key.
+    Chunks of the value previously stored under key are deleted.
+    If pipe is provided, commands are added to it instead of being executed.
+    """
+    execute = pipe is None
+    if execute:
+        pipe = redis.pipeline(transaction=False)
+    manifest = _queue_chunked_value(pipe, key, value, chunk_size, ttl, redis.get(key))
+    if execute:
+        pipe.execute()
+    return manifest
+
+
+async def async_write_chunked_value(redis, key, value, chunk_size, ttl=None, pipe=None):
+    """Same as write_chunked_value() using a redis.asyncio client"""
+    execute = pipe is None
+    if execute:
+        pipe = redis.pipeline(transaction=False)
+    manifest = _queue_chunked_value(pipe, key, value, chunk_size, ttl, await redis.get(key))
+    if execute:
+        await pipe.execute()
+    return manifest
+
+
+def _queue_chunked_value(pipe, key, value, chunk_size, ttl=None, old_manifest=None):
+    version = uuid.uuid4().hex[:12]
+    count = (len(value) + chunk_size - 1) // chunk_size
+    manifest = '%s%s:%s' % (CHUNK_MANIFEST_PREFIX, version, count)
+    if isinstance(value, bytes):
+        manifest = manifest.encode('ascii')
+    # chunks are written before the manifest so readers never see a partial value
+    for i in range(count):
+        chunk = value[i * chunk_size:(i + 1) * chunk_size]
+        if ttl:
+            pipe.setex(chunk_key(key, version, i), ttl, chunk)
+        else:
+            pipe.set(chunk_key(key, version, i), chunk)
+    if ttl:
+        pipe.setex(key, ttl, manifest)
+    else:
+        pipe.set(key, manifest)
+    if is_chunk_manifest(old_manifest):
+        _delete_chunks(pipe, key, old_manifest)
+    return manifest
+
+
+def _delete_chunks(pipe, key, manifest):
+    version, count, _ = parse_chunk_manifest(manifest)
+    if count:
+        pipe.delete(*[chunk_key(key, version, i) for i in range(count)])
+
+
+def get_chunk_keys(redis, keys):
+    """Returns the keys of the chunks of the values stored under keys. Only the beginning
+    of each value is fetched to detect manifests.
+    """
+    keys = list(keys)
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        pipe.getrange(key, 0, CHUNK_MANIFEST_MAX_LENGTH - 1)
+    chunk_keys = []
+    for key, head in zip(keys, pipe.execute(raise_on_error=False)):
+        if not isinstance(head, Exception) and is_chunk_manifest(head):
+            version, count, _ = parse_chunk_manifest(head)
+            chunk_keys.extend(chunk_key(key, version, i) for i in range(count))
+    return chunk_keys
+
+
+def iter_chunks(redis, key, manifest, batch_size=16):
+    """Yields the chunks of a value, fetching batch_size chunks per pipeline.
+    Raises a KeyError if a chunk is missing (eg: it expired before the manifest).
+    """
+    version, count, _ = parse_chunk_manifest(manifest)
+    for start in range(0, count, batch_size):
+        pipe = redis.pipeline(transaction=False)
+        for i in range(start, min(start + batch_size, count)):
+            pipe.get(chunk_key(key, version, i))
+        for chunk in pipe.execute():
+            if chunk is None:
+                raise KeyError(key)
+            yield chunk
+
+
+def read_chunked_value(redis, key, manifest):
+    """Returns the value described by manifest (fetching all the chunks in one pipeline)
+    or None if some chunks are missing.
+    """
+    _, count, type_ = parse_chunk_manifest(manifest)
+    try:
+        return type_().join(iter_chunks(redis, key, manifest, max(count, 1)))
+    except KeyError:
+        return None
+
+
+async def async_read_chunked_value(redis, key, manifest):
+    """Same as read_chunked_value() using a redis.asyncio client"""
+    version, count, type_ = parse_chunk_manifest(manifest)
+    pipe = redis.pipeline(transaction=False)
+    for i in range(count):
+        pipe.get(chunk_key(key, version, i))
+    chunks = await pipe.execute() if count else []
+    if any(chunk is None for chunk in chunks):
+        return None
+    return type_().join(chunks)
+
+
+def delete_chunked_value(redis, key):
+    """Deletes key and its chunks if the value was stored in chunks"""
+    manifest = redis.get(key)
+    pipe = redis.pipeline(transaction=False)
+    pipe.delete(key)
+    if is_chunk_manifest(manifest):
+        _delete_chunks(pipe, key, manifest)
+    pipe.execute()
+
+
+async def async_delete_chunked_value(redis, key):
+    """Same as delete_chunked_value() using a redis.asyncio client"""
+    manifest = await redis.get(key)
+    pipe = redis.pipeline(transaction=False)
+    pipe.delete(key)
+    if is_chunk_manifest(manifest):
+        _delete_chunks(pipe, key, manifest)
+    await pipe.execute()
+
+
+def redis_iter_value_chunks(key, redis=None, batch_size=16, binary=False):
+    """Returns an iterator over the parts of the value stored under key without loading
+    it entirely in memory, or None if the key does not exist. Values which are not stored in chunks
+    are returned as a single part. Raises a KeyError while iterating if a chunk has expired.
+    """
+    if not redis or isinstance(redis, str):
+        redis = current_app.extensions.frasco_redis.get_cache_connection(redis, binary=binary)
+    value = redis.get(key)
+    if value is None:
+        return None
+    if not is_chunk_manifest(value):
+        return iter([value])
+    return iter_chunks(redis, key, value, batch_size)
@@ -0,0 +1,121 @@
+from flask import json
+import pickle
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+__all__ = ('Codec', 'PickleCodec', 'JSONCodec', 'CompactJSONCodec', 'MsgpackCodec', 'CompressedCodec', 'register_codec', 'get_codec')
+
+
+COMPRESSED_PREFIX = b'\x00z'
+
+
+class Codec(object):
+    """Converts values to bytes and back. Codecs are used with the binary redis connection.
+    """
+    def dumps(self, value):
+        raise NotImplementedError()
+
+    def loads(self, data):
+        raise NotImplementedError()
+
+
+class PickleCodec(Codec):
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+        self.protocol = protocol
+
+    def dumps(self, value):
+        return pickle.dumps(value, protocol=self.protocol)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class JSONCodec(Codec):
+    def dumps(self, value):
+        return json.dumps(value).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class CompactJSONCodec(JSONCodec):
+    """JSON without any whitespace
+    """
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+class MsgpackCodec(Codec):
+    """Requires the msgpack package. Data written with this codec can only be read with it
+    (use compact_json when some processes may not have msgpack installed).
+    """
+    def dumps(self, value):
+        return _get_msgpack().packb(value, use_bin_type=True)
+
+    def loads(self, data):
+        return _get_msgpack().unpackb(data, raw=False)
+
+
+def _get_msgpack():
+    if msgpack is None:
+        raise RuntimeError("The msgpack redis codec requires the msgpack package")
+    return msgpack
+
+
+def compress(data, threshold=None, level=-1):
+    if threshold is not None and len(data) <= threshold:
+        return data
+    return COMPRESSED_PREFIX + zlib.compress(data, level)
+
+
+def decompress(data):
+    if data.startswith(COMPRESSED_PREFIX):
+        return zlib.decompress(data[len(COMPRESSED_PREFIX):])
+    return data
+
+
+class CompressedCodec(Codec):
+    """Compresses the output of another codec using zlib when it is larger than threshold
+    """
+    def __init__(self, codec, threshold=1024, level=-1):
+        self.codec = get_codec(codec)
+        self.threshold = threshold
+        self.level = level
+
+    def dumps(self, value):
+        return compress(self.codec.dumps(value), self.threshold, self.level)
+
+    def loads(self, data):
+        return self.codec.loads(decompress(data))
+
+
+_codecs = {}
+
+
+def register_codec(name, codec):
+    _codecs[name] = codec
+
+
+def get_codec(codec):
+    """Returns a codec object from a codec name. Names can be suffixed with "+zlib" to use
+    a CompressedCodec with the default threshold (eg: "pickle+zlib").
+    """
+    if not isinstance(codec, str):
+        return codec
+    if codec not in _codecs and codec.endswith('+zlib'):
+        _codecs[codec] = CompressedCodec(codec[:-5])
+    try:
+        return _codecs[codec]
+    except KeyError:
+        raise ValueError("Unknown redis codec '%s'" % codec)
+
+
+register_codec('pickle', PickleCodec())
+register_codec('json', JSONCodec())
+register_codec('compact_json', CompactJSONCodec())
+register_codec('msgpack', MsgpackCodec())
@@ -2,23 +2,249 @@ from frasco.ext import *
 from redis import Redis
 from werkzeug.local import LocalProxy
 from .templating import CacheFragmentExtension
+from .local_cache import LocalCache
+from .stats import CacheStats, sample_keyspace
+from .tags import register_model_cache_tags_listeners
+from .warm import warm_redis_cached, resolve_model
+from .breaker import CircuitBreaker
+from .sharding import ShardedRedis
+from sqlalchemy import text
+import asyncio
+import weakref
+import time
+import click
+
+try:
+    from redis import asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+
+CONNECTION_OPTIONS = ('url', 'max_connections', 'socket_timeout', 'socket_connect_timeout', 'socket_keepalive',
+                      'health_check_interval', 'retry_on_timeout')
+# options of sharded connections: a list of urls and the number of virtual nodes per url
+SHARDING_OPTIONS = ('shards', 'virtual_nodes')
+
+
+class FrascoRedisState(ExtensionState):
+    def __init__(self, *args, **kwargs):
+        super(FrascoRedisState, self).__init__(*args, **kwargs)
+        self.connections = {}
+        self.async_connections = weakref.WeakKeyDictionary() # event loop -> {(name, binary): client}
+        self.async_connections_closers = weakref.WeakKeyDictionary() # event loop -> async generator
+        self.tagged_connections = set() # names of the connections registered as holding tag indexes
+        self.connections_options = {None: dict((k, self.options[k]) for k in CONNECTION_OPTIONS)}
+        for name, options in self.options['connections'].items():
+            if isinstance(options, str):
+                options = {'url': options}
+            self.connections_options[name] = dict(self.connections_options[None], **options)
+
+    def get_connection(self, name=None, binary=False):
+        """Returns the client of a named connection (or of the default one if there
+        is no connection with this name). Each named connection has its own pool.
+        Connections configured with a list of shards urls return a ShardedRedis.
+        """
+        if name not in self.connections_options:
+            name = None
+        connection = self.connections.get((name, binary))
+        if connection is None:
+            options = self.get_connection_kwargs(name)
+            if not binary:
+                options.update(decode_responses=self.options["decode_responses"], encoding=self.options["encoding"])
+            shards = self.connections_options[name].get('shards')
+            if shards:
+                connection = ShardedRedis([Redis.from_url(url, **options) for url in shards], shards,
+                    self.connections_options[name].get('virtual_nodes', 160))
+            else:
+                connection = Redis.from_url(self.get_connection_url(name), **options)
+            self.connections[(name, binary)] = connection
+        return connection
+
+    def get_async_connection(self, name=None, binary=False):
+        """Same as get_connection() but returns a redis.asyncio client (requires redis>=4.2).
+        Clients are bound to the running event loop and reused while it runs, they are meant
+        for long lived loops (eg: the one of an ASGI server). They are closed when the loop
+        shuts down its async generators (as done by asyncio.run()) or by close_async_connections().
+        """
+        if aioredis is None:
+            raise RuntimeError("redis.asyncio is not available, redis>=4.2 is needed")
+        if name not in self.connections_options:
+            name = None
+        if self.connections_options[name].get('shards'):
+            raise RuntimeError("Sharded connections cannot be used with redis.asyncio")
+        loop = asyncio.get_running_loop()
+        connections = self.async_connections.get(loop)
+        if connections is None:
+            connections = self.async_connections[loop] = {}
+            closer = self.async_connections_closers[loop] = _close_async_connections_on_shutdown(self)
+            # starting the generator registers it to be closed when the loop shuts down
+            asyncio.ensure_future(closer.__anext__())
+        connection = connections.get((name, binary))
+        if connection is None:
+            options = self.get_connection_kwargs(name)
+            if not binary:
+                options.update(decode_responses=self.options["decode_responses"], encoding=self.options["encoding"])
+            connection = aioredis.Redis.from_url(self.get_connection_url(name), **options)
+            connections[(name, binary)] = connection
+        return connection
+
+    async def close_async_connections(self):
+        """Closes the redis.asyncio clients of the running event loop"""
+        connections = self.async_connections.pop(asyncio.get_running_loop(), {})
+        for connection in connections.values():
+            await connection.close()
+
+    def get_connection_name(self, connection):
+        """Returns the name of a client returned by get_connection() or get_async_connection()
+        (None for the default connection). Raises a ValueError for other clients.
+        """
+        connections = list(self.connections.items())
+        if aioredis is not None:
+            try:
+                connections.extend(self.async_connections.get(asyncio.get_running_loop(), {}).items())
+            except RuntimeError:
+                pass
+        for (name, _), client in connections:
+            if client is connection:
+                return name
+        raise ValueError("%r is not a connection of frasco_redis" % connection)
+
+    def get_cache_async_connection(self, name=None, binary=False):
+        return self.get_async_connection(name or self.options["cache_connection"], binary)
+
+    def has_connection(self, name):
+        return name in self.connections_options
+
+    def get_connection_url(self, name=None):
+        return self.connections_options.get(name, self.connections_options[None])['url']
+
+    def get_connection_kwargs(self, name=None):
+        """Returns the options (except the url) of a connection, as accepted by Redis.from_url()"""
+        options = self.connections_options.get(name, self.connections_options[None])
+        return dict((k, v) for k, v in options.items() if v is not None and k != 'url' and k not in SHARDING_OPTIONS)
+
+    def get_cache_connection(self, name=None, binary=False):
+        return self.get_connection(name or self.options["cache_connection"], binary)
+
+
+async def _close_async_connections_on_shutdown(state):
+    try:
+        yield
+    finally:
+        await state.close_async_connections()
 
 
 class FrascoRedis(Extension):
     name = "frasco_redis"
+    state_class = FrascoRedisState
     defaults = {"url": "redis://localhost:6379/0",
+                "max_connections": None,
+                "socket_timeout": None,
+                "socket_connect_timeout": None,
+                "socket_keepalive": None,
+                "health_check_interval": 0,
+                "retry_on_timeout": False,
+                "connections": {},
+                "cache_connection": None,
                 "fragment_cache_timeout": 3600,
+                "fragment_cache_compress_threshold": 1024,
+                "fragment_cache_version": None,
                 "decode_responses": True,
-                "encoding": "utf-8"}
+                "encoding": "utf-8",
+                "local_cache_max_items": 1000,
+                "local_cache_max_memory": 16 * 1024 * 1024,
+                "local_cache_ttl": 60,
+                "local_cache_channel": "frasco:local_cache:invalidate",
+                "cache_stats": False,
+                "cache_stats_key": "frasco:cache_stats",
+                "cache_stats_flush_interval": 10,
+                "cache_tag_prefix": "cache_tag:",
+                "model_cache_tags": False,
+                "circuit_breaker": True,
+                "circuit_breaker_threshold": 5,
+                "circuit_breaker_reset_timeout": 30,
+                "circuit_breaker_log_interval": 60}
 
     def _init_app(self, app, state):
-        state.connection = Redis.from_url(state.options["url"],
-            decode_responses=state.options["decode_responses"],
-            encoding=state.options["encoding"])
+        state.connection = state.get_connection()
+        # used for values which are not text (eg: compressed fragments)
+        state.binary_connection = state.get_connection(binary=True)
+        state.cache_connection = state.get_cache_connection()
+        state.cache_binary_connection = state.get_cache_connection(binary=True)
+        state.local_cache = LocalCache(max_items=state.options["local_cache_max_items"],
+            max_memory=state.options["local_cache_max_memory"],
+            ttl=state.options["local_cache_ttl"],
+            channel=state.options["local_cache_channel"])
+        state.circuit_breaker = None
+        if state.options["circuit_breaker"]:
+            state.circuit_breaker = CircuitBreaker(state.options["circuit_breaker_threshold"],
+                state.options["circuit_breaker_reset_timeout"], state.options["circuit_breaker_log_interval"])
+        state.cache_stats = None
+        if state.options["cache_stats"]:
+            state.cache_stats = CacheStats(state.options["cache_stats_key"],
+                state.options["cache_stats_flush_interval"], state.circuit_breaker)
+        if state.options["model_cache_tags"]:
+            register_model_cache_tags_listeners()
         app.jinja_env.add_extension(CacheFragmentExtension)
 
+        @app.cli.command('redis-cache-stats')
+        @click.option('--keyspace/--no-keyspace', default=True, help='Sample key counts and memory per prefix')
+        @click.option('--max-keys', default=10000, help='Maximum number of keys to sample')
+        @click.option('--depth', default=1, help='Number of key segments used as prefix')
+        @click.option('--reset', is_flag=True, help='Reset the counters after reporting them')
+        def stats_command(keyspace, max_keys, depth, reset):
+            """Report cache hit ratios, recompute times, circuit breakers and memory usage"""
+            stats = CacheStats(state.options["cache_stats_key"])
+            click.echo("%-50s %10s %10s %7s %8s %12s %12s" % ("cache", "hits", "misses", "ratio", "errors",
+                "avg compute", "avg size"))
+            for name, counters in stats.read(state.cache_connection).items():
+                lookups = counters['hits'] + counters['misses']
+                click.echo("%-50s %10d %10d %6.1f%% %8d %10.1fms %11dB" % (name, counters['hits'], counters['misses'],
+                    counters['hits'] * 100.0 / lookups if lookups else 0, counters['errors'],
+                    counters['recompute_time'] * 1000.0 / counters['misses'] if counters['misses'] else 0,
+                    counters['value_size'] / counters['writes'] if counters['writes'] else 0))
+            breakers = stats.read_breakers(state.cache_connection)
+            if breakers:
+                click.echo("\n%-40s %10s %10s %10s %10s %10s" % ("worker circuit breaker", "state", "failures",
+                    "opened", "skipped", "updated"))
+                for worker, metrics in breakers.items():
+                    click.echo("%-40s %10s %10d %10d %10d %9ds" % (worker, metrics['state'], metrics['failures'],
+                        metrics['opened_count'], metrics['skipped_count'], time.time() - metrics['updated_at']))
+            if reset:
+                stats.reset(state.cache_connection)
+            if not keyspace:
+                return
+            dbsize = state.cache_connection.dbsize()
+            scanned, prefixes = sample_keyspace(state.cache_connection, max_keys, depth)
+            click.echo("\nSampled %d keys out of %d" % (scanned, dbsize))
+            click.echo("%-50s %10s %14s %12s" % ("prefix", "keys", "memory", "avg memory"))
+            for prefix, usage in sorted(prefixes.items(), key=lambda i: i[1]['memory'], reverse=True):
+                click.echo("%-50s %10d %13dB %11dB" % (prefix, usage['keys'], usage['memory'],
+                    usage['memory'] / usage['keys']))
+
+        @app.cli.command('redis-cache-warm')
+        @click.argument('model')
+        @click.argument('names', nargs=-1, required=True)
+        @click.option('--filter', help='SQL condition to select the rows')
+        @click.option('--chunk-size', default=500, help='Number of rows loaded and written at once')
+        @click.option('--workers', default=1, help='Number of threads computing the values')
+        def warm_command(model, names, filter, chunk_size, workers):
+            """Compute and store cached properties of all the rows of a model"""
+            model = resolve_model(model)
+            query = model.query
+            if filter:
+                query = query.filter(text(filter))
+            start = time.time()
+            with click.progressbar(length=query.count(), label='Warming %s' % model.__name__) as bar:
+                count = warm_redis_cached(model, names, filter, chunk_size, workers, progress=bar.update)
+            click.echo("Warmed %d objects in %.1fs" % (count, time.time() - start))
+
 
 def get_current_redis():
     return get_extension_state('frasco_redis').connection
 
+
+def get_redis_connection(name=None, binary=False, app=None):
+    return get_extension_state('frasco_redis', app=app).get_connection(name, binary)
+
 redis = LocalProxy(get_current_redis)
@@ -0,0 +1,191 @@
+from frasco.ext import get_extension_state, has_extension
+from collections import OrderedDict
+from .breaker import guard_redis_call, guard_async_redis_call
+import threading
+import logging
+import time
+import os
+
+
+__all__ = ('LocalCache', 'get_local_cache', 'local_cache_invalidate', 'async_local_cache_invalidate')
+
+
+logger = logging.getLogger('frasco.redis')
+
+
+class LocalCache(object):
+    """Per-worker in-process LRU cache used as a first tier in front of redis.
+    Raw redis values are stored so that each hit still goes through the caller's
+    deserialization (no shared mutable objects between requests).
+    Invalidations are broadcast to other workers using a redis pub/sub channel. While the
+    subscription to this channel is lost, the cache is empty and must not be used.
+    """
+    def __init__(self, max_items=1000, max_memory=None, ttl=60, channel=None, reconnect_interval=1):
+        self.max_items = max_items
+        self.max_memory = max_memory
+        self.ttl = ttl
+        self.channel = channel
+        self.reconnect_interval = reconnect_interval
+        self.stats = {}
+        self._lock = threading.RLock()
+        self._listen_lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._items = OrderedDict() # key -> (value, expires_at, size)
+        self._memory = 0
+        self._pid = os.getpid()
+        self._listener = None
+        self._disconnected = False
+
+    def _check_pid(self):
+        # the cache and the listener thread do not survive a fork
+        if self._pid != os.getpid():
+            with self._lock:
+                self._reset()
+
+    def _count(self, name, stat):
+        counters = self.stats.setdefault(name, {'hits': 0, 'misses': 0})
+        counters[stat] += 1
+
+    def get(self, key, name=None):
+        """Returns the raw value or None if it is not in the cache"""
+        self._check_pid()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[1] is not None and item[1] < time.time():
+                self._remove(key)
+                item = None
+            if item is None:
+                self._count(name, 'misses')
+                return None
+            self._items.move_to_end(key)
+            self._count(name, 'hits')
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+        if value is None:
+            return
+        self._check_pid()
+        if self.ttl and (ttl is None or ttl > self.ttl):
+            ttl = self.ttl
+        size = len(value) if isinstance(value, (str, bytes)) else 0
+        if self.max_memory and size > self.max_memory:
+            return
+        with self._lock:
+            self._remove(key)
+            self._items[key] = (value, time.time() + ttl if ttl else None, size)
+            self._memory += size
+            while self._items and (len(self._items) > self.max_items or \
+                  (self.max_memory and self._memory > self.max_memory)):
+                self._remove(next(iter(self._items)))
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._memory -= item[2]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._memory = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def memory(self):
+        return self._memory
+
+    def invalidate(self, key, redis):
+        """Evicts the key from this worker and from all other workers"""
+        self.delete(key)
+        if self.channel:
+            redis.publish(self.channel, key)
+
+    async def async_invalidate(self, key, redis):
+        """Same as invalidate() using a redis.asyncio client"""
+        self.delete(key)
+        if self.channel:
+            await redis.publish(self.channel, key)
+
+    def has_listener(self):
+        self._check_pid()
+        return not self.channel or self._listener is not None
+
+    def is_listening(self):
+        """Returns whether invalidations from other workers are being received"""
+        return self.has_listener() and not self._disconnected
+
+    def listen(self, redis):
+        """Starts (once per process) the thread receiving invalidations from other workers.
+        Connection errors are raised when subscribing, the thread then reconnects by itself.
+        """
+        if self.has_listener():
+            return
+        with self._listen_lock:
+            if self._listener is not None:
+                return
+            pubsub = redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(**{self.channel: self._on_invalidate_message})
+            except Exception:
+                pubsub.close()
+                raise
+            # called on each reconnection, after the channel has been subscribed again
+            pubsub.connection.register_connect_callback(self._on_listener_connect)
+            self._listener = pubsub.run_in_thread(sleep_time=1, daemon=True, exception_handler=self._on_listener_error)
+            logger.debug('Listening for local cache invalidations on %s' % self.channel)
+
+    def _on_listener_error(self, exc, pubsub, thread):
+        if not isinstance(exc, Exception):
+            raise exc
+        if not self._disconnected:
+            logger.warning('Lost the local cache invalidations subscription (%s), not using the local cache until it is back' % exc)
+        # invalidations are missed until the subscription is back
+        self._disconnected = True
+        self.clear()
+        time.sleep(self.reconnect_interval)
+
+    def _on_listener_connect(self, connection):
+        if self._disconnected:
+            self.clear()
+            self._disconnected = False
+            logger.warning('Local cache invalidations subscription is back')
+
+    def _on_invalidate_message(self, message):
+        key = message['data']
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        self.delete(key)
+
+
+def get_local_cache():
+    """Returns the LocalCache of the current app, or None if invalidations from other workers
+    cannot be received (the local cache is then not used)
+    """
+    if not has_extension('frasco_redis'):
+        return None
+    state = get_extension_state('frasco_redis')
+    local_cache = state.local_cache
+    if not local_cache.has_listener():
+        guard_redis_call(local_cache.listen, state.cache_connection)
+    if not local_cache.is_listening():
+        return None
+    return local_cache
+
+
+def local_cache_invalidate(key):
+    if has_extension('frasco_redis'):
+        state = get_extension_state('frasco_redis')
+        guard_redis_call(state.local_cache.invalidate, key, state.cache_connection)
+
+
+async def async_local_cache_invalidate(key):
+    if has_extension('frasco_redis'):
+        state = get_extension_state('frasco_redis')
+        await guard_async_redis_call(state.local_cache.async_invalidate, key, state.get_cache_async_connection())
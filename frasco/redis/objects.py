@@ -1,6 +1,7 @@
 from flask import json
 from frasco.ext import get_extension_state
 from .ext import redis as current_app_redis
+from .codecs import get_codec
 
 
 __all__ = ('PartialObject', 'RedisHash', 'JSONRedisHash', 'RedisList', 'JSONRedisList', 'RedisSet', 'JSONRedisSet')
@@ -29,11 +30,29 @@ class PartialObject(object):
 
 
 class RedisObject(object):
-    def __init__(self, key, serializer=None, coerce=None, redis=None):
+    def __init__(self, key, serializer=None, coerce=None, redis=None, codec=None, page_size=100):
         self.key = key
-        self.serializer = serializer
+        self.page_size = page_size
+        self.codec = get_codec(codec) if codec else None
+        self.serializer = self.codec or serializer
         self.coerce = coerce
-        self.redis = redis or current_app_redis
+        self._redis = redis
+
+    @property
+    def redis(self):
+        if self._redis and not isinstance(self._redis, str):
+            return self._redis
+        if not self._redis and not self.codec:
+            return current_app_redis
+        # redis can also be the name of a connection, resolved when used so that objects
+        # can be created outside of an app context
+        return get_extension_state('frasco_redis').get_connection(self._redis, binary=bool(self.codec))
+
+    def _decode_name(self, name):
+        # field names are returned as bytes by the binary connection
+        if isinstance(name, bytes):
+            return name.decode('utf-8')
+        return name
 
     def _to_redis(self, value):
         if self.serializer:
@@ -67,25 +86,38 @@ class RedisHash(RedisObject):
         return self.redis.hdel(self.key, key)
 
     def __contains__(self, key):
-        return key in self.keys()
+        return self.redis.hexists(self.key, key)
+
+    def __iter__(self):
+        return self.scan_keys()
+
+    def __len__(self):
+        return self.redis.hlen(self.key)
 
     def get(self, key):
         return self._from_redis(self.redis.hget(self.key, key))
 
     def keys(self):
-        return self.redis.hkeys(self.key)
+        return [self._decode_name(k) for k in self.redis.hkeys(self.key)]
 
     def items(self):
-        return {k: self._from_redis(v) for k, v in self.redis.hgetall(self.key).items()}
+        return {self._decode_name(k): self._from_redis(v) for k, v in self.redis.hgetall(self.key).items()}
 
     def values(self):
-        return list(self.items().values())
+        return [self._from_redis(v) for v in self.redis.hvals(self.key)]
+
+    def scan_items(self, match=None, page_size=None):
+        """Iterates over the items using HSCAN, fetching page_size fields per round trip"""
+        for k, v in self.redis.hscan_iter(self.key, match=match, count=page_size or self.page_size):
+            yield self._decode_name(k), self._from_redis(v)
+
+    def scan_keys(self, match=None, page_size=None):
+        for k, _ in self.scan_items(match, page_size):
+            yield k
 
     def update(self, dct):
-        pipe = self.redis.pipeline()
-        for k, v in dct.items():
-            pipe.hset(self.key, k, self._to_redis(v))
-        pipe.execute()
+        if dct:
+            self.redis.hset(self.key, mapping={k: self._to_redis(v) for k, v in dct.items()})
 
 
 class JSONRedisHash(RedisHash):
@@ -100,10 +132,19 @@ class RedisList(RedisObject):
 
     def __getitem__(self, index):
         if isinstance(index, slice):
-            if slice.step is not None:
-                return [self[i] for i in range(*index.indices(len(self)))]
+            if index.step not in (None, 1):
+                # bounds are relative to the direction of the step, they are normalized like python lists do
+                indices = range(*index.indices(len(self)))
+                if not indices:
+                    return []
+                lower = min(indices[0], indices[-1])
+                values = self.redis.lrange(self.key, lower, max(indices[0], indices[-1]))
+                return [self._from_redis(values[i - lower]) for i in indices]
+            if index.stop == 0:
+                return []
+            # LRANGE includes the stop index
             return [self._from_redis(v) for v in \
-                self.redis.lrange(self.key, slice.start or 0, slice.stop or -1)]
+                self.redis.lrange(self.key, index.start or 0, index.stop - 1 if index.stop is not None else -1)]
         elif isinstance(index, int):
             return self._from_redis(self.redis.lindex(self.key, index))
         else:
@@ -117,16 +158,15 @@ class RedisList(RedisObject):
             yield self._from_redis(value)
 
     def __contains__(self, value):
-        return value in list(self)
+        return self.redis.lpos(self.key, self._to_redis(value)) is not None
 
     def append(self, value):
         self.redis.rpush(self.key, self._to_redis(value))
 
     def extend(self, lst):
-        pipe = self.redis.pipeline()
-        for v in lst:
-            pipe.rpush(self.key, self._to_redis(v))
-        pipe.execute()
+        values = [self._to_redis(v) for v in lst]
+        if values:
+            self.redis.rpush(self.key, *values)
 
     def remove(self, value):
         self.redis.lrem(self.key, 1, self._to_redis(value))
@@ -147,16 +187,22 @@ class RedisSet(RedisObject):
         return self.redis.scard(self.key)
 
     def __contains__(self, value):
-        return self.redis.ismember(self.key, value)
+        return self.redis.sismember(self.key, self._to_redis(value))
+
+    def scan(self, match=None, page_size=None):
+        """Iterates over the members using SSCAN, fetching page_size members per round trip.
+        Members may be returned more than once if the set is modified during the iteration.
+        """
+        for value in self.redis.sscan_iter(self.key, match=match, count=page_size or self.page_size):
+            yield self._from_redis(value)
 
     def add(self, value):
         self.redis.sadd(self.key, self._to_redis(value))
 
     def update(self, lst):
-        pipe = self.redis.pipeline()
-        for v in lst:
-            pipe.sadd(self.key, self._to_redis(v))
-        pipe.execute()
+        values = [self._to_redis(v) for v in lst]
+        if values:
+            self.redis.sadd(self.key, *values)
 
     def remove(self, value):
         self.redis.srem(self.key, self._to_redis(value))
@@ -167,7 +213,7 @@ class RedisSet(RedisObject):
     def move(self, destination, value):
         if isinstance(destination, RedisSet):
             destination = destination.key
-        self.redis.smove(self.key, self.destination, self._to_redis(value))
+        self.redis.smove(self.key, destination, self._to_redis(value))
 
     def diff(self, *other_keys):
         return self._cmp('sdiff', other_keys)
@@ -176,7 +222,7 @@ class RedisSet(RedisObject):
         return self._cmp('sinter', other_keys)
 
     def union(self, *other_keys):
-        return self._cmp('union', other_keys)
+        return self._cmp('sunion', other_keys)
 
     def _cmp(self, op, other_keys):
         keys = []
@@ -0,0 +1,204 @@
+from concurrent.futures import ThreadPoolExecutor
+import bisect
+import hashlib
+import itertools
+import os
+
+
+__all__ = ('HashRing', 'ShardedRedis', 'ShardedPipeline')
+
+
+# commands taking multiple keys as positional arguments, results are summed
+MULTI_KEY_COMMANDS = ('delete', 'unlink', 'exists', 'touch')
+# commands executed on the first shard
+UNSHARDED_COMMANDS = ('publish', 'pubsub')
+# scripts are executed on the shard of their first key
+SCRIPT_COMMANDS = ('eval', 'evalsha')
+
+
+def _hash(key):
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    return int.from_bytes(hashlib.md5(key).digest()[:8], 'big')
+
+
+class HashRing(object):
+    """Consistent hashing ring with virtual nodes. Nodes are identified by their
+    name (eg: their url) so that adding or removing a node only moves the keys of this node.
+    """
+    def __init__(self, nodes, virtual_nodes=160):
+        self.nodes = list(nodes)
+        ring = sorted((_hash('%s#%s' % (node, i)), index)
+            for index, node in enumerate(self.nodes) for i in range(virtual_nodes))
+        self._hashes = [h for h, _ in ring]
+        self._indexes = [index for _, index in ring]
+
+    def get_index(self, key):
+        pos = bisect.bisect(self._hashes, _hash(key))
+        return self._indexes[pos % len(self._hashes)]
+
+    def get_node(self, key):
+        return self.nodes[self.get_index(key)]
+
+
+class ShardedRedis(object):
+    """Routes commands to a set of redis clients using consistent hashing on their first
+    argument (the key). Only suited for data which can be partitioned by key like cache values.
+    Multi-key commands are split per shard and executed in parallel.
+    """
+    def __init__(self, clients, nodes=None, virtual_nodes=160):
+        self.clients = list(clients)
+        self.ring = HashRing(nodes or [str(i) for i in range(len(self.clients))], virtual_nodes)
+        self._executor = None
+        self._pid = None
+
+    def get_client(self, key):
+        return self.clients[self.ring.get_index(key)]
+
+    def group_keys(self, keys):
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.ring.get_index(key), []).append(key)
+        return groups
+
+    def map_shards(self, func, items):
+        """Calls func(client, arg) for each (shard index, arg) item, in parallel when
+        multiple shards are involved. Returns the results in the same order.
+        """
+        items = list(items)
+        if len(items) == 1:
+            index, arg = items[0]
+            return [func(self.clients[index], arg)]
+        if self._executor is None or self._pid != os.getpid():
+            # threads are not inherited by forked processes
+            self._executor = ThreadPoolExecutor(max_workers=len(self.clients))
+            self._pid = os.getpid()
+        return list(self._executor.map(lambda item: func(self.clients[item[0]], item[1]), items))
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def command(key, *args, **kwargs):
+            return getattr(self.get_client(key), name)(key, *args, **kwargs)
+        return command
+
+    def mget(self, keys, *args):
+        keys = list(keys) + list(args)
+        groups = list(self.group_keys(keys).items())
+        values = {}
+        for (_, group), results in zip(groups, self.map_shards(lambda client, group: client.mget(group), groups)):
+            values.update(zip(group, results))
+        return [values[key] for key in keys]
+
+    def _multi_key_command(self, name, keys):
+        groups = self.group_keys(keys).items()
+        return sum(self.map_shards(lambda client, group: getattr(client, name)(*group), groups))
+
+    def delete(self, *keys):
+        return self._multi_key_command('delete', keys)
+
+    def unlink(self, *keys):
+        return self._multi_key_command('unlink', keys)
+
+    def exists(self, *keys):
+        return self._multi_key_command('exists', keys)
+
+    def touch(self, *keys):
+        return self._multi_key_command('touch', keys)
+
+    def eval(self, script, numkeys, *keys_and_args):
+        return self.get_client(keys_and_args[0]).eval(script, numkeys, *keys_and_args)
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        return self.get_client(keys_and_args[0]).evalsha(sha, numkeys, *keys_and_args)
+
+    def publish(self, channel, message):
+        return self.clients[0].publish(channel, message)
+
+    def pubsub(self, **kwargs):
+        return self.clients[0].pubsub(**kwargs)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return ShardedPipeline(self, transaction)
+
+    def scan_iter(self, *args, **kwargs):
+        return itertools.chain(*[client.scan_iter(*args, **kwargs) for client in self.clients])
+
+    def keys(self, *args, **kwargs):
+        return list(itertools.chain(*[client.keys(*args, **kwargs) for client in self.clients]))
+
+    def dbsize(self):
+        return sum(client.dbsize() for client in self.clients)
+
+    def flushdb(self, *args, **kwargs):
+        return all([client.flushdb(*args, **kwargs) for client in self.clients])
+
+
+class ShardedPipeline(object):
+    """Buffers commands and executes them using one pipeline per shard (in parallel).
+    Transactions are only atomic per shard.
+    """
+    def __init__(self, sharded, transaction=True):
+        self.sharded = sharded
+        self.transaction = transaction
+        self.commands = [] # [(parts, combine)] where parts is [(shard index, name, args, kwargs)]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def command(*args, **kwargs):
+            if name in MULTI_KEY_COMMANDS:
+                parts = [(index, name, keys, kwargs) for index, keys in self.sharded.group_keys(args).items()]
+                self.commands.append((parts, sum))
+            elif name in UNSHARDED_COMMANDS:
+                self.commands.append(([(0, name, args, kwargs)], None))
+            elif name in SCRIPT_COMMANDS:
+                self.commands.append(([(self.sharded.ring.get_index(args[2]), name, args, kwargs)], None))
+            else:
+                self.commands.append(([(self.sharded.ring.get_index(args[0]), name, args, kwargs)], None))
+            return self
+        return command
+
+    def mget(self, keys, *args):
+        keys = list(keys) + list(args)
+        groups = self.sharded.group_keys(keys)
+        parts = [(index, 'mget', (group,), {}) for index, group in groups.items()]
+        def combine(results):
+            values = {}
+            for group, group_values in zip(groups.values(), results):
+                values.update(zip(group, group_values))
+            return [values[key] for key in keys]
+        self.commands.append((parts, combine))
+        return self
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def reset(self):
+        self.commands = []
+
+    def execute(self, raise_on_error=True):
+        commands, self.commands = self.commands, []
+        shards = {} # shard index -> [(command position, part position, name, args, kwargs)]
+        for pos, (parts, _) in enumerate(commands):
+            for part_pos, (index, name, args, kwargs) in enumerate(parts):
+                shards.setdefault(index, []).append((pos, part_pos, name, args, kwargs))
+
+        def execute_shard(client, shard_commands):
+            pipe = client.pipeline(transaction=self.transaction)
+            for _, _, name, args, kwargs in shard_commands:
+                getattr(pipe, name)(*args, **kwargs)
+            return pipe.execute(raise_on_error=raise_on_error)
+
+        results = [[None] * len(parts) for parts, _ in commands]
+        items = list(shards.items())
+        for (_, shard_commands), shard_results in zip(items, self.sharded.map_shards(execute_shard, items) if items else []):
+            for (pos, part_pos, _, _, _), result in zip(shard_commands, shard_results):
+                results[pos][part_pos] = result
+        return [combine(result) if combine else result[0] for (_, combine), result in zip(commands, results)]
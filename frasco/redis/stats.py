@@ -0,0 +1,218 @@
+from frasco.ext import get_extension_state, has_extension
+from contextlib import contextmanager
+from .breaker import guard_redis_call, guard_async_redis_call
+import threading
+import socket
+import json
+import time
+import os
+
+
+__all__ = ('BufferedRedisStats', 'CacheStats', 'get_cache_stats', 'get_async_cache_stats', 'sample_keyspace')
+
+
+COUNTERS = ('hits', 'misses', 'errors', 'writes', 'recompute_time', 'value_size')
+
+
+class BufferedRedisStats(object):
+    """Counters per name which are buffered in memory and periodically added to redis hashes
+    (one per name, the names being stored in a set) so that the stats of all workers can be
+    reported together. Subclasses list their counters and the ones holding floats.
+    """
+    counters = ()
+    float_counters = ()
+
+    def __init__(self, key_prefix, flush_interval=10):
+        self.key_prefix = key_prefix
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._reset_buffers()
+        self._last_flush = time.time()
+        self._pid = os.getpid()
+
+    def _reset_buffers(self):
+        self._counters = {}
+
+    def _take_buffers(self):
+        counters = self._counters
+        self._counters = {}
+        return counters
+
+    def _check_pid(self):
+        # must be called with the lock held
+        if self._pid != os.getpid():
+            # counters inherited from the parent process were already accounted
+            self._reset_buffers()
+            self._pid = os.getpid()
+
+    def incr(self, name, counter, amount=1):
+        with self._lock:
+            self._check_pid()
+            counters = self._counters.setdefault(name, {})
+            counters[counter] = counters.get(counter, 0) + amount
+
+    def should_flush(self):
+        return time.time() - self._last_flush >= self.flush_interval
+
+    def maybe_flush(self, redis):
+        if self.should_flush():
+            self.flush(redis)
+
+    def flush(self, redis):
+        pipe = self._make_flush_pipeline(redis)
+        if pipe is not None:
+            pipe.execute()
+
+    async def async_flush(self, redis):
+        """Same as flush() using a redis.asyncio client"""
+        pipe = self._make_flush_pipeline(redis)
+        if pipe is not None:
+            await pipe.execute()
+
+    def _make_flush_pipeline(self, redis):
+        with self._lock:
+            buffers = self._take_buffers()
+            self._last_flush = time.time()
+        pipe = redis.pipeline(transaction=False)
+        if not self._queue_flush(pipe, buffers):
+            return None
+        return pipe
+
+    def _queue_flush(self, pipe, counters):
+        """Queues the commands saving the buffers taken by _take_buffers(), returns False if there are none"""
+        if not counters:
+            return False
+        pipe.sadd(self.key_prefix, *counters.keys())
+        for name, values in counters.items():
+            key = '%s:%s' % (self.key_prefix, name)
+            for counter, amount in values.items():
+                if isinstance(amount, float):
+                    pipe.hincrbyfloat(key, counter, amount)
+                else:
+                    pipe.hincrby(key, counter, amount)
+        return True
+
+    def _read_names(self, redis):
+        return sorted(n.decode('utf-8') if isinstance(n, bytes) else n for n in redis.smembers(self.key_prefix))
+
+    def read(self, redis):
+        """Returns the counters per name"""
+        names = self._read_names(redis)
+        pipe = redis.pipeline(transaction=False)
+        for name in names:
+            pipe.hgetall('%s:%s' % (self.key_prefix, name))
+        stats = {}
+        for name, values in zip(names, pipe.execute()):
+            stats[name] = dict((c, 0.0 if c in self.float_counters else 0) for c in self.counters)
+            for counter, value in values.items():
+                if isinstance(counter, bytes):
+                    counter = counter.decode('utf-8')
+                stats[name][counter] = float(value) if counter in self.float_counters else int(value)
+        return stats
+
+    def reset(self, redis):
+        redis.delete(self.key_prefix, *['%s:%s' % (self.key_prefix, n) for n in self._read_names(redis)])
+
+
+class CacheStats(BufferedRedisStats):
+    """Counts hits, misses, errors, recompute time and serialized size per logical cache name.
+    When a circuit breaker is provided, its metrics are saved with each flush under a key per worker.
+    """
+    counters = COUNTERS
+    float_counters = ('recompute_time',)
+
+    def __init__(self, key_prefix='frasco:cache_stats', flush_interval=10, breaker=None):
+        super(CacheStats, self).__init__(key_prefix, flush_interval)
+        self.breaker = breaker
+
+    def incr(self, name, counter, amount=1):
+        super(CacheStats, self).incr(name or 'unnamed', counter, amount)
+
+    def hit(self, name):
+        self.incr(name, 'hits')
+
+    def miss(self, name):
+        self.incr(name, 'misses')
+
+    def error(self, name):
+        self.incr(name, 'errors')
+
+    def write(self, name, value):
+        self.incr(name, 'writes')
+        if isinstance(value, (str, bytes)):
+            self.incr(name, 'value_size', len(value))
+
+    @contextmanager
+    def recompute(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.incr(name, 'recompute_time', time.time() - start)
+
+    def _queue_flush(self, pipe, counters):
+        if self.breaker is not None:
+            # expires when the worker stops reporting
+            pipe.setex('%s:breaker:%s:%s' % (self.key_prefix, socket.gethostname(), os.getpid()),
+                max(int(self.flush_interval) * 6, 60), json.dumps(dict(self.breaker.metrics(), updated_at=time.time())))
+        return super(CacheStats, self)._queue_flush(pipe, counters) or self.breaker is not None
+
+    def read_breakers(self, redis):
+        """Returns the last circuit breaker metrics reported by each worker (keyed by "hostname:pid")"""
+        prefix = '%s:breaker:' % self.key_prefix
+        keys = sorted(k.decode('utf-8') if isinstance(k, bytes) else k for k in redis.scan_iter(match=prefix + '*'))
+        if not keys:
+            return {}
+        return dict((key[len(prefix):], json.loads(value)) for key, value in zip(keys, redis.mget(keys)) if value)
+
+
+def get_cache_stats():
+    """Returns the CacheStats object of the current app, or None if stats are disabled"""
+    if not has_extension('frasco_redis'):
+        return None
+    state = get_extension_state('frasco_redis')
+    if state.cache_stats:
+        guard_redis_call(state.cache_stats.maybe_flush, state.cache_connection)
+    return state.cache_stats
+
+
+async def get_async_cache_stats():
+    """Same as get_cache_stats() but flushes the counters using a redis.asyncio client"""
+    if not has_extension('frasco_redis'):
+        return None
+    state = get_extension_state('frasco_redis')
+    if state.cache_stats and state.cache_stats.should_flush():
+        await guard_async_redis_call(state.cache_stats.async_flush, state.get_cache_async_connection())
+    return state.cache_stats
+
+
+def sample_keyspace(redis, max_keys=10000, depth=1, separator=':', match=None, batch_size=500):
+    """Scans up to max_keys keys and returns their count and memory usage grouped by
+    prefix (the first depth segments of the key)
+    """
+    prefixes = {}
+    scanned = 0
+    batch = []
+
+    def process_batch():
+        pipe = redis.pipeline(transaction=False)
+        for key in batch:
+            pipe.memory_usage(key)
+        for key, memory in zip(batch, pipe.execute()):
+            if isinstance(key, bytes):
+                key = key.decode('utf-8', 'replace')
+            stats = prefixes.setdefault(separator.join(key.split(separator)[:depth]), {'keys': 0, 'memory': 0})
+            stats['keys'] += 1
+            stats['memory'] += memory or 0
+        del batch[:]
+
+    for key in redis.scan_iter(match=match, count=batch_size):
+        batch.append(key)
+        scanned += 1
+        if len(batch) >= batch_size:
+            process_batch()
+        if scanned >= max_keys:
+            break
+    if batch:
+        process_batch()
+    return scanned, prefixes
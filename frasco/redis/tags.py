@@ -0,0 +1,193 @@
+from frasco.ext import get_extension_state, has_extension
+from frasco.models.events import after_modified_objs_commit
+from sqlalchemy import inspect as sqla_inspect
+from frasco.utils import unknown_value
+from .breaker import guard_redis_call
+from .chunks import get_chunk_keys
+import itertools
+import logging
+import math
+
+
+__all__ = ('model_cache_tag', 'format_cache_tags', 'tag_cache_key', 'async_tag_cache_key', 'invalidate_cache_tags',
+           'register_model_cache_tags_listeners')
+
+
+logger = logging.getLogger('frasco.redis')
+
+
+# KEYS[1] is the tag index, ARGV[1] the cache key and ARGV[2] its ttl (0 if it never expires).
+# The index expires with the longest lived key it contains so that it does not keep
+# the keys which expired by themselves forever.
+TAG_CACHE_KEY_SCRIPT = """
+local current = redis.call('ttl', KEYS[1])
+redis.call('sadd', KEYS[1], ARGV[1])
+local ttl = tonumber(ARGV[2])
+if ttl <= 0 then
+  redis.call('persist', KEYS[1])
+elseif current == -2 or (current >= 0 and current < ttl) then
+  redis.call('expire', KEYS[1], ttl)
+end
+"""
+
+
+def model_cache_tag(obj):
+    """Returns the tag of a model instance, eg: "User:42"
+    """
+    identity = sqla_inspect(obj).identity
+    if identity is None:
+        return None
+    return '%s:%s' % (obj.__class__.__name__, ':'.join(str(v) for v in identity))
+
+
+def format_cache_tags(tags):
+    """Normalizes a list of tags which can be strings or model instances"""
+    formatted = []
+    for tag in tags or []:
+        if not isinstance(tag, str):
+            tag = model_cache_tag(tag)
+        if tag:
+            formatted.append(tag)
+    return formatted
+
+
+def _tag_key(state, tag):
+    return '%s%s' % (state.options['cache_tag_prefix'], tag)
+
+
+def _tagged_connections_key(state):
+    # set on the cache connection of the other connections holding tag indexes
+    return '%s__connections__' % state.options['cache_tag_prefix']
+
+
+def _get_tagged_connection_name(state, redis):
+    """Returns the name of the connection holding the key (and its tag indexes) or None
+    for the cache connection
+    """
+    if redis is None:
+        return None
+    name = state.get_connection_name(redis)
+    if name == state.options['cache_connection']:
+        return None
+    # the default connection is stored as an empty name
+    return name or ''
+
+
+def tag_cache_key(key, tags, pipe=None, ttl=None, redis=None):
+    """Adds key to the index of each tag. ttl is the ttl of key, indexes expire after their
+    longest lived key. redis is the connection holding key (defaults to the cache connection),
+    indexes are stored on the same connection. When pipe is provided, commands are added to it.
+    """
+    tags = format_cache_tags(tags)
+    if not tags:
+        return
+    state = get_extension_state('frasco_redis')
+    name = _get_tagged_connection_name(state, redis)
+    if name is not None and name not in state.tagged_connections:
+        state.cache_connection.sadd(_tagged_connections_key(state), name)
+        state.tagged_connections.add(name)
+    execute = pipe is None
+    if execute:
+        pipe = (redis or state.cache_connection).pipeline(transaction=False)
+    _queue_tag_commands(pipe, state, key, tags, ttl)
+    if execute:
+        pipe.execute()
+
+
+async def async_tag_cache_key(key, tags, pipe=None, ttl=None, redis=None):
+    """Same as tag_cache_key() using a redis.asyncio client"""
+    tags = format_cache_tags(tags)
+    if not tags:
+        return
+    state = get_extension_state('frasco_redis')
+    name = _get_tagged_connection_name(state, redis)
+    if name is not None and name not in state.tagged_connections:
+        await state.get_cache_async_connection().sadd(_tagged_connections_key(state), name)
+        state.tagged_connections.add(name)
+    execute = pipe is None
+    if execute:
+        pipe = (redis or state.get_cache_async_connection()).pipeline(transaction=False)
+    _queue_tag_commands(pipe, state, key, tags, ttl)
+    if execute:
+        await pipe.execute()
+
+
+def _queue_tag_commands(pipe, state, key, tags, ttl=None):
+    ttl = int(math.ceil(ttl)) if ttl else 0
+    for tag in tags:
+        pipe.eval(TAG_CACHE_KEY_SCRIPT, 1, _tag_key(state, tag), key, ttl)
+
+
+def invalidate_cache_tags(*tags):
+    """Deletes all the keys tagged with any of the tags (and their chunks if they were stored in chunks)
+    on the cache connection and on the other connections where keys were tagged
+    """
+    tags = format_cache_tags(tags)
+    if not tags:
+        return
+    state = get_extension_state('frasco_redis')
+    tag_keys = [_tag_key(state, tag) for tag in tags]
+    keys, names = _pop_tagged_keys(state.cache_connection, tag_keys, _tagged_connections_key(state))
+    deleted_keys = set(keys)
+    for name in names:
+        name = name.decode('utf-8') if isinstance(name, bytes) else name
+        connection = state.get_connection(name or None)
+        other_keys = _pop_tagged_keys(connection, tag_keys)[0]
+        if other_keys:
+            pipe = connection.pipeline(transaction=False)
+            _queue_delete_keys(pipe, state.get_connection(name or None, binary=True), other_keys)
+            pipe.execute()
+            deleted_keys.update(other_keys)
+    if not deleted_keys:
+        return
+    pipe = state.cache_connection.pipeline(transaction=False)
+    _queue_delete_keys(pipe, state.cache_binary_connection, keys)
+    if state.local_cache.channel:
+        local_cache = state.local_cache
+        for key in deleted_keys:
+            local_cache.delete(key)
+            pipe.publish(local_cache.channel, key)
+    pipe.execute()
+
+
+def _pop_tagged_keys(connection, tag_keys, connections_key=None):
+    """Returns the keys of the indexes and the names of the tagged connections (read from
+    connections_key when provided), the indexes are deleted
+    """
+    # read and clear the indexes atomically so that keys tagged concurrently are not lost
+    pipe = connection.pipeline(transaction=True)
+    for tag_key in tag_keys:
+        pipe.smembers(tag_key)
+    if connections_key:
+        pipe.smembers(connections_key)
+    pipe.delete(*tag_keys)
+    rv = pipe.execute()[:-1]
+    names = rv.pop() if connections_key else ()
+    return set(itertools.chain(*rv)), names
+
+
+def _queue_delete_keys(pipe, binary_connection, keys):
+    if keys:
+        # values can be binary, manifests are detected using the binary connection
+        pipe.delete(*keys, *get_chunk_keys(binary_connection, keys))
+
+
+_listeners_registered = False
+
+
+def register_model_cache_tags_listeners():
+    """Invalidates the tags of modified and deleted model instances after each commit
+    """
+    global _listeners_registered
+    if _listeners_registered:
+        return
+    _listeners_registered = True
+    after_modified_objs_commit('cache_tags_to_invalidate', _invalidate_committed_objs_tags)
+
+
+def _invalidate_committed_objs_tags(objs):
+    if not has_extension('frasco_redis'):
+        return
+    tags = format_cache_tags(objs)
+    if tags and guard_redis_call(invalidate_cache_tags, *tags) is unknown_value:
+        logger.error('Redis is unavailable, cache tags were not invalidated: %s' % ', '.join(sorted(tags)))
@@ -1,14 +1,197 @@
 from flask import current_app
-from frasco.templating import jinja_fragment_extension
+from frasco.templating.extensions import parse_block_signature
 from frasco.ext import get_extension_state
+from jinja2 import nodes, Undefined
+from jinja2.ext import Extension
+from jinja2.environment import TemplateExpression
+from .utils import redis_get_set, _call_callback
+from .stats import get_cache_stats
+from .tags import tag_cache_key
+from .codecs import compress, decompress
+from .breaker import guard_redis_call
+from frasco.utils import unknown_value
+import hashlib
+import weakref
+import copy
 
 
-@jinja_fragment_extension("cache")
-def CacheFragmentExtension(caller=None, key=None, timeout=None):
-    state = get_extension_state('frasco_redis')
-    rv = state.connection.get(key)
-    if rv is None:
+__all__ = ('CacheFragmentExtension', 'build_fragment_key', 'encode_fragment', 'decode_fragment')
+
+
+# cache blocks nested in these tags may depend on local variables and cannot be prefetched
+NON_PREFETCHABLE_TAGS = set(['for', 'macro', 'call', 'with', 'filter'])
+
+
+def _fragment_key_part(value):
+    cache_id = getattr(value, '__redis_cache_id__', None)
+    if cache_id:
+        return str(cache_id())
+    cache_id = getattr(value, 'cache_id', None)
+    if cache_id is not None:
+        # CachableModelMixin: cache_id is rotated when the object is modified
+        return '%s:%s:%s' % (value.__class__.__name__, getattr(value, 'id', ''), cache_id)
+    return str(value)
+
+
+def build_fragment_key(template_name, lineno, args=None, version=None):
+    """Builds the key of a {% cache %} block from its position and its arguments
+    """
+    parts = [_fragment_key_part(arg) for arg in (args or [])]
+    digest = hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+    key = 'fragment:%s:%s:%s' % (template_name or '__string__', lineno, digest)
+    if version is not None:
+        key = 'v%s:%s' % (version, key)
+    return key
+
+
+def _resolve_legacy_args(args, key=None, timeout=None):
+    # {% cache "key", timeout %} used to take the key and the timeout as positional arguments
+    if key is None and 1 <= len(args) <= 2 and isinstance(args[0], str) and \
+       (len(args) == 1 or (isinstance(args[1], int) and not isinstance(args[1], bool))):
+        return args[0], (args[1] if len(args) == 2 and timeout is None else timeout)
+    return key, timeout
+
+
+def encode_fragment(html, compress_threshold=None):
+    data = html.encode('utf-8')
+    if compress_threshold is None:
+        return data
+    return compress(data, compress_threshold)
+
+
+def decode_fragment(data):
+    if isinstance(data, str):
+        return data
+    return decompress(data).decode('utf-8')
+
+
+class CacheFragmentExtension(Extension):
+    """Caches the content of a block in redis:
+
+        {% cache user, project %}...{% endcache %}
+        {% cache key="sidebar:" ~ user.id, timeout=600 %}...{% endcache %}
+        {% cache project, tags=[project] %}...{% endcache %}
+        {% cache "sidebar:" ~ user.id, 600 %}...{% endcache %}
+
+    Unless a key is provided, it is derived from the template name, the position of
+    the block and the arguments (using the cache_id of models). For backward compatibility,
+    a single string argument optionally followed by an integer is used as the key and
+    the timeout.
+    On the first cache block of a template, the keys of all the blocks which can be
+    computed from the template context are fetched using a single MGET.
+    """
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        super(CacheFragmentExtension, self).__init__(environment)
+        self._prefetchable = {}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args, kwargs = parse_block_signature(parser)
+        options = dict((kw.key, kw.value) for kw in kwargs)
+        if parser.name and 'stampede_protection' not in options and \
+           not NON_PREFETCHABLE_TAGS.intersection(parser._tag_stack):
+            self._register_prefetchable(parser, lineno, args, options)
+
+        call = self.call_method('_render_block', [nodes.ContextReference(), nodes.Const(parser.name),
+            nodes.Const(lineno), nodes.List(args, lineno=lineno)], kwargs, lineno=lineno)
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(call, [], [], body, lineno=lineno)
+
+    def _register_prefetchable(self, parser, lineno, args, options):
+        entry = self._prefetchable.get(parser.name)
+        if entry is None or entry[0]() is not parser:
+            # the template is being (re)compiled
+            entry = self._prefetchable[parser.name] = (weakref.ref(parser), [])
+        expr = nodes.List([options.get('key', nodes.Const(None)), options.get('version', nodes.Const(None)),
+            nodes.Const(lineno), nodes.List(args)], lineno=lineno)
+        entry[1].append([copy.deepcopy(expr), None])
+
+    def _compile_key_expr(self, item):
+        if item[1] is None:
+            body = [nodes.Assign(nodes.Name('result', 'store'), item[0], lineno=1)]
+            item[1] = TemplateExpression(self.environment.from_string(nodes.Template(body, lineno=1)), False)
+        return item[1]
+
+    def _prefetch(self, context, template_name, state):
+        prefetched = getattr(context, '_prefetched_fragments', None)
+        if prefetched is None:
+            prefetched = context._prefetched_fragments = {'templates': set(), 'values': {}}
+        if template_name in prefetched['templates']:
+            return prefetched['values']
+        prefetched['templates'].add(template_name)
+
+        keys = []
+        context_vars = context.get_all()
+        for item in self._prefetchable.get(template_name, (None, []))[1]:
+            try:
+                key, version, lineno, args = self._compile_key_expr(item)(context_vars)
+            except Exception:
+                continue
+            if any(isinstance(v, Undefined) for v in [key, version] + list(args)):
+                continue
+            key, _ = _resolve_legacy_args(args, key)
+            if key is None:
+                key = build_fragment_key(template_name, lineno, args,
+                    version if version is not None else state.options['fragment_cache_version'])
+            if key not in prefetched['values']:
+                keys.append(key)
+
+        if len(keys) > 1:
+            try:
+                values = guard_redis_call(state.cache_binary_connection.mget, keys)
+                if values is not unknown_value:
+                    prefetched['values'].update(zip(keys, values))
+            except Exception as e:
+                current_app.log_exception(e)
+        return prefetched['values']
+
+    def _render_block(self, context, template_name, lineno, args, key=None, timeout=None,
+                      version=None, stampede_protection=False, tags=None, caller=None):
+        state = get_extension_state('frasco_redis')
+        key, timeout = _resolve_legacy_args(args, key, timeout)
+        if key is None:
+            key = build_fragment_key(template_name, lineno, args,
+                version if version is not None else state.options['fragment_cache_version'])
         timeout = timeout or state.options["fragment_cache_timeout"]
-        rv = caller()
-        state.connection.setex(key, timeout, rv)
-    return rv
+        stats_name = 'fragment:%s' % template_name
+        if stampede_protection:
+            return redis_get_set(key, caller, ttl=timeout, redis=state.cache_connection, name=stats_name,
+                stampede_protection=stampede_protection, tags=tags)
+
+        stats = get_cache_stats()
+        try:
+            prefetched = self._prefetch(context, template_name, state)
+            if key in prefetched:
+                rv = prefetched[key]
+            else:
+                rv = guard_redis_call(state.cache_binary_connection.get, key)
+        except Exception:
+            if stats:
+                stats.error(stats_name)
+            raise
+        if rv is unknown_value:
+            # redis is unavailable, render without caching
+            if stats:
+                stats.error(stats_name)
+            return caller()
+        if rv is not None:
+            if stats:
+                stats.hit(stats_name)
+            return decode_fragment(rv)
+
+        if stats:
+            stats.miss(stats_name)
+        rv = _call_callback(caller, stats, stats_name)
+        data = encode_fragment(rv, state.options["fragment_cache_compress_threshold"])
+        pipe = state.cache_binary_connection.pipeline(transaction=False)
+        pipe.setex(key, timeout, data)
+        if tags:
+            tag_cache_key(key, tags, pipe, timeout)
+        if guard_redis_call(pipe.execute) is unknown_value:
+            return rv
+        prefetched[key] = data
+        if stats:
+            stats.write(stats_name, data)
+        return rv
@@ -1,40 +1,241 @@
 from flask import current_app, json
 from frasco.utils import unknown_value
+from redis.exceptions import LockError
+from .local_cache import get_local_cache, local_cache_invalidate
+from .codecs import get_codec
+from .stats import get_cache_stats
+from .tags import tag_cache_key
+from .breaker import guard_redis_call
+from .chunks import is_chunk_manifest, write_chunked_value, read_chunked_value, delete_chunked_value
 import re
 import functools
 import inspect
 import logging
+import random
+import math
+import time
+import operator
 
 
-__all__ = ('redis_get_set', 'redis_get_set_as_json', 'build_object_key', 'redis_cached_function', 'redis_cached_function_as_json')
+__all__ = ('redis_get_set', 'redis_get_set_as_json', 'redis_invalidate_key', 'build_object_key', 'redis_cached_function',
+           'redis_cached_function_as_json')
 
 
 logger = logging.getLogger('frasco.redis')
 
 
-def redis_get_set(key, callback, ttl=None, coerce=None, serializer=None, redis=None, logging=False):
-    if not redis:
-        redis = current_app.extensions.frasco_redis.connection
-    value = redis.get(key)
+NONE_VALUE = 'None'
+
+
+def redis_get_set(key, callback, ttl=None, coerce=None, serializer=None, redis=None, logging=False,
+                  local_cache=False, name=None, stampede_protection=False, should_cache=None, codec=None, tags=None,
+                  chunk_size=None):
+    """Returns the value cached under key or calls callback() and caches its result.
+    With stampede_protection (True or a dict of options for _redis_get_set_protected()),
+    only one caller recomputes an expired value while the others get the stale one.
+    should_cache can be a callable evaluated after callback() to skip storing the result.
+    When a codec (name or object) is provided, values are stored as bytes using the binary connection.
+    tags is a list of tags (strings or model instances) which can be used to invalidate the key.
+    Values longer than chunk_size are stored in multiple keys of chunk_size (see write_chunked_value()).
+    """
+    if codec:
+        serializer, coerce = _make_codec_serializers(get_codec(codec), coerce)
+    if not redis or isinstance(redis, str):
+        # redis can also be the name of a connection
+        redis = current_app.extensions.frasco_redis.get_cache_connection(redis, binary=bool(codec))
+    if local_cache:
+        local_cache = get_local_cache()
+    log = logging or (logging is None and current_app.debug)
+    stats = get_cache_stats()
+    if stampede_protection:
+        return _redis_get_set_protected(redis, key, callback, ttl, coerce, serializer, local_cache,
+            name, should_cache, log, stats, tags, chunk_size,
+            **(stampede_protection if isinstance(stampede_protection, dict) else {}))
+    value = _get_raw_value(redis, key, ttl, local_cache, name, stats, chunk_size)
     if value is not None:
-        if logging or (logging is None and current_app.debug):
+        if log:
             logger.debug('CACHE HIT: %s' % key)
-        if value == 'None':
-            return None
-        if coerce:
-            return coerce(value)
-        return value
-    if logging or (logging is None and current_app.debug):
+        return _decode_value(value, coerce)
+    if log:
         logger.debug('CACHE MISS: %s' % key)
-    _value = value = callback()
-    if serializer:
-        _value = serializer(value)
-    if _value is None:
-        _value = 'None'
-    if ttl:
-        redis.setex(key, ttl, _value)
+    value = _call_callback(callback, stats, name)
+    if should_cache is None or should_cache():
+        _set_raw_value(redis, key, _encode_value(value, serializer), ttl, local_cache, stats, name, tags, chunk_size)
+    return value
+
+
+def _redis_get_set_protected(redis, key, callback, ttl, coerce, serializer, local_cache, name, should_cache, log,
+                             stats=None, tags=None, chunk_size=None, lock_timeout=10, wait_timeout=2, wait_interval=0.05, stale_ttl=None, early_refresh=1.0):
+    """Stampede protected version of redis_get_set().
+    Values are stored with their expiration time and computation time. They are kept in redis
+    for stale_ttl more seconds (defaults to ttl) after they expire so they can be served while
+    one caller, holding a short lock, recomputes it. Values are also refreshed early with
+    a probability increasing as the expiration time approaches (see "Optimal Probabilistic
+    Cache Stampede Prevention", Vattani et al.), early_refresh being the beta parameter.
+    """
+    raw = _get_raw_value(redis, key, ttl, local_cache, name, stats, chunk_size)
+    stale = unknown_value
+    if raw is not None:
+        expires_at, delta, payload = _unpack_protected_value(raw)
+        if payload is not unknown_value:
+            if not expires_at or time.time() - delta * early_refresh * math.log(1.0 - random.random()) < expires_at:
+                if log:
+                    logger.debug('CACHE HIT: %s' % key)
+                return _decode_value(payload, coerce)
+            stale = payload
+
+    lock = redis.lock('%s:lock' % key, timeout=lock_timeout)
+    acquired = guard_redis_call(lock.acquire, blocking=False)
+    if acquired is unknown_value:
+        lock = None # redis is unavailable, compute the value without locking
+    elif not acquired:
+        if stale is not unknown_value:
+            if log:
+                logger.debug('CACHE STALE: %s' % key)
+            return _decode_value(stale, coerce)
+        deadline = time.time() + wait_timeout
+        while time.time() < deadline:
+            time.sleep(wait_interval)
+            raw = guard_redis_call(_get_value, redis, key, chunk_size)
+            if raw is unknown_value:
+                break
+            _, _, payload = _unpack_protected_value(raw)
+            if payload is not unknown_value:
+                return _decode_value(payload, coerce)
+        lock = None # the lock holder is too slow, compute the value ourselves
+
+    if log:
+        logger.debug('CACHE MISS: %s' % key)
+    try:
+        start = time.time()
+        value = _call_callback(callback, stats, name)
+        delta = time.time() - start
+        if should_cache is None or should_cache():
+            expires_at = ''
+            redis_ttl = None
+            if ttl:
+                expires_at = time.time() + ttl
+                redis_ttl = int(ttl + (stale_ttl if stale_ttl is not None else ttl))
+            _set_raw_value(redis, key, _pack_protected_value(expires_at, delta, _encode_value(value, serializer)),
+                redis_ttl, local_cache, stats, name, tags, chunk_size)
+    finally:
+        if lock is not None:
+            try:
+                guard_redis_call(lock.release)
+            except LockError:
+                pass
+    return value
+
+
+def _pack_protected_value(expires_at, delta, payload):
+    header = '%s|%s|' % (expires_at, delta)
+    if isinstance(payload, bytes):
+        return header.encode('ascii') + payload
+    return header + payload
+
+
+def _unpack_protected_value(raw):
+    if raw is None:
+        return None, None, unknown_value
+    try:
+        expires_at, delta, payload = raw.split(b'|' if isinstance(raw, bytes) else '|', 2)
+        return float(expires_at) if expires_at else None, float(delta), payload
+    except ValueError:
+        # value stored without stampede protection
+        return None, None, unknown_value
+
+
+def _get_value(redis, key, chunk_size=None):
+    value = redis.get(key)
+    if chunk_size and is_chunk_manifest(value):
+        value = read_chunked_value(redis, key, value)
+    return value
+
+
+def _set_value(redis, key, value, ttl=None, chunk_size=None, pipe=None):
+    if chunk_size and len(value) > chunk_size:
+        write_chunked_value(redis, key, value, chunk_size, ttl, pipe)
+    elif pipe is not None and ttl:
+        pipe.setex(key, ttl, value)
+    elif pipe is not None:
+        pipe.set(key, value)
+    elif ttl:
+        redis.setex(key, ttl, value)
     else:
-        redis.set(key, _value)
+        redis.set(key, value)
+
+
+def _get_raw_value(redis, key, ttl=None, local_cache=None, name=None, stats=None, chunk_size=None):
+    try:
+        if not local_cache:
+            value = guard_redis_call(_get_value, redis, key, chunk_size)
+        else:
+            value = local_cache.get(key, name)
+            if value is None:
+                value = guard_redis_call(_get_value, redis, key, chunk_size)
+                if value is not unknown_value:
+                    local_cache.set(key, value, ttl)
+    except Exception:
+        if stats:
+            stats.error(name)
+        raise
+    if value is unknown_value:
+        # redis is unavailable
+        if stats:
+            stats.error(name)
+        return None
+    if stats:
+        if value is None:
+            stats.miss(name)
+        else:
+            stats.hit(name)
+    return value
+
+
+def _set_raw_value(redis, key, value, ttl=None, local_cache=None, stats=None, name=None, tags=None, chunk_size=None):
+    if tags:
+        def write():
+            pipe = redis.pipeline(transaction=False)
+            _set_value(redis, key, value, ttl, chunk_size, pipe)
+            tag_cache_key(key, tags, pipe, ttl, redis)
+            return pipe.execute()
+        rv = guard_redis_call(write)
+    else:
+        rv = guard_redis_call(_set_value, redis, key, value, ttl, chunk_size)
+    if rv is unknown_value:
+        return
+    if local_cache:
+        local_cache.set(key, value, ttl)
+    if stats:
+        stats.write(name, value)
+
+
+def _call_callback(callback, stats=None, name=None):
+    if not stats:
+        return callback()
+    with stats.recompute(name):
+        return callback()
+
+
+def _make_codec_serializers(codec, coerce=None):
+    if coerce:
+        return codec.dumps, lambda value: coerce(codec.loads(value))
+    return codec.dumps, codec.loads
+
+
+def _encode_value(value, serializer=None):
+    if serializer:
+        value = serializer(value)
+    if value is None:
+        return NONE_VALUE
+    return value
+
+
+def _decode_value(value, coerce=None):
+    if value == NONE_VALUE:
+        return None
+    if coerce:
+        return coerce(value)
     return value
 
 
@@ -44,7 +245,100 @@ def redis_get_set_as_json(key, callback, **kwargs):
     return redis_get_set(key, callback, **kwargs)
 
 
+def redis_invalidate_key(key, redis=None, local_cache=False, chunked=False):
+    if not redis or isinstance(redis, str):
+        redis = current_app.extensions.frasco_redis.get_cache_connection(redis)
+    if chunked:
+        delete_chunked_value(redis, key)
+    else:
+        redis.delete(key)
+    if local_cache:
+        local_cache_invalidate(key)
+
+
+KEY_FIELD_NAME = 0
+KEY_FIELD_AT_VALUE = 1
+KEY_FIELD_ATTR = 2
+
+
+class KeyTemplate(object):
+    """A key template (eg: "User:{id}:{__name__}:{@arg}") parsed once
+    """
+    def __init__(self, template):
+        self.template = template
+        self.fields = []
+        for field in re.findall(r'\{(@?[a-z0-9_]+)[^}]*\}', template, re.I):
+            if field == '__name__':
+                self.fields.append((field, KEY_FIELD_NAME, None))
+            elif field.startswith('@'):
+                self.fields.append((field, KEY_FIELD_AT_VALUE, field[1:]))
+            else:
+                self.fields.append((field, KEY_FIELD_ATTR, operator.attrgetter(field)))
+        self.needs_at_values = any(kind == KEY_FIELD_AT_VALUE for _, kind, _ in self.fields)
+
+    def format(self, obj=None, name=None, at_values=None, values=None):
+        values = dict(values) if values else {}
+        if callable(at_values):
+            at_values = at_values() if self.needs_at_values else None
+        for field, kind, arg in self.fields:
+            if kind == KEY_FIELD_NAME:
+                if name is None:
+                    continue
+                value = name
+            elif kind == KEY_FIELD_AT_VALUE and at_values:
+                value = at_values.get(arg, '')
+            elif obj:
+                value = arg(obj) if kind == KEY_FIELD_ATTR else getattr(obj, field)
+            else:
+                continue
+            cache_id = getattr(value, '__redis_cache_id__', None)
+            if cache_id:
+                value = cache_id()
+            values[field] = value
+        return self.template.format_map(values)
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_key_template(template):
+    return KeyTemplate(template)
+
+
+class CallArgsBinder(object):
+    """Faster equivalent of inspect.getcallargs() for a given function
+    """
+    def __init__(self, func):
+        self.signature = inspect.signature(func)
+        self.names = []
+        self.defaults = {}
+        self.simple = True
+        for param in self.signature.parameters.values():
+            if param.kind != param.POSITIONAL_OR_KEYWORD:
+                self.simple = False
+                break
+            self.names.append(param.name)
+            if param.default is not param.empty:
+                self.defaults[param.name] = param.default
+        self.names_set = frozenset(self.names)
+
+    def __call__(self, *args, **kwargs):
+        # keyword arguments must only name parameters not already given positionally
+        if self.simple and len(args) <= len(self.names) and (not kwargs or (self.names_set.issuperset(kwargs)
+                and kwargs.keys().isdisjoint(self.names[:len(args)]))):
+            values = dict(self.defaults)
+            values.update(zip(self.names, args))
+            values.update(kwargs)
+            if len(values) == len(self.names):
+                return values
+        # unusual signatures and invalid calls (which raise a TypeError)
+        bound = self.signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        return bound.arguments
+
+
 def build_object_key(obj=None, name=None, key=None, at_values=None, values=None, super_key=None):
+    """Builds a key from a key template. at_values can be a callable which will only
+    be called when the template contains @ fields.
+    """
     cls = None
     if obj:
         super_key = getattr(obj, '__redis_cache_key__', None)
@@ -63,37 +357,46 @@ def build_object_key(obj=None, name=None, key=None, at_values=None, values=None,
         key = '%s:{__name__}' % cls.__name__
     if name is None and cls:
         name = cls.__name__
-    if values is None:
-        values = {}
-    else:
-        values = dict(**values)
-
-    for attr in re.findall(r'\{(@?[a-z0-9_]+)[^}]*\}', key, re.I):
-        value = unknown_value
-        if attr == '__name__' and name is not None:
-            value = name
-        elif attr.startswith('@') and at_values:
-            value = at_values.get(attr[1:], '')
-        elif obj:
-            value = getattr(obj, attr)
-        if value is not unknown_value:
-            cache_id = getattr(value, '__redis_cache_id__', None)
-            if cache_id:
-                value = cache_id()
-            values[attr] = value
-    return key.format(**values)
+    return compile_key_template(key).format(obj, name, at_values, values)
+
+
+def _make_function_key_builders(func, key, tags=None):
+    bind_args = CallArgsBinder(func)
+    if not callable(key):
+        key_template = compile_key_template(key)
+
+    def build_key(*args, **kwargs):
+        if callable(key):
+            return key(*args, **kwargs)
+        return key_template.format(None, func.__name__, values=bind_args(*args, **kwargs))
+
+    def build_tags(*args, **kwargs):
+        if callable(tags):
+            return tags(*args, **kwargs)
+        values = bind_args(*args, **kwargs)
+        return [compile_key_template(tag).format(None, func.__name__, values=values) for tag in tags]
+
+    return build_key, build_tags
 
 
 def redis_cached_function(key, **opts):
     opts.setdefault('logging', None)
+    tags = opts.pop('tags', None)
     def decorator(func):
+        opts.setdefault('name', func.__qualname__)
+        build_key, build_tags = _make_function_key_builders(func, key, tags)
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            if callable(key):
-                k = key(*args, **kwargs)
-            else:
-                k = build_object_key(None, func.__name__, key, values=inspect.getcallargs(func, *args, **kwargs))
-            return redis_get_set(k, lambda: func(*args, **kwargs), **opts)
+            return redis_get_set(build_key(*args, **kwargs), lambda: func(*args, **kwargs),
+                tags=build_tags(*args, **kwargs) if tags else None, **opts)
+
+        def invalidate(*args, **kwargs):
+            redis_invalidate_key(build_key(*args, **kwargs), redis=opts.get('redis'),
+                local_cache=opts.get('local_cache', False), chunked=bool(opts.get('chunk_size')))
+
+        wrapper.build_key = build_key
+        wrapper.invalidate = invalidate
         return wrapper
     return decorator
 
@@ -0,0 +1,158 @@
+from flask import current_app
+from werkzeug.utils import import_string
+from sqlalchemy import inspect as sqla_inspect, text, tuple_
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .attr import RedisCachedProperty
+from .utils import _call_callback, _pack_protected_value, _encode_value, _set_value
+from .tags import tag_cache_key
+from .local_cache import get_local_cache
+from .stats import get_cache_stats
+import itertools
+import time
+
+
+__all__ = ('warm_redis_cached',)
+
+
+def warm_redis_cached(model, names, filter=None, chunk_size=500, workers=1, progress=None):
+    """Computes and stores the values of cached properties for all the rows of a model.
+    filter can be an SQL criterion, an SQL string or a callable receiving and returning the query.
+    Rows are streamed in chunks of chunk_size and values of a chunk are written using a single
+    pipeline per redis connection. With more than one worker, primary keys are streamed and
+    chunks are loaded and computed in separate threads (each with its own app context and session).
+    progress is called with the number of processed objects after each chunk.
+    Returns the number of processed objects.
+    """
+    attrs = []
+    for name in names:
+        attr = getattr(model, name, None)
+        if not isinstance(attr, RedisCachedProperty):
+            raise TypeError("'%s' is not a redis cached property of %s" % (name, model.__name__))
+        attrs.append(attr)
+
+    query = model.query
+    if callable(filter):
+        query = filter(query)
+    elif isinstance(filter, str):
+        query = query.filter(text(filter))
+    elif filter is not None:
+        query = query.filter(filter)
+
+    if workers <= 1:
+        count = 0
+        for chunk in _iter_chunks(query.yield_per(chunk_size), chunk_size):
+            _warm_objs(chunk, attrs)
+            count += len(chunk)
+            if progress:
+                progress(len(chunk))
+        return count
+
+    app = current_app._get_current_object()
+    pk_cols = sqla_inspect(model).primary_key
+
+    def run(ids):
+        with app.app_context():
+            try:
+                if len(pk_cols) == 1:
+                    objs = model.query.filter(pk_cols[0].in_([i[0] for i in ids])).all()
+                else:
+                    objs = model.query.filter(tuple_(*pk_cols).in_(ids)).all()
+                _warm_objs(objs, attrs)
+                return len(ids)
+            finally:
+                app.extensions['sqlalchemy'].db.session.remove()
+
+    count = 0
+    pending = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def process_done(done):
+            processed = 0
+            for future in done:
+                processed += future.result()
+            if progress and processed:
+                progress(processed)
+            return processed
+
+        for ids in _iter_chunks(query.with_entities(*pk_cols).yield_per(chunk_size), chunk_size):
+            if len(pending) >= workers * 2:
+                # do not load primary keys faster than workers can process them
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                count += process_done(done)
+            pending.add(executor.submit(run, [tuple(i) for i in ids]))
+        count += process_done(wait(pending)[0])
+    return count
+
+
+def _iter_chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _warm_objs(objs, attrs):
+    stats = get_cache_stats()
+    pipes = {}
+    for obj in objs:
+        for attr in attrs:
+            if attr.cache_disabled:
+                continue
+            try:
+                key = attr.build_key(obj)
+                start = time.time()
+                value = _call_callback(lambda: attr.get_fresh(obj), stats, attr.stats_name)
+                delta = time.time() - start
+            except Exception as e:
+                current_app.log_exception(e)
+                continue
+            obj.__dict__[attr.cached_property_name] = value
+            if attr.cache_ignore_current:
+                continue
+            conn = attr.redis
+            pipe = pipes.get(conn)
+            if pipe is None:
+                pipe = pipes[conn] = conn.pipeline(transaction=False)
+            default_ttl = getattr(obj, '__redis_cache_ttl__', None)
+            if attr.stampede_protection:
+                _set_protected_value(attr, pipe, key, value, delta, default_ttl, attr._build_tags(obj), stats)
+            else:
+                attr._set_cached_value(key, value, default_ttl, pipe=pipe, tags=attr._build_tags(obj))
+    for pipe in pipes.values():
+        pipe.execute()
+
+
+def _set_protected_value(attr, pipe, key, value, delta, default_ttl=None, tags=None, stats=None):
+    # same envelope as the one written by redis_get_set(stampede_protection=True)
+    ttl = attr.ttl if attr.ttl is not None else default_ttl
+    options = attr.stampede_protection if isinstance(attr.stampede_protection, dict) else {}
+    stale_ttl = options.get('stale_ttl')
+    expires_at = ''
+    redis_ttl = None
+    if ttl:
+        expires_at = time.time() + ttl
+        redis_ttl = int(ttl + (stale_ttl if stale_ttl is not None else ttl))
+    value = _pack_protected_value(expires_at, delta,
+        _encode_value(value, attr.serializer.dumps if attr.serializer else None))
+    _set_value(attr.redis, key, value, redis_ttl, attr.chunk_size, pipe)
+    if tags:
+        tag_cache_key(key, tags, pipe, redis_ttl, attr.redis)
+    local_cache = get_local_cache() if attr.local_cache else None
+    if local_cache:
+        local_cache.set(key, value, redis_ttl)
+    if stats:
+        stats.write(attr.stats_name, value)
+
+
+def resolve_model(name):
+    """Returns a model class from its name or its import path"""
+    if ':' in name or '.' in name:
+        return import_string(name)
+    base = current_app.extensions['sqlalchemy'].db.Model
+    registry = getattr(base, '_decl_class_registry', None)
+    if registry is None:
+        registry = base.registry._class_registry
+    if name not in registry:
+        raise ValueError("Unknown model '%s'" % name)
+    return registry[name]
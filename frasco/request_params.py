@@ -1,5 +1,5 @@
 from flask import request, abort, current_app, has_request_context
-from .utils import unknown_value
+from .utils import unknown_value, decode_cursor
 from .ctx import FlagContextStack
 from werkzeug.exceptions import HTTPException
 from dateutil.parser import parse as parse_date
@@ -315,6 +315,24 @@ def utcdatetime(**kwargs):
     return wrapper
 
 
+def keyset_cursor(columns=None):
+    """Type decoding cursors returned by keyset_paginate(). When the columns given to
+    keyset_paginate() are provided, values are checked against them.
+    """
+    def wrapper(value):
+        if not value:
+            return
+        try:
+            values = decode_cursor(value)
+            if columns is not None:
+                from frasco.models.utils import coerce_keyset_cursor
+                values = coerce_keyset_cursor(columns, values)
+            return values
+        except ValueError:
+            abort(400, "invalid cursor")
+    return wrapper
+
+
 def required_if_other(other_params):
     if not isinstance(other_params, dict):
         other_params = dict([(other_params, unknown_value)])
@@ -1,12 +1,13 @@
 from frasco.ext import *
 from frasco.utils import import_string
 from frasco.models import delayed_tx_calls
-from frasco.ctx import ContextStack
+from frasco.ctx import ContextStack, make_call_key
 from flask_rq2 import RQ
 from flask_rq2 import cli
 from rq import get_current_job
 from rq.timeouts import JobTimeoutException
-from .job import FrascoJob, prevent_circular_task, synchronous_tasks
+from rq.job import JobStatus
+from .job import FrascoJob, prevent_circular_task, synchronous_tasks, pack_job_args
 import redis.exceptions
 import functools
 import logging
@@ -19,16 +20,24 @@ class FrascoTasks(Extension):
     name = 'frasco_tasks'
     prefix_extra_options = 'RQ_'
     defaults = {"tasks_timeout": RQ.default_timeout,
-                "scheduled_tasks_timeout": 300}
+                "scheduled_tasks_timeout": 300,
+                "redis_connection": "queue"}
 
     def _init_app(self, app, state):
-        if not app.config.get('RQ_REDIS_URL') and has_extension('frasco_redis', app):
-            app.config['RQ_REDIS_URL'] = app.extensions.frasco_redis.options['url']
+        redis_connection = None
+        if has_extension('frasco_redis', app) and not app.config.get('RQ_REDIS_URL'):
+            redis_state = app.extensions.frasco_redis
+            app.config['RQ_REDIS_URL'] = redis_state.get_connection_url(state.options['redis_connection'])
+            if redis_state.has_connection(state.options['redis_connection']):
+                # rq needs a connection which does not decode responses
+                redis_connection = redis_state.get_connection(state.options['redis_connection'], binary=True)
 
         app.config.setdefault('RQ_JOB_CLASS', 'frasco.tasks.job.FrascoJob')
         if app.testing:
             app.config.setdefault('RQ_ASYNC', False)
         state.rq = RQ(app, default_timeout=state.options['tasks_timeout'])
+        if redis_connection:
+            state.rq._connection = redis_connection
         state.rq.exception_handler(per_task_exception_handler)
 
 
@@ -42,27 +51,77 @@ def enqueue_task_now(func, *args, **kwargs):
 
 
 def enqueue_now(func, **options):
+    queue, job, enqueue_options = _create_job(func, **options)
+    if synchronous_tasks.calling_ctx.top:
+        return queue.run_job(job)
+    return _enqueue_job(queue, job, **enqueue_options)
+
+
+def _create_job(func, **options):
+    # everything depending on the calling thread (task options, forwarded contexts, current user,
+    # request, arguments packing) is resolved here so that the job can be sent from another thread
     if getattr(func, '__task_options__', None):
         options.update(func.__task_options__)
+    options.pop('coalesce', None)
     queue_name = options.pop('queue', None)
     forward_contexts = options.pop('forward_contexts', None)
     if forward_contexts:
-        options.setdefault('meta', {})['forwarded_contexts'] = {ctx: import_string(ctx).stack for ctx in forward_contexts}
+        options.setdefault('meta', {})['forwarded_contexts'] = {ctx: list(import_string(ctx).stack) for ctx in forward_contexts}
     if callable(queue_name):
         queue_name = queue_name()
+    enqueue_options = {k: options.pop(k) for k in ('at_front', 'pipeline') if k in options}
     queue = get_extension_state('frasco_tasks').rq.get_queue(queue_name)
+    job = queue.create_job(func, **options)
+    job.data # packs the arguments
+    return queue, job, enqueue_options
+
+
+def _enqueue_job(queue, job, at_front=False, pipeline=None):
+    # same as Queue.enqueue_call() once the job is created
+    job = queue.setup_dependencies(job, pipeline=pipeline)
+    if job.get_status(refresh=False) != JobStatus.DEFERRED:
+        return queue.enqueue_job(job, pipeline=pipeline, at_front=at_front)
+    return job
+
+
+def prepare_enqueue(func, **options):
+    """Creates the job in the calling thread and returns a function sending it to the queue
+    (or None if tasks are run synchronously, in which case the job has already run)
+    """
+    queue, job, enqueue_options = _create_job(func, **options)
     if synchronous_tasks.calling_ctx.top:
-        job = queue.create_job(func, **options)
-        return queue.run_job(job)
-    return queue.enqueue_call(func, **options)
+        queue.run_job(job)
+        return None
+    return functools.partial(_enqueue_job, queue, job, **enqueue_options)
 
 
 def enqueue_task(func, *args, **kwargs):
     return enqueue(func, args=args, kwargs=kwargs)
 
 
+def _enqueue_dedupe_key(func, **options):
+    # tasks declared with @task(coalesce=True) are only enqueued once per transaction for the same
+    # arguments, coalesce can also be a function receiving the task arguments and returning a key.
+    # keys start with the import name of the task so that different tasks are never coalesced together
+    coalesce = (getattr(func, '__task_options__', None) or {}).get('coalesce', options.get('coalesce'))
+    if not coalesce:
+        return None
+    args = options.get('args') or ()
+    kwargs = options.get('kwargs') or {}
+    if callable(coalesce):
+        key = coalesce(*args, **kwargs)
+        return (_get_task_import_name(func), key) if key is not None else None
+    return (_get_task_import_name(func), make_call_key(pack_job_args(list(args)), pack_job_args(kwargs)))
+
+
+def _get_task_import_name(func):
+    if isinstance(func, str):
+        return func
+    return '%s.%s' % (func.__module__, getattr(func, '__qualname__', func.__name__))
+
+
 @synchronous_tasks.proxy
-@delayed_tx_calls.proxy
+@delayed_tx_calls.proxy(dedupe_key=_enqueue_dedupe_key, background=prepare_enqueue)
 def enqueue(func, **options):
     return enqueue_now(func, **options)
 
@@ -2,6 +2,7 @@ from flask import has_app_context, current_app, has_request_context, session, re
 from frasco.users import user_login_context, is_user_logged_in, current_user
 from frasco.utils import import_string
 from frasco.ctx import ContextStack, DelayedCallsContext
+from frasco.models.instrumentation import sql_profile
 from flask_rq2.job import FlaskJob
 from rq.job import UNEVALUATED, dumps, Job as RQJob
 from contextlib import contextmanager
@@ -121,12 +122,15 @@ class FrascoJob(FlaskJob):
                 import_string(ctx_import_str).stack.extend(stack)
                 clear_extended_fowarded_contexts[ctx_import_str] = len(stack) # keep track using temp variable as if it runs in sync mode, stack will be modified
         try:
-            current_user_id = self.meta.get('current_user_id')
-            if current_user_id and not is_user_logged_in(): # user is already logged in if task is async=False
-                with user_login_context(current_app.extensions.frasco_users.Model.query.get(current_user_id)):
+            with sql_profile('task:%s' % self.func_name):
+                current_user_id = self.meta.get('current_user_id')
+                if current_user_id and not is_user_logged_in(): # user is already logged in if task is async=False
+                    user_model = current_app.extensions.frasco_users.Model
+                    user = user_model.get_cached(current_user_id) if hasattr(user_model, 'get_cached') else user_model.query.get(current_user_id)
+                    with user_login_context(user):
+                        rv = RQJob.perform(self)
+                else:
                     rv = RQJob.perform(self)
-            else:
-                rv = RQJob.perform(self)
         finally:
             if clear_extended_fowarded_contexts:
                 for ctx_import_str, clear_len in clear_extended_fowarded_contexts.items():
@@ -182,7 +182,10 @@ class FrascoUsers(Extension):
 
         @state.manager.user_loader
         def user_loader(id):
-            return state.Model.query.filter(getattr(state.Model, getattr(state.Model, '__session_cookie_identifier__', 'id')) == id).first()
+            identifier = getattr(state.Model, '__session_cookie_identifier__', 'id')
+            if identifier == 'id' and hasattr(state.Model, 'get_cached'):
+                return state.Model.get_cached(id)
+            return state.Model.query.filter(getattr(state.Model, identifier) == id).first()
 
         @state.manager.request_loader
         def request_loaders(request):
@@ -30,6 +30,7 @@ class OAuth1RequestTokenCache(object):
 
 class OAuth1RequestTokenRedisCache(OAuth1RequestTokenCache):
     def __init__(self, *args, **kwargs):
+        kwargs.setdefault('redis', 'sessions')
         self._data = JSONRedisHash(*args, **kwargs)
 
 
@@ -2,6 +2,12 @@ from werkzeug.utils import import_string as wz_import_string, cached_property
 from flask import abort
 from slugify import slugify
 import functools
+import datetime
+import decimal
+import math
+import base64
+import json
+import uuid
 import re
 import yaml
 import os
@@ -252,3 +258,60 @@ def join_url_rule(rule1, rule2):
     if not rule2:
         return rule1
     return (rule1.rstrip('/') + '/' + rule2.lstrip('/')).rstrip('/')
+
+
+def _encode_cursor_value(value):
+    if isinstance(value, datetime.datetime):
+        return {"$dt": value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {"$d": value.isoformat()}
+    if isinstance(value, uuid.UUID):
+        return {"$uuid": str(value)}
+    if isinstance(value, decimal.Decimal):
+        return {"$dec": str(value)}
+    return value
+
+
+_cursor_value_decoders = {"$dt": datetime.datetime.fromisoformat,
+                          "$d": datetime.date.fromisoformat,
+                          "$uuid": uuid.UUID,
+                          "$dec": decimal.Decimal}
+
+
+def _decode_cursor_value(value):
+    if isinstance(value, dict):
+        if len(value) != 1:
+            raise ValueError("Invalid cursor value")
+        (tag, encoded), = value.items()
+        if tag not in _cursor_value_decoders or not isinstance(encoded, str):
+            raise ValueError("Invalid cursor value")
+        try:
+            value = _cursor_value_decoders[tag](encoded)
+        except (ValueError, TypeError, ArithmeticError): # decimal.InvalidOperation is an ArithmeticError
+            raise ValueError("Invalid cursor value")
+        if isinstance(value, decimal.Decimal) and not value.is_finite():
+            raise ValueError("Invalid cursor value")
+        return value
+    # only scalars can be compared to columns
+    if value is not None and not isinstance(value, (str, int, float)):
+        raise ValueError("Invalid cursor value")
+    if isinstance(value, float) and not math.isfinite(value):
+        raise ValueError("Invalid cursor value")
+    return value
+
+
+def encode_cursor(values):
+    """Encodes a list of values as an opaque url-safe string"""
+    data = json.dumps([_encode_cursor_value(v) for v in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor created with encode_cursor(). Raises a ValueError if it is invalid (any decoding error)"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8'))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(data, list):
+        raise ValueError("Invalid cursor")
+    return [_decode_cursor_value(v) for v in data]
@@ -59,7 +59,7 @@ setup(
         'python-slugify~=6.1.0',
         'python-socketio~=5.5.2',
         'PyYAML~=5.4.1',
-        'redis~=4.1.4',
+        'redis~=4.3.6',
         'requests~=2.27.1',
         'suds-py3~=1.4.1.0',
         'speaklater~=1.3',
@@ -0,0 +1,46 @@
+"""Tests for the delayed calls of frasco.ctx.
+Run with: python -m pytest tests
+"""
+from frasco.ctx import DelayedCallsContext
+
+
+class CallableDict(dict):
+    def __call__(self):
+        return self
+
+
+def test_coalesced_and_merged_calls():
+    calls = []
+    ctx = DelayedCallsContext()
+    deduped = ctx.proxy(lambda *args: calls.append(('deduped', args)), dedupe_key=True)
+    merged = ctx.proxy(lambda items: calls.append(('merged', items)),
+                       merge=lambda args_list: (([args[0] for args, _ in args_list],), {}))
+    with ctx():
+        deduped(1)
+        deduped(1)
+        deduped(2)
+        merged(1)
+        merged(2)
+        assert calls == []
+    assert calls == [('deduped', (1,)), ('deduped', (2,)), ('merged', [1, 2])]
+
+
+def test_callable_mapping_kwargs_are_not_mistaken_for_a_merge_function():
+    calls = []
+    ctx = DelayedCallsContext()
+    func = ctx.proxy(lambda **kwargs: calls.append(kwargs))
+    with ctx():
+        func(**CallableDict(a=1))
+        ctx.call(lambda *args, **kwargs: calls.append(kwargs), (), CallableDict(b=2))
+    assert calls == [{'a': 1}, {'b': 2}]
+
+
+def test_background_calls_are_dispatched_after_the_inline_ones():
+    calls = []
+    ctx = DelayedCallsContext(dispatcher=lambda run: (calls.append('dispatch'), run()))
+    inline = ctx.proxy(lambda x: calls.append(('inline', x)))
+    background = ctx.proxy(lambda x: calls.append(('background', x)), background=True)
+    with ctx():
+        background(1)
+        inline(2)
+    assert calls == [('inline', 2), 'dispatch', ('background', 1)]
@@ -0,0 +1,57 @@
+"""Tests for the validation of keyset_paginate() cursors.
+Run with: python -m pytest tests
+"""
+import datetime
+
+import pytest
+from werkzeug.exceptions import BadRequest
+
+from frasco.app import Frasco
+from frasco.models import db, transaction, keyset_paginate, coerce_keyset_cursor
+from frasco.request_params import keyset_cursor
+from frasco.utils import encode_cursor
+
+
+class KeysetEvent(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    created = db.Column(db.DateTime)
+
+
+COLUMNS = [KeysetEvent.created.desc(), KeysetEvent.id.desc()]
+
+
+@pytest.fixture
+def app():
+    app = Frasco(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://')
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        with transaction():
+            db.session.add_all([KeysetEvent(id=i, created=datetime.datetime(2020, 1, i)) for i in range(1, 6)])
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+def test_next_page_from_cursor(app):
+    page = keyset_paginate(KeysetEvent.query, COLUMNS, per_page=2)
+    assert [e.id for e in page] == [5, 4]
+    page = keyset_paginate(KeysetEvent.query, COLUMNS, page.next_cursor, per_page=2)
+    assert [e.id for e in page] == [3, 2]
+
+
+@pytest.mark.parametrize('values', [
+    ['2020-01-03', 3], # string for a datetime column
+    [datetime.datetime(2020, 1, 3), '3'], # string for an int column
+    [datetime.datetime(2020, 1, 3), True],
+    [datetime.date(2020, 1, 3), 3],
+    [datetime.datetime(2020, 1, 3)],
+])
+def test_invalid_cursors_are_rejected(app, values):
+    with pytest.raises(ValueError):
+        coerce_keyset_cursor(COLUMNS, values)
+    with pytest.raises(BadRequest):
+        keyset_paginate(KeysetEvent.query, COLUMNS, encode_cursor(values))
+    with pytest.raises(BadRequest):
+        keyset_cursor(COLUMNS)(encode_cursor(values))
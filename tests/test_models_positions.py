@@ -0,0 +1,56 @@
+"""Tests for the gap based ordering mode of move_obj_position_in_collection().
+Run with: python -m pytest tests (requires fakeredis)
+"""
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+pytest.importorskip('frasco.users') # frasco.tasks can only be imported after frasco.users
+tasks = pytest.importorskip('frasco.tasks')
+
+from frasco.app import Frasco
+from frasco.models import db, transaction, move_obj_position_in_collection
+
+
+class PositionedCard(db.Model):
+    __position_gap__ = 1024
+    id = db.Column(db.Integer, primary_key=True)
+    list_id = db.Column(db.Integer)
+    position = db.Column(db.Integer)
+
+
+@pytest.fixture
+def app():
+    app = Frasco(__name__)
+    app.testing = True
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://', RQ_ASYNC=False)
+    db.init_app(app)
+    tasks.FrascoTasks(app)
+    app.extensions.frasco_tasks.rq._connection = fakeredis.FakeRedis()
+    with app.app_context():
+        db.create_all()
+        with transaction():
+            db.session.add_all([PositionedCard(id=i + 1, list_id=1, position=(i + 1) * 1024) for i in range(4)])
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+def get_ordered_ids():
+    return [c.id for c in PositionedCard.query.filter_by(list_id=1).order_by(PositionedCard.position)]
+
+
+def test_move_only_writes_the_moved_row(app):
+    with transaction():
+        move_obj_position_in_collection(PositionedCard.query.get(4), 0, scope={'list_id': 1})
+    assert get_ordered_ids() == [4, 1, 2, 3]
+    assert [c.position for c in PositionedCard.query.order_by(PositionedCard.id)] == [1024, 2048, 3072, 0]
+
+
+def test_exhausted_gaps_are_rebalanced_by_a_task(app):
+    for _ in range(10):
+        # moving the last card between the first two ones halves the gap, down to 1 after 10 moves
+        with transaction():
+            move_obj_position_in_collection(PositionedCard.query.get(get_ordered_ids()[-1]), 1, scope={'list_id': 1})
+    db.session.remove()
+    positions = sorted(c.position for c in PositionedCard.query.filter_by(list_id=1))
+    assert positions == [1024, 2048, 3072, 4096]
@@ -0,0 +1,84 @@
+"""Tests for DatabaseDictSerializer.dump_stream() and the bulk import of DatabaseDictSerializer.load().
+Run with: python -m pytest tests
+"""
+import pytest
+
+from frasco.app import Frasco
+from frasco.models import db, transaction
+from frasco.models.serializer import DatabaseDictSerializer, DictSink
+
+
+class SerializedTag(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String, unique=True)
+    label = db.Column(db.String)
+
+
+serialized_post_tags = db.Table('serialized_post_tags',
+    db.Column('post_id', db.Integer, db.ForeignKey('serialized_post.id')),
+    db.Column('tag_id', db.Integer, db.ForeignKey('serialized_tag.id')))
+
+
+class SerializedAuthor(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+
+
+class SerializedPost(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    author_id = db.Column(db.Integer, db.ForeignKey('serialized_author.id'))
+    author = db.relationship(SerializedAuthor, backref='posts')
+    tags = db.relationship(SerializedTag, secondary=serialized_post_tags)
+
+
+@pytest.fixture
+def app():
+    app = Frasco(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://')
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+class PrefixingSerializer(DatabaseDictSerializer):
+    def _process_data(self, table, row, idmap, data):
+        data = super(PrefixingSerializer, self)._process_data(table, row, idmap, data)
+        data['label'] = 'imported:%s' % data['label']
+        return data
+
+    def _insert_raw(self, table, oldid, data, idmap):
+        # sqlite does not support RETURNING
+        newid = db.session.execute(table.insert(), data).inserted_primary_key[0]
+        idmap.setdefault(table.name, {})[int(oldid)] = newid
+        return newid
+
+
+def test_bulk_load_uses_overridden_row_hooks(app):
+    data = {'serialized_tag': [{'id': '10', 'name': 'a', 'label': 'A'}, {'id': '11', 'name': 'b', 'label': 'B'}]}
+    with transaction():
+        idmap = PrefixingSerializer().load(data, bulk=True)
+    labels = {t.id: t.label for t in SerializedTag.query}
+    assert {old: labels[new] for old, new in idmap['serialized_tag'].items()} == {10: 'imported:A', 11: 'imported:B'}
+
+
+def test_bulk_insert_key_col_must_identify_each_row(app):
+    table = SerializedTag.__table__
+    serializer = DatabaseDictSerializer()
+    assert serializer._get_bulk_insert_key_col(table, [{'name': 'a'}, {'name': 'b'}]) is table.c.name
+    assert serializer._get_bulk_insert_key_col(table, [{'name': 'a'}, {'name': None}]) is None
+    assert serializer._get_bulk_insert_key_col(table, [{'label': 'a'}, {'label': 'b'}]) is None
+
+
+def test_dump_stream_exports_association_rows_once(app):
+    with transaction():
+        author = SerializedAuthor(id=1)
+        tags = [SerializedTag(id=1, name='a'), SerializedTag(id=2, name='b')]
+        db.session.add_all([SerializedPost(id=1, author=author, tags=tags),
+                            SerializedPost(id=2, author=author, tags=tags[:1])])
+    # posts are reached from the root query and again from their author with another spec
+    follow_rels = {'SerializedPost': ['tags', ('author', {'SerializedAuthor': [('posts', {'SerializedPost': ['tags']})]})]}
+    data = DatabaseDictSerializer().dump_stream(SerializedPost.query, DictSink(), follow_rels=follow_rels).data
+    assert sorted((r['post_id'], r['tag_id']) for r in data['serialized_post_tags']) == [('1', '1'), ('1', '2'), ('2', '1')]
+    assert sorted(r['id'] for r in data['serialized_post']) == [1, 2]
@@ -0,0 +1,47 @@
+"""Tests for the redis.asyncio clients of FrascoRedis.
+Run with: python -m pytest tests
+"""
+import asyncio
+
+import pytest
+
+from frasco.app import Frasco
+from frasco.redis import ext
+from frasco.redis.ext import FrascoRedis
+
+
+if ext.aioredis is None:
+    pytest.skip("redis.asyncio is not available", allow_module_level=True)
+
+
+@pytest.fixture
+def state(monkeypatch):
+    app = Frasco(__name__)
+    FrascoRedis(app)
+    closed = []
+    async def close(self):
+        closed.append(self)
+    monkeypatch.setattr(ext.aioredis.Redis, 'close', close)
+    state = app.extensions.frasco_redis
+    state.closed = closed
+    return state
+
+
+def test_clients_are_reused_and_closed_when_the_loop_ends(state):
+    async def main():
+        connection = state.get_async_connection()
+        assert state.get_async_connection() is connection
+        return [connection, state.get_async_connection(binary=True)]
+    connections = asyncio.run(main())
+    assert state.closed == connections
+    assert len(state.async_connections) == 0
+
+
+def test_close_async_connections(state):
+    async def main():
+        connection = state.get_async_connection()
+        await state.close_async_connections()
+        assert state.closed == [connection]
+        assert state.get_async_connection() is not connection
+    asyncio.run(main())
+    assert len(state.closed) == 2
@@ -0,0 +1,45 @@
+"""Tests for the redis circuit breaker.
+Run with: python -m pytest tests
+"""
+import pytest
+
+from frasco.app import Frasco
+from frasco.redis import redis_get_set, redis_cached_property, get_circuit_breaker
+from frasco.redis.ext import FrascoRedis
+
+
+@pytest.fixture
+def app():
+    app = Frasco(__name__)
+    # nothing listens on this port, connections are refused right away
+    app.config.update(FRASCO_REDIS_URL='redis://127.0.0.1:1/0', FRASCO_REDIS_SOCKET_CONNECT_TIMEOUT=0.5,
+                      FRASCO_REDIS_CIRCUIT_BREAKER_THRESHOLD=2)
+    FrascoRedis(app)
+    with app.app_context():
+        yield app
+
+
+def test_redis_get_set_with_local_cache_falls_back_to_the_function(app):
+    calls = []
+    for i in range(5):
+        assert redis_get_set('key', lambda: calls.append(i) or 'value', local_cache=True) == 'value'
+    assert calls == list(range(5))
+    assert get_circuit_breaker().state == 'open'
+
+
+class Obj(object):
+    __redis_cache_key__ = 'Obj:{id}:{__name__}'
+    id = 1
+    calls = []
+
+    @redis_cached_property(local_cache=True)
+    def prop(self):
+        self.calls.append(1)
+        return 'value'
+
+
+def test_cached_property_with_local_cache_falls_back_to_the_function(app, caplog):
+    for i in range(5):
+        assert Obj().prop == 'value'
+    assert len(Obj.calls) == 5
+    assert not [r for r in caplog.records if r.exc_info]
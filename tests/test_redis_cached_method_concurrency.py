@@ -0,0 +1,148 @@
+"""Stress tests for redis cached methods shared by many threads and asyncio tasks.
+Run with: python -m pytest tests (requires fakeredis)
+"""
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from frasco.app import Frasco
+from frasco.redis import redis_cached_method
+from frasco.redis.aio import async_redis_cached_method
+from frasco.redis.ext import FrascoRedis
+
+
+THREADS = 32
+INSTANCES = 50
+CALLS = 20
+
+
+@pytest.fixture
+def app():
+    app = Frasco(__name__)
+    FrascoRedis(app)
+    state = app.extensions.frasco_redis
+    server = fakeredis.FakeServer()
+    conn = fakeredis.FakeRedis(server=server, decode_responses=True)
+    binary_conn = fakeredis.FakeRedis(server=server)
+    for name in list(state.connections_options):
+        state.connections[(name, False)] = conn
+        state.connections[(name, True)] = binary_conn
+    state.connection = state.cache_connection = conn
+    state.binary_connection = state.cache_binary_connection = binary_conn
+    app.redis_server = server
+    with app.app_context():
+        yield app
+
+
+class Obj(object):
+    __redis_cache_key__ = 'Obj:{id}:{__name__}'
+
+    def __init__(self, id):
+        self.id = id
+
+    @redis_cached_method(key='Obj:{id}:value:{@x}', ttl=100)
+    def value(self, x):
+        time.sleep(random.random() / 1000)
+        if x % 7 == 0:
+            self.value.cache_ignore_current = True
+        elif x % 5 == 0:
+            self.value.cache_current_ttl = 10
+        return '%s-%s' % (self.id, x)
+
+
+def test_threads_get_values_of_their_instance(app):
+    redis = app.extensions.frasco_redis.cache_connection
+    errors = []
+
+    def work(i):
+        with app.app_context():
+            obj = Obj(i % INSTANCES)
+            bound = obj.value
+            for x in range(CALLS):
+                time.sleep(random.random() / 2000)
+                value = bound(x)
+                if value != '%s-%s' % (obj.id, x):
+                    errors.append((obj.id, x, value))
+
+    with ThreadPoolExecutor(THREADS) as executor:
+        list(executor.map(work, range(THREADS * 20)))
+
+    assert errors == []
+    for key in redis.keys('Obj:*:value:*'):
+        obj_id, x = key.split(':')[1], int(key.split(':')[-1])
+        assert redis.get(key) == '%s-%s' % (obj_id, x)
+        assert x % 7 != 0, "values flagged with cache_ignore_current must not be stored"
+        # values are written while the test runs
+        assert (1 if x % 5 == 0 else 80) <= redis.ttl(key) <= (10 if x % 5 == 0 else 100)
+
+
+def test_flags_do_not_leak_across_threads(app):
+    redis = app.extensions.frasco_redis.cache_connection
+    # all the threads are inside the cached method at the same time
+    barrier = threading.Barrier(THREADS)
+
+    class Flagged(object):
+        def __init__(self, id):
+            self.id = id
+
+        @redis_cached_method(key='Flagged:{id}', ttl=100)
+        def value(self):
+            if self.id % 2:
+                self.value.cache_ignore_current = True
+            else:
+                self.value.cache_current_ttl = 50 + self.id
+            barrier.wait(timeout=10)
+            return str(self.id)
+
+    def work(i):
+        with app.app_context():
+            return Flagged(i).value()
+
+    with ThreadPoolExecutor(THREADS) as executor:
+        assert list(executor.map(work, range(THREADS))) == [str(i) for i in range(THREADS)]
+
+    assert sorted(int(k.split(':')[1]) for k in redis.keys('Flagged:*')) == list(range(0, THREADS, 2))
+    for i in range(0, THREADS, 2):
+        assert redis.ttl('Flagged:%s' % i) == 50 + i
+
+
+def test_flags_do_not_leak_across_asyncio_tasks(app):
+    aioredis = pytest.importorskip('fakeredis.aioredis')
+    state = app.extensions.frasco_redis
+    server = app.redis_server
+    redis = state.cache_connection
+
+    def get_async_connection(name=None, binary=False):
+        connections = state.async_connections.setdefault(asyncio.get_running_loop(), {})
+        if (name, binary) not in connections:
+            connections[(name, binary)] = aioredis.FakeRedis(server=server, decode_responses=not binary)
+        return connections[(name, binary)]
+    state.get_async_connection = get_async_connection
+
+    class AsyncObj(object):
+        def __init__(self, id):
+            self.id = id
+
+        @async_redis_cached_method(key='AsyncObj:{id}', ttl=100)
+        async def value(self):
+            if self.id % 2:
+                self.value.cache_ignore_current = True
+            else:
+                self.value.cache_current_ttl = 50 + self.id
+            # let the other tasks run and set their own flags
+            await asyncio.sleep(0.01)
+            return str(self.id)
+
+    async def main():
+        return await asyncio.gather(*[AsyncObj(i).value() for i in range(THREADS)])
+
+    assert asyncio.run(main()) == [str(i) for i in range(THREADS)]
+    assert sorted(int(k.split(':')[1]) for k in redis.keys('AsyncObj:*')) == list(range(0, THREADS, 2))
+    for i in range(0, THREADS, 2):
+        assert redis.ttl('AsyncObj:%s' % i) == 50 + i
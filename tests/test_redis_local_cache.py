@@ -0,0 +1,42 @@
+"""Tests for the local cache invalidations subscription.
+Run with: python -m pytest tests
+"""
+import pytest
+
+from frasco.app import Frasco
+from frasco.redis import get_local_cache
+from frasco.redis.ext import FrascoRedis
+
+
+@pytest.fixture
+def app():
+    app = Frasco(__name__)
+    # nothing listens on this port, connections are refused right away
+    app.config.update(FRASCO_REDIS_URL='redis://127.0.0.1:1/0', FRASCO_REDIS_SOCKET_CONNECT_TIMEOUT=0.5,
+                      FRASCO_REDIS_CIRCUIT_BREAKER_THRESHOLD=2)
+    FrascoRedis(app)
+    with app.app_context():
+        yield app
+
+
+def test_local_cache_is_not_used_without_the_invalidations_subscription(app):
+    assert get_local_cache() is None
+    assert not app.extensions.frasco_redis.local_cache.has_listener()
+
+
+def test_local_cache_is_cleared_when_the_subscription_is_lost(app):
+    fakeredis = pytest.importorskip('fakeredis')
+    local_cache = app.extensions.frasco_redis.local_cache
+    local_cache.reconnect_interval = 0
+    app.extensions.frasco_redis.cache_connection = fakeredis.FakeRedis(decode_responses=True)
+    assert get_local_cache() is local_cache
+    local_cache.set('key', 'value')
+
+    local_cache._on_listener_error(ConnectionError('lost'), None, None)
+    assert get_local_cache() is None
+    assert len(local_cache) == 0
+
+    local_cache.set('key', 'stale')
+    local_cache._on_listener_connect(None)
+    assert get_local_cache() is local_cache
+    assert local_cache.get('key') is None
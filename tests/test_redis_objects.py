@@ -0,0 +1,38 @@
+"""Tests for the redis objects.
+Run with: python -m pytest tests (requires fakeredis)
+"""
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from frasco.app import Frasco
+from frasco.redis.ext import FrascoRedis
+from frasco.redis.objects import JSONRedisHash, JSONRedisList
+
+
+@pytest.fixture
+def app():
+    app = Frasco(__name__)
+    app.config.update(FRASCO_REDIS_CONNECTIONS={'sessions': 'redis://localhost:6379/1'})
+    FrascoRedis(app)
+    app.extensions.frasco_redis.connections[('sessions', False)] = fakeredis.FakeRedis(decode_responses=True)
+    return app
+
+
+def test_named_connection_is_resolved_when_used(app):
+    # created outside of an app context (eg: at import time)
+    data = JSONRedisHash('hash', redis='sessions')
+    with app.app_context():
+        data['a'] = {'b': 1}
+        assert data['a'] == {'b': 1}
+        assert app.extensions.frasco_redis.get_connection('sessions').hget('hash', 'a') == '{"b": 1}'
+
+
+@pytest.mark.parametrize('index', [slice(None, None, 2), slice(None, None, -1), slice(7, 2, -1), slice(8, None, -3),
+                                   slice(-2, 1, -2), slice(2, 7, -1), slice(1, 20, 3), slice(-20, 20, -1)])
+def test_list_slice_with_step(app, index):
+    values = list(range(10))
+    with app.app_context():
+        lst = JSONRedisList('list', redis='sessions')
+        lst.extend(values)
+        assert lst[index] == values[index]
@@ -0,0 +1,44 @@
+"""Tests for the cache tags.
+Run with: python -m pytest tests (requires fakeredis)
+"""
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from frasco.app import Frasco
+from frasco.redis import redis_get_set, invalidate_cache_tags
+from frasco.redis.ext import FrascoRedis
+
+
+@pytest.fixture
+def app():
+    app = Frasco(__name__)
+    app.config.update(FRASCO_REDIS_CONNECTIONS={'other': 'redis://localhost:6379/1'})
+    FrascoRedis(app)
+    state = app.extensions.frasco_redis
+    for name in (None, 'other'):
+        server = fakeredis.FakeServer()
+        state.connections[(name, False)] = fakeredis.FakeRedis(server=server, decode_responses=True)
+        state.connections[(name, True)] = fakeredis.FakeRedis(server=server)
+    state.cache_connection = state.connections[(None, False)]
+    state.cache_binary_connection = state.connections[(None, True)]
+    with app.app_context():
+        yield app
+
+
+def test_tagged_keys_are_invalidated_on_their_connection(app):
+    state = app.extensions.frasco_redis
+    other = state.get_connection('other')
+    assert redis_get_set('a', lambda: 'value', tags=['tag']) == 'value'
+    assert redis_get_set('b', lambda: 'value', tags=['tag'], redis='other') == 'value'
+    assert other.get('b') is not None
+    # the connections holding tag indexes are read from redis, not from the current process
+    state.tagged_connections.clear()
+    invalidate_cache_tags('tag')
+    assert state.cache_connection.get('a') is None
+    assert other.get('b') is None
+
+
+def test_tags_cannot_be_used_with_unknown_clients(app):
+    with pytest.raises(ValueError):
+        redis_get_set('a', lambda: 'value', tags=['tag'], redis=fakeredis.FakeRedis())
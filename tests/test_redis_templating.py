@@ -0,0 +1,41 @@
+"""Tests for the {% cache %} template tag.
+Run with: python -m pytest tests (requires fakeredis)
+"""
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from flask import render_template_string
+from frasco.app import Frasco
+from frasco.redis.ext import FrascoRedis
+
+
+@pytest.fixture
+def app():
+    app = Frasco(__name__)
+    FrascoRedis(app)
+    state = app.extensions.frasco_redis
+    server = fakeredis.FakeServer()
+    state.cache_connection = fakeredis.FakeRedis(server=server, decode_responses=True)
+    state.cache_binary_connection = fakeredis.FakeRedis(server=server)
+    with app.test_request_context():
+        yield app
+
+
+def test_legacy_positional_key_and_timeout(app):
+    redis = app.extensions.frasco_redis.cache_binary_connection
+    assert render_template_string('{% cache "sidebar", 600 %}content{% endcache %}') == 'content'
+    assert redis.get('sidebar') == b'content'
+    assert 590 < redis.ttl('sidebar') <= 600
+    assert render_template_string('{% cache "sidebar:" ~ 1 %}other{% endcache %}') == 'other'
+    assert redis.get('sidebar:1') == b'other'
+    assert redis.ttl('sidebar:1') > 3000
+
+
+def test_key_derived_from_arguments(app):
+    redis = app.extensions.frasco_redis.cache_binary_connection
+    template = '{% cache user, "header" %}{{ user }}{% endcache %}'
+    assert render_template_string(template, user='a') == 'a'
+    assert render_template_string(template, user='b') == 'b'
+    assert render_template_string(template, user='a') == 'a'
+    assert len([k for k in redis.keys() if k.startswith(b'fragment:')]) == 2
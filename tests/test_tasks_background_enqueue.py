@@ -0,0 +1,67 @@
+"""Tests for tasks enqueued from the background delayed calls thread pool.
+Run with: python -m pytest tests (requires fakeredis)
+"""
+import threading
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+pytest.importorskip('frasco.users') # frasco.tasks can only be imported after frasco.users
+tasks = pytest.importorskip('frasco.tasks')
+
+from flask_login import LoginManager
+from frasco.app import Frasco
+from frasco.ctx import ContextStack
+from frasco.models import db, transaction
+from frasco.models.transactions import flush_delayed_tx_calls
+
+
+forwarded_ctx = ContextStack()
+dump_threads = []
+
+
+class TaskArg(object):
+    def __init__(self, id):
+        self.id = id
+
+    def __taskdump__(self):
+        dump_threads.append(threading.current_thread())
+        return None, self.id
+
+    @classmethod
+    def __taskload__(cls, id):
+        return cls(id)
+
+
+@tasks.task(forward_contexts=[__name__ + '.forwarded_ctx'])
+def background_task(arg):
+    pass
+
+
+@pytest.fixture
+def app():
+    app = Frasco(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://', RQ_ASYNC=True,
+                      FRASCO_MODELS_BACKGROUND_DELAYED_CALLS=True)
+    LoginManager(app).user_loader(lambda id: None) # jobs record the current user
+    db.init_app(app)
+    tasks.FrascoTasks(app)
+    app.extensions.frasco_tasks.rq._connection = fakeredis.FakeRedis()
+    yield app
+    app.extensions.pop('frasco_delayed_tx_calls', None)
+
+
+def test_jobs_are_built_in_the_calling_thread(app):
+    del dump_threads[:]
+    with app.test_request_context():
+        assert app.extensions.get('frasco_delayed_tx_calls') is not None
+        with forwarded_ctx('value'):
+            with transaction():
+                background_task.enqueue(TaskArg(42))
+            flush_delayed_tx_calls(5)
+        queue = app.extensions.frasco_tasks.rq.get_queue()
+        jobs = queue.get_jobs()
+    assert len(jobs) == 1
+    assert dump_threads == [threading.current_thread()]
+    assert jobs[0].meta['forwarded_contexts'][__name__ + '.forwarded_ctx'] == ['value']
+    assert list(jobs[0].args) == [{'$taskobj': [__name__ + '.TaskArg', 42]}]
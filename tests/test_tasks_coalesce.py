@@ -0,0 +1,61 @@
+"""Tests for the coalescing of tasks enqueued during a transaction.
+Run with: python -m pytest tests
+"""
+import pytest
+
+pytest.importorskip('frasco.users') # frasco.tasks can only be imported after frasco.users
+tasks = pytest.importorskip('frasco.tasks')
+
+from frasco.ctx import DelayedCallsContext
+
+
+@tasks.task(coalesce=True)
+def first_task(obj_id):
+    pass
+
+
+@tasks.task(coalesce=True)
+def second_task(obj_id):
+    pass
+
+
+@tasks.task(coalesce=lambda obj_id, **kwargs: obj_id)
+def first_keyed_task(obj_id, **kwargs):
+    pass
+
+
+@tasks.task(coalesce=lambda obj_id, **kwargs: obj_id)
+def second_keyed_task(obj_id, **kwargs):
+    pass
+
+
+def enqueue_all(calls):
+    enqueued = []
+    ctx = DelayedCallsContext()
+    enqueue = ctx.proxy(lambda func, **options: enqueued.append((func, options)),
+                        dedupe_key=tasks._enqueue_dedupe_key)
+    with ctx():
+        for func, args in calls:
+            enqueue(func, args=args, kwargs={})
+    return [(func, options['args']) for func, options in enqueued]
+
+
+def test_tasks_sharing_args_are_not_coalesced_together():
+    assert enqueue_all([(first_task, (1,)), (second_task, (1,)), (first_task, (1,)), (second_task, (1,))]) == [
+        (first_task, (1,)), (second_task, (1,))]
+
+
+def test_same_task_is_coalesced_per_args():
+    assert enqueue_all([(first_task, (1,)), (first_task, (2,)), (first_task, (1,))]) == [
+        (first_task, (1,)), (first_task, (2,))]
+
+
+def test_tasks_sharing_a_coalesce_key_are_not_coalesced_together():
+    assert enqueue_all([(first_keyed_task, (1,)), (second_keyed_task, (1,)), (first_keyed_task, (1,))]) == [
+        (first_keyed_task, (1,)), (second_keyed_task, (1,))]
+
+
+def test_dedupe_key_starts_with_the_task_import_name():
+    key = tasks._enqueue_dedupe_key(first_task, args=(1,), kwargs={})
+    assert key[0] == __name__ + '.first_task'
+    assert tasks._enqueue_dedupe_key('app.tasks.first_task', args=(1,), kwargs={}, coalesce=True)[0] == 'app.tasks.first_task'